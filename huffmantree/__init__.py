@@ -0,0 +1,10 @@
+"""
+Huffman compression of files, streams and in-memory payloads.
+
+Run as python -m huffmantree to compress, uncompress or verify files from the
+command line.
+"""
+
+from .huffman import compress, uncompress, read_range, compress_context
+from .huffman import compress_bytes, uncompress_bytes
+from .huffman import compress_files, uncompress_files, verify, verify_files
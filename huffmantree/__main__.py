@@ -0,0 +1,11 @@
+"""
+Command line entry point: python -m huffmantree c|u FILES...
+
+Unlike running huffman.py directly, this never runs the doctests or
+prompts for input.
+"""
+
+import sys
+from .huffman import main
+
+sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+Benchmarks for the stages of compressing and decompressing in huffman.py.
+
+Run as
+    python benchmark.py -o results.json
+    python benchmark.py -o new.json --compare results.json
+The second run exits with status 1 if any stage, or importing the
+package, got slower by more than the threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+try:
+    from .huffman import make_freq_dict, huffman_tree, get_codes
+    from .huffman import number_nodes, generate_compressed
+    from .huffman import generate_uncompressed, num_nodes_to_bytes
+    from .huffman import tree_to_bytes, avg_length, decode_cache
+except ImportError:
+    # run as a script, or imported from this directory
+    from huffman import make_freq_dict, huffman_tree, get_codes
+    from huffman import number_nodes, generate_compressed
+    from huffman import generate_uncompressed, num_nodes_to_bytes
+    from huffman import tree_to_bytes, avg_length, decode_cache
+
+# Sample files timed when present next to this module
+SAMPLE_FILES = ["book.txt", "dan.bmp", "music.wav", "music.mp3"]
+# Sizes of the synthetic inputs
+SYNTHETIC_SIZES = [1 << 16, 1 << 20]
+# Stages timed, in the order they run
+STAGES = ["make_freq_dict", "huffman_tree", "get_codes",
+          "generate_compressed", "header", "generate_uncompressed"]
+# Slowdown of a stage, as a fraction, reported as a regression
+THRESHOLD = 0.25
+# Stages faster than this many seconds in both runs are too noisy to compare
+MIN_SECONDS = 1e-3
+# Import times below this many seconds in both runs are too noisy to compare
+MIN_IMPORT_SECONDS = 1e-2
+
+
+def synthetic_inputs(size, seed=0):
+    """ Return a dict of named inputs of size bytes with entropies from none
+    to 8 bits per byte, made by a random generator seeded with seed so
+    every run gets the same bytes.
+
+    @param int size: bytes in each input
+    @param int seed: seed of the random generator
+    @rtype: dict(str,bytes)
+
+    >>> inputs = synthetic_inputs(100)
+    >>> sorted(inputs)
+    ['constant-100', 'geometric-100', 'skewed-100', 'uniform-100']
+    >>> inputs == synthetic_inputs(100)
+    True
+    """
+    rng = random.Random(seed)
+    return {
+        "constant-{}".format(size): bytes(size),
+        "skewed-{}".format(size): bytes(rng.choices(b"ab", [9, 1], k=size)),
+        "geometric-{}".format(size): bytes(rng.choices(
+            range(256), [0.5 ** symbol for symbol in range(256)], k=size)),
+        "uniform-{}".format(size): rng.randbytes(size)}
+
+
+def load_inputs(directory, sizes=None):
+    """ Return a dict of the sample files found in directory and the
+    synthetic inputs of each of sizes, by name.
+
+    @param str directory: where the sample files are
+    @param list[int]|None sizes: sizes of synthetic inputs, or
+    SYNTHETIC_SIZES if None
+    @rtype: dict(str,bytes)
+    """
+    inputs = {}
+    for name in SAMPLE_FILES:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                inputs[name] = f.read()
+    for size in SYNTHETIC_SIZES if sizes is None else sizes:
+        inputs.update(synthetic_inputs(size))
+    return inputs
+
+
+def time_stage(function, repeat, memory=True):
+    """ Return the least wall time of repeat calls of function, with the
+    peak memory allocated by one more call, and that call's result.
+
+    Memory is traced by tracemalloc, which makes the extra call many times
+    slower; if not memory, the extra call is not traced and the peak is
+    None.
+
+    @param callable function: a function of no arguments
+    @param int repeat: number of timed calls
+    @param bool memory: whether to measure peak memory
+    @rtype: (float, int|None, object)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    if not memory:
+        return best, None, function()
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def bench_input(text, repeat, memory=True):
+    """ Return the timings of each stage of compressing and decompressing
+    text, with its compression figures.
+
+    @param bytes text: the input
+    @param int repeat: number of timed calls of each stage
+    @param bool memory: whether to measure peak memory
+    @rtype: dict
+    """
+    stages = {}
+
+    def record(stage, function):
+        """ Time function as stage and return its result. """
+        seconds, peak, result = time_stage(function, repeat, memory)
+        stages[stage] = {"seconds": seconds,
+                         "mb_per_s": len(text) / 1e6 / max(seconds, 1e-9),
+                         "peak_bytes": peak}
+        return result
+
+    def header():
+        """ Serialize tree as compress does. """
+        number_nodes(tree)
+        return num_nodes_to_bytes(tree) + tree_to_bytes(tree)
+
+    def uncompressed():
+        """ Decompress as for a new tree, building its decoding table
+        rather than finding it in decode_cache. """
+        decode_cache.clear()
+        return generate_uncompressed(tree, compressed, len(text))
+
+    freq = record("make_freq_dict", lambda: make_freq_dict(text))
+    if len(freq) < 2:
+        # a tree of one leaf has no codes to time past this point
+        return {"size": len(text), "stages": stages}
+    tree = record("huffman_tree", lambda: huffman_tree(freq))
+    codes = record("get_codes", lambda: get_codes(tree))
+    compressed = record("generate_compressed",
+                        lambda: generate_compressed(text, codes))
+    header_bytes = record("header", header)
+    if record("generate_uncompressed", uncompressed) != text:
+        raise ValueError("round trip failed")
+    return {"size": len(text), "stages": stages,
+            "compressed_size": len(header_bytes) + 4 + len(compressed),
+            "bits_per_symbol": avg_length(tree, freq)}
+
+
+def run(inputs, repeat=5, memory=True):
+    """ Return the benchmark results for each of inputs, with a description
+    of the machine they were measured on.
+
+    @param dict(str,bytes) inputs: inputs by name
+    @param int repeat: number of timed calls of each stage
+    @param bool memory: whether to measure peak memory
+    @rtype: dict
+    """
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+            "inputs": {name: bench_input(text, repeat, memory)
+                       for name, text in inputs.items()}}
+
+
+def compare(old, new, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    """ Return a line for each stage of each input in both old and new that
+    is more than threshold slower in new, ignoring stages taking under
+    min_seconds in both, and one for importing the package if that is.
+
+    @param dict old: earlier results from run
+    @param dict new: later results from run
+    @param float threshold: slowdown reported, as a fraction
+    @param float min_seconds: time below which stages are not compared
+    @rtype: list[str]
+
+    >>> old = {"inputs": {"a": {"stages": {"get_codes": {"seconds": 1.0}}}}}
+    >>> new = {"inputs": {"a": {"stages": {"get_codes": {"seconds": 1.5}}}}}
+    >>> compare(old, new)
+    ['a get_codes: 1.000000s -> 1.500000s (+50%)']
+    >>> compare(new, old)
+    []
+    >>> compare(old, new, min_seconds=2.0)
+    []
+    >>> compare({"inputs": {}, "import_seconds": 0.050},
+    ...         {"inputs": {}, "import_seconds": 0.053})
+    []
+    >>> compare({"inputs": {}, "import_seconds": 0.050},
+    ...         {"inputs": {}, "import_seconds": 0.080})
+    ['import: 0.050000s -> 0.080000s (+60%)']
+    """
+    lines = []
+    for name, result in new["inputs"].items():
+        old_stages = old["inputs"].get(name, {}).get("stages", {})
+        for stage in STAGES:
+            if stage not in result["stages"] or stage not in old_stages:
+                continue
+            before = old_stages[stage]["seconds"]
+            after = result["stages"][stage]["seconds"]
+            if max(before, after) >= min_seconds and \
+                    after > before * (1 + threshold):
+                lines.append("{} {}: {:.6f}s -> {:.6f}s (+{:.0%})".format(
+                    name, stage, before, after, after / before - 1))
+    if "import_seconds" in old and "import_seconds" in new:
+        before, after = old["import_seconds"], new["import_seconds"]
+        if max(before, after) >= MIN_IMPORT_SECONDS and \
+                after > before * (1 + threshold):
+            lines.append("import: {:.6f}s -> {:.6f}s (+{:.0%})".format(
+                before, after, after / before - 1))
+    return lines
+
+
+def import_time(module="huffmantree", repeat=5):
+    """ Return the least seconds that importing module takes in each of
+    repeat fresh interpreters started in the directory holding the
+    package, not counting the interpreter's own startup.
+
+    Bytecode is cached as usual, so this is the cold start of a process
+    rather than of a newly installed package, unless
+    PYTHONDONTWRITEBYTECODE is set.
+
+    @param str module: name of the module to import
+    @param int repeat: number of interpreters
+    @rtype: float
+    """
+    code = ("import time; start = time.perf_counter(); import {}; "
+            "print(time.perf_counter() - start)").format(module)
+    parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return min(float(subprocess.run([sys.executable, "-c", code], cwd=parent,
+                                    check=True, capture_output=True,
+                                    text=True).stdout)
+               for _ in range(repeat))
+
+
+def format_results(results):
+    """ Return a table of the MB/s of each stage of each input in results.
+
+    @param dict results: results from run
+    @rtype: str
+    """
+    lines = ["{:<20}".format("input") +
+             "".join("{:>22}".format(stage) for stage in STAGES)]
+    for name, result in results["inputs"].items():
+        lines.append("{:<20}".format(name) + "".join(
+            "{:>22.2f}".format(result["stages"][stage]["mb_per_s"])
+            if stage in result["stages"] else "{:>22}".format("-")
+            for stage in STAGES))
+    if "import_seconds" in results:
+        lines.append("import: {:.1f} ms".format(
+            results["import_seconds"] * 1e3))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """ Run the benchmarks as the command line argv asks, print a table of
+    MB/s, and return 1 if a comparison found regressions, in the stages or
+    importing the package, and 0 otherwise.
+
+    @param list[str]|None argv: arguments, or sys.argv[1:] if None
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("-o", "--output", help="file to write results to")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed calls of each stage (default: 5)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="slowdown reported as a regression")
+    parser.add_argument("--quick", action="store_true",
+                        help="only the smallest synthetic inputs")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the slow peak memory measurement")
+    args = parser.parse_args(argv)
+    if args.quick:
+        inputs = load_inputs("", SYNTHETIC_SIZES[:1])
+        inputs = {name: text for name, text in inputs.items()
+                  if name not in SAMPLE_FILES}
+    else:
+        inputs = load_inputs(os.path.dirname(os.path.abspath(__file__)))
+    results = run(inputs, args.repeat, not args.no_memory)
+    results["import_seconds"] = import_time(repeat=args.repeat)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+    for line in regressions:
+        print("REGRESSION", line)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
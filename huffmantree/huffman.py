@@ -2,7 +2,115 @@
 Code for compressing and decompressing using Huffman compression.
 """
 
-from nodes import HuffmanNode, ReadNode
+import glob
+import heapq
+import io
+import math
+import mmap
+import os
+import re
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import closing, contextmanager, nullcontext, suppress
+try:
+    from .nodes import ArrayTree, HuffmanNode, ReadNode
+    from .stats import NullStats
+except ImportError:
+    # run as a script, or imported from this directory
+    from nodes import ArrayTree, HuffmanNode, ReadNode
+    from stats import NullStats
+
+# Number of bits looked up at once by the table-driven decoder
+TABLE_BITS = 12
+# Chunks at least this long are counted with NumPy, if it is installed;
+# importing it takes longer than counting shorter chunks in Python
+NUMPY_MIN_CHUNK = 1 << 16
+# Number of bytes read from a file at once when streaming
+CHUNK_SIZE = 1 << 20
+# First byte of a versioned header. An old-style header starts with its
+# number of internal nodes instead, which is never 0.
+HEADER_MAGIC = 0
+# Format of an old-style header holding the tree, which has no format byte
+FORMAT_TREE = 0
+# Format byte following HEADER_MAGIC for canonical codes stored as lengths
+FORMAT_CANONICAL = 1
+# Format byte following HEADER_MAGIC for independently encoded blocks
+FORMAT_BLOCKS = 2
+# Number of bytes of input in each block of the block format
+BLOCK_SIZE = 1 << 17
+# Last bytes of a compressed file ending with a seek index
+INDEX_MAGIC = b"HIDX"
+# Flag set in the format byte of a file with a seek index. A tree header
+# with a flag set is preceded by HEADER_MAGIC and FORMAT_TREE with the flag.
+INDEXED = 1 << 7
+# Format byte following HEADER_MAGIC for streams of symbols wider than bytes
+FORMAT_SYMBOLS = 3
+# Ways of splitting a text into symbols for FORMAT_SYMBOLS: single bytes,
+# 16-bit little-endian words, or words and the runs between them
+SYMBOLS_BYTE = 1
+SYMBOLS_16BIT = 2
+SYMBOLS_WORD = 3
+# What counts as one token for SYMBOLS_WORD
+WORD_PATTERN = re.compile(rb"\w+|\W+")
+# Format byte following HEADER_MAGIC for one-pass streams whose codes adapt
+# to the bytes seen so far
+FORMAT_ADAPTIVE = 4
+# Default bytes coded with each model in FORMAT_ADAPTIVE
+ADAPTIVE_BLOCK_SIZE = 1 << 16
+# Total count above which the FORMAT_ADAPTIVE model halves its counts, so
+# that it keeps following changes in the input
+ADAPTIVE_COUNT_LIMIT = 1 << 22
+# Format byte following HEADER_MAGIC for files stored without coding,
+# because coding would not make them smaller
+FORMAT_STORED = 6
+# Bytes before the body of a FORMAT_STORED file: magic, format and size
+STORED_HEADER_SIZE = 6
+# Least fraction of its size that coding must save for a file or block not
+# to be stored, since decoding costs far more than copying
+STORE_SAVING = 0.01
+# Flag set in the original size of a block of FORMAT_BLOCKS stored without
+# coding
+STORED_BLOCK = 1 << 31
+# Default number of decoding tables kept by decode_cache
+DECODE_CACHE_SIZE = 64
+# Format byte following HEADER_MAGIC for messages coded with a shared
+# dictionary, which is named by its ID instead of being stored
+FORMAT_DICTIONARY = 5
+# Bytes of the fingerprint of its code lengths a dictionary message carries
+DICTIONARY_FINGERPRINT_SIZE = 2
+# Last bytes of a compressed file ending with checksums, after any seek index
+CHECKSUM_MAGIC = b"HCRC"
+# Flag set in the format byte of a file ending with checksums, like INDEXED
+CHECKSUMMED = 1 << 6
+# Added to the name of the file uncompress writes until it is complete
+PARTIAL_SUFFIX = ".part"
+# Format byte following HEADER_MAGIC for canonical codes of the bytes left
+# by run-length coding the input
+FORMAT_RLE = 7
+# Equal bytes in a row after which run-length coding adds a count of the
+# repeats that follow, and the largest such count
+RLE_RUN = 4
+RLE_MAX_COUNT = 255
+# Runs of RLE_RUN or more equal bytes, and RLE_RUN equal bytes with their
+# count
+RUN_PATTERN = re.compile(rb"(.)\1{3,}", re.DOTALL)
+RUN_CODE_PATTERN = re.compile(rb"(.)\1{3}(.)", re.DOTALL)
+# Number and size of the samples of a file from which compress estimates
+# what run-length coding would save
+RLE_SAMPLES = 16
+RLE_SAMPLE_SIZE = 1 << 12
+# Least fraction of the samples that run-length coding must save for
+# compress to choose it
+RLE_SAVING = 0.1
+# Format byte following HEADER_MAGIC for order-1 codes, chosen by the byte
+# before each byte from a few sets of canonical codes
+FORMAT_CONTEXT = 8
+# Most bits looked up at once in each decoding table of FORMAT_CONTEXT,
+# fewer than TABLE_BITS since there may be a table for every byte
+CONTEXT_TABLE_BITS = 10
 
 
 # ====================
@@ -52,6 +160,85 @@ def bits_to_byte(bits):
                 for pos in range(len(bits))])
 
 
+def iter_chunks(f, chunk_size=CHUNK_SIZE, limit=None):
+    """ Yield the rest of the binary file f, or its next limit bytes if
+    limit is given, in bytes objects of at most chunk_size bytes.
+
+    @param file f: a file opened for reading in binary mode
+    @param int chunk_size: most bytes yielded at once
+    @param int|None limit: most bytes yielded in all, if any
+    @rtype: generator[bytes]
+
+    >>> import io
+    >>> list(iter_chunks(io.BytesIO(bytes([1, 2, 3, 4, 5])), 2))
+    [b'\\x01\\x02', b'\\x03\\x04', b'\\x05']
+    >>> list(iter_chunks(io.BytesIO(bytes([1, 2, 3, 4, 5])), 2, 3))
+    [b'\\x01\\x02', b'\\x03']
+    """
+    if limit is None:
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+        return
+    while limit > 0:
+        chunk = f.read(min(chunk_size, limit))
+        if not chunk:
+            return
+        limit -= len(chunk)
+        yield chunk
+
+
+def iter_views(view, chunk_size=CHUNK_SIZE):
+    """ Yield consecutive slices of view of at most chunk_size bytes,
+    without copying them.
+
+    @param memoryview view: a memoryview of bytes
+    @param int chunk_size: most bytes yielded at once
+    @rtype: generator[memoryview]
+
+    >>> [bytes(piece) for piece in iter_views(memoryview(b"abcde"), 2)]
+    [b'ab', b'cd', b'e']
+    """
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+@contextmanager
+def map_file(f):
+    """ Memory-map the whole binary file f for reading, and provide the
+    map as a memoryview.
+
+    Slices of the memoryview must be released before the map is closed.
+
+    @param file f: a non-empty file opened for reading in binary mode
+    @rtype: generator[memoryview]
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped) as view:
+        yield view
+
+
+def write_mapped(out_file, pieces, size):
+    """ Write the bytes objects in pieces, size bytes in total, to out_file
+    through a memory map of the file preallocated to size bytes.
+
+    @param str out_file: output file to write
+    @param iterable[bytes] pieces: bytes to write in order
+    @param int size: total number of bytes in pieces
+    @rtype: NoneType
+    """
+    with open(out_file, "w+b") as g:
+        g.truncate(size)
+        if size == 0:
+            return
+        with mmap.mmap(g.fileno(), size) as mapped:
+            pos = 0
+            for piece in pieces:
+                mapped[pos:pos + len(piece)] = piece
+                pos += len(piece)
+
+
 # ====================
 # Functions for compression
 
@@ -59,20 +246,120 @@ def bits_to_byte(bits):
 def make_freq_dict(text):
     """ Return a dictionary that maps each byte in text to its frequency.
 
-    @param bytes text: a bytes object
+    text may also be an array of wider symbols, such as 16-bit words or
+    word numbers, or an iterable of chunks that are bytes-like objects or
+    arrays, whose counts are added together. Bytes are in the order they
+    first occur in text, which decides how huffman_tree breaks ties, and
+    wider symbols are in increasing order.
+
+    @param bytes|bytearray|memoryview|array|iterable text: a bytes-like
+    object or array of symbols, or chunks of them
     @rtype: dict{int,int}
 
     >>> d = make_freq_dict(bytes([65, 66, 67, 66]))
     >>> d == {65: 1, 66: 2, 67: 1}
     True
+    >>> make_freq_dict([bytes([67, 66]), bytearray([65, 66])])
+    {67: 1, 66: 2, 65: 1}
+    >>> make_freq_dict(array("I", [70000, 65, 70000]))
+    {65: 1, 70000: 2}
     """
-    freq_dict = {}
-    for i in text:
-        if i in freq_dict:
-            freq_dict[i] += 1
+    if isinstance(text, (bytes, bytearray, memoryview, array)):
+        text = [text]
+    counts = [0] * 256
+    seen = []
+    wide_counts = Counter()
+    for chunk in text:
+        if isinstance(chunk, array):
+            wide_counts.update(chunk)
         else:
-            freq_dict[i] = 1
-    return freq_dict
+            unseen = [symbol for symbol in range(256) if not counts[symbol]]
+            _count_bytes(chunk, counts)
+            seen += _first_seen(chunk, [symbol for symbol in unseen
+                                        if counts[symbol]])
+    if not wide_counts:
+        return {symbol: counts[symbol] for symbol in seen}
+    for symbol, count in enumerate(counts):
+        if count:
+            wide_counts[symbol] += count
+    return dict(sorted(wide_counts.items()))
+
+
+# The numpy module once _load_numpy has imported it, or False if it is
+# not installed
+_numpy = None
+
+
+def _load_numpy():
+    """ Return the numpy module, importing it on first use, or None if it
+    is not installed.
+
+    @rtype: module|None
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _process_pool(workers):
+    """ Return a ProcessPoolExecutor of workers processes, importing it on
+    first use so that importing this module stays fast.
+
+    @param int workers: number of processes
+    @rtype: ProcessPoolExecutor
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(workers)
+
+
+def _first_seen(chunk, symbols):
+    """ Return symbols, bytes which all occur in chunk, in the order they
+    first occur in it.
+
+    Memoryviews have no find method, so each byte is searched for with a
+    one-byte pattern, which re keeps compiled between calls.
+
+    @param bytes|bytearray|memoryview chunk: a bytes-like object
+    @param list[int] symbols: bytes occurring in chunk
+    @rtype: list[int]
+
+    >>> _first_seen(memoryview(b"abracadabra"), [ord("d"), ord("a")])
+    [97, 100]
+    """
+    return sorted(symbols, key=lambda symbol: re.search(
+        re.escape(bytes([symbol])), chunk).start())
+
+
+def _count_bytes(chunk, counts):
+    """ Add the number of times each byte occurs in chunk to counts.
+
+    Uses numpy.bincount for chunks of NUMPY_MIN_CHUNK bytes or more when
+    NumPy is installed, which is much faster on them than counting in
+    Python.
+
+    @param bytes|bytearray|memoryview chunk: a bytes-like object
+    @param list[int] counts: a running count for each of the 256 bytes
+    @rtype: NoneType
+
+    >>> counts = [0] * 256
+    >>> _count_bytes(bytes([1, 1, 255]), counts)
+    >>> counts[1], counts[255], sum(counts)
+    (2, 1, 3)
+    """
+    numpy = _load_numpy() if len(chunk) >= NUMPY_MIN_CHUNK else None
+    if numpy is not None:
+        histogram = numpy.bincount(numpy.frombuffer(chunk, numpy.uint8),
+                                   minlength=256).tolist()
+        for symbol in range(256):
+            counts[symbol] += histogram[symbol]
+    else:
+        for symbol, count in Counter(chunk).items():
+            counts[symbol] += count
 
 
 def huffman_tree(freq_dict):
@@ -88,24 +375,115 @@ def huffman_tree(freq_dict):
     >>> result2 = HuffmanNode(None, HuffmanNode(2), HuffmanNode(3))
     >>> t == result1 or t == result2
     True
-    >>> freq = {3:10, 5:20, 7:30, 11:40, 13:50}
+    >>> freq = {3: 10, 5: 10, 7: 20}
     >>> huffman_tree(freq)
-
+    HuffmanNode(None, HuffmanNode(7, None, None), \
+HuffmanNode(None, HuffmanNode(3, None, None), HuffmanNode(5, None, None)))
     """
-    # Create a list of tuple(freq, HuffmanNode) and sorted by freq
-    lst = []
-    for key in freq_dict:
-        lst.append((freq_dict[key], HuffmanNode(key)))
-    lst.sort()
+    # a heap of (freq, order, HuffmanNode), where order breaks ties in
+    # favour of the node that entered first: symbols in freq_dict order,
+    # then merged nodes in the order they were made
+    heap = [(freq, order, HuffmanNode(symbol))
+            for order, (symbol, freq) in enumerate(freq_dict.items())]
+    heapq.heapify(heap)
+    order = len(heap)
     # Create huffman tree
-    while len(lst) > 1:
-        first = lst.pop(0)
-        second = lst.pop(0)
-        new_freq = first[0] + second[0]
-        new_node = HuffmanNode(None, first[1], second[1])
-        lst.append((new_freq, new_node))
-        lst.sort()
-    return lst[0][1]
+    while len(heap) > 1:
+        first = heapq.heappop(heap)
+        second = heapq.heappop(heap)
+        new_node = HuffmanNode(None, first[2], second[2])
+        heapq.heappush(heap, (first[0] + second[0], order, new_node))
+        order += 1
+    return heap[0][2]
+
+
+def huffman_array_tree(freq_dict):
+    """ Return the same Huffman tree as huffman_tree, as an ArrayTree, for
+    callers that only need its codes and rebuild it often.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @rtype: ArrayTree
+
+    >>> freq = {3: 10, 5: 10, 7: 20}
+    >>> huffman_array_tree(freq).to_huffman_node() == huffman_tree(freq)
+    True
+    """
+    tree = ArrayTree()
+    # a heap of (freq, order, node number), with ties broken as in
+    # huffman_tree
+    heap = [(freq, order, tree.add_node(symbol))
+            for order, (symbol, freq) in enumerate(freq_dict.items())]
+    heapq.heapify(heap)
+    order = len(heap)
+    while len(heap) > 1:
+        first = heapq.heappop(heap)
+        second = heapq.heappop(heap)
+        heapq.heappush(heap, (first[0] + second[0], order,
+                              tree.add_node(-1, first[2], second[2])))
+        order += 1
+    return tree
+
+def limited_code_lengths(freq_dict, max_length):
+    """ Return a dict mapping symbols in freq_dict to the lengths of an
+    optimal prefix code whose codes are at most max_length bits long.
+
+    Uses the package-merge algorithm: the code length of a symbol is the
+    number of times it is picked among the 2n - 2 lightest items, after
+    max_length - 1 rounds of pairing items up and merging the pairs back
+    in with the symbols.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @param int max_length: the longest code allowed
+    @rtype: dict(int,int)
+
+    >>> freq = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8}
+    >>> get_code_lengths(huffman_tree(freq)) == {1: 4, 2: 4, 3: 3, 4: 2, 5: 1}
+    True
+    >>> limited_code_lengths(freq, 3) == {1: 3, 2: 3, 3: 3, 4: 3, 5: 1}
+    True
+    """
+    if len(freq_dict) <= 1:
+        return {symbol: 0 for symbol in freq_dict}
+    if 1 << max_length < len(freq_dict):
+        raise ValueError("{} symbols do not fit in codes of {} bits"
+                         .format(len(freq_dict), max_length))
+    leaves = sorted(((freq, [symbol]) for symbol, freq in freq_dict.items()),
+                    key=lambda item: item[0])
+    items = leaves
+    for _ in range(max_length - 1):
+        packages = [(items[i][0] + items[i + 1][0],
+                     items[i][1] + items[i + 1][1])
+                    for i in range(0, len(items) - 1, 2)]
+        items = sorted(leaves + packages, key=lambda item: item[0])
+    lengths = dict.fromkeys(freq_dict, 0)
+    for _, symbols in items[:2 * len(freq_dict) - 2]:
+        for symbol in symbols:
+            lengths[symbol] += 1
+    return lengths
+
+
+def lengths_to_tree(lengths):
+    """ Return the root HuffmanNode of the tree of the canonical codes with
+    the given code lengths.
+
+    @param dict(int,int) lengths: mappings from symbols to code lengths
+    @rtype: HuffmanNode
+
+    >>> lengths_to_tree({7: 2, 3: 1, 2: 2})
+    HuffmanNode(None, HuffmanNode(3, None, None), \
+HuffmanNode(None, HuffmanNode(2, None, None), HuffmanNode(7, None, None)))
+    """
+    tree = HuffmanNode()
+    for symbol, (value, length) in canonical_codes(lengths).items():
+        node = tree
+        for bit_num in range(length - 1, -1, -1):
+            side = "right" if (value >> bit_num) & 1 else "left"
+            if getattr(node, side) is None:
+                setattr(node, side, HuffmanNode())
+            node = getattr(node, side)
+        node.symbol = symbol
+    return tree
+
 
 def get_codes(tree):
     """ Return a dict mapping symbols from tree rooted at HuffmanNode to codes.
@@ -118,18 +496,106 @@ def get_codes(tree):
     >>> d == {3: "0", 2: "1"}
     True
     """
-    # base case leaf
-    d = {}
+    return {symbol: format(value, "0{}b".format(length)) if length else ""
+            for symbol, (value, length) in get_code_pairs(tree).items()}
+
+
+def get_code_pairs(tree):
+    """ Return a dict mapping symbols from tree rooted at HuffmanNode to
+    (value, length) pairs, where value is the code read as a binary number.
+
+    tree may also be an ArrayTree.
+
+    @param HuffmanNode|ArrayTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: dict(int,(int,int))
+
+    >>> right = HuffmanNode(None, HuffmanNode(2), HuffmanNode(7))
+    >>> tree = HuffmanNode(None, HuffmanNode(3), right)
+    >>> d = get_code_pairs(tree)
+    >>> d == {3: (0, 1), 2: (2, 2), 7: (3, 2)}
+    True
+    """
+    if isinstance(tree, ArrayTree):
+        return tree.code_pairs()
+    codes = {}
     if not tree:
-        return {}
-    if tree.is_leaf():
-        d = {tree.symbol: ""}
-    # recursion internal
-    for key, value in get_codes(tree.left).items():
-        d[key] = "0" + value
-    for key, value in get_codes(tree.right).items():
-        d[key] = "1" + value
-    return d
+        return codes
+    # walk the tree with an explicit stack of (node, value, length)
+    stack = [(tree, 0, 0)]
+    while stack:
+        node, value, length = stack.pop()
+        if node.is_leaf():
+            codes[node.symbol] = (value, length)
+            continue
+        if node.right:
+            stack.append((node.right, (value << 1) | 1, length + 1))
+        if node.left:
+            stack.append((node.left, value << 1, length + 1))
+    return codes
+
+
+def _iter_internal_postorder(tree):
+    """ Yield the internal nodes of tree in postorder, without recursion.
+
+    @param HuffmanNode tree: a Huffman tree rooted at node 'tree'
+    @rtype: generator[HuffmanNode]
+
+    >>> left = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+    >>> tree = HuffmanNode(None, left, HuffmanNode(5))
+    >>> [node is left for node in _iter_internal_postorder(tree)]
+    [True, False]
+    """
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node is None or node.is_leaf():
+            continue
+        if expanded:
+            yield node
+        else:
+            stack.extend([(node, True), (node.right, False),
+                          (node.left, False)])
+
+
+def get_code_lengths(tree):
+    """ Return a dict mapping symbols from tree rooted at HuffmanNode, or
+    in an ArrayTree, to the lengths of their codes.
+
+    @param HuffmanNode|ArrayTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: dict(int,int)
+
+    >>> right = HuffmanNode(None, HuffmanNode(2), HuffmanNode(7))
+    >>> tree = HuffmanNode(None, HuffmanNode(3), right)
+    >>> get_code_lengths(tree) == {3: 1, 2: 2, 7: 2}
+    True
+    """
+    return {symbol: length
+            for symbol, (_, length) in get_code_pairs(tree).items()}
+
+
+def canonical_codes(lengths):
+    """ Return the canonical Huffman codes with the given code lengths, as
+    a dict mapping symbols to (value, length) pairs.
+
+    Symbols are given consecutive codes in order of (length, symbol), so
+    the lengths alone are enough to rebuild the codes.
+
+    @param dict(int,int) lengths: mappings from symbols to code lengths
+    @rtype: dict(int,(int,int))
+
+    >>> d = canonical_codes({7: 2, 3: 1, 2: 2})
+    >>> d == {3: (0, 1), 2: (2, 2), 7: (3, 2)}
+    True
+    """
+    codes = {}
+    value = prev_length = 0
+    for length, symbol in sorted((length, symbol)
+                                 for symbol, length in lengths.items()):
+        value <<= length - prev_length
+        codes[symbol] = (value, length)
+        value += 1
+        prev_length = length
+    return codes
 
 
 def number_nodes(tree):
@@ -150,28 +616,11 @@ def number_nodes(tree):
     >>> tree.number
     2
     """
-    def helper(t, num):
-        """Number internal nodes in t according to postorder traversal:
-         start numbering at num and return the next num
-
-        @param HuffmanNode t:  a Huffman tree rooted at node 'tree'
-        @param int num:  starting number
-        @rtype: int
-
-        >>> tree = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
-        >>> helper(tree, 0)
-        1
-        """
-        if t.is_leaf():
-            return num
-        num = helper(t.left, num)
-        num = helper(t.right, num)
-        if t.symbol is None:
-            t.number = num
-            return num + 1
-        return num
-
-    helper(tree, 0)
+    num = 0
+    for node in _iter_internal_postorder(tree):
+        if node.symbol is None:
+            node.number = num
+            num += 1
 
 
 def avg_length(tree, freq_dict):
@@ -192,10 +641,10 @@ def avg_length(tree, freq_dict):
     # get total number of frequency
     total_number = sum(freq_dict.values())
     # get total number of bits
-    dict_ = get_codes(tree)
+    lengths = get_code_lengths(tree)
     number_of_bits = 0
     for key in freq_dict:
-        number_of_bits += len(dict_[key]) * (freq_dict[key])
+        number_of_bits += lengths[key] * (freq_dict[key])
     # calculate
     return number_of_bits / total_number
 
@@ -203,8 +652,12 @@ def avg_length(tree, freq_dict):
 def generate_compressed(text, codes):
     """ Return compressed form of text, using mapping in codes for each symbol.
 
+    Codes may be given as bit strings, as (value, length) pairs or as a
+    table from build_encode_table.
+
     @param bytes text: a bytes object
-    @param dict(int,str) codes: mappings from symbols to codes
+    @param dict(int,str)|dict(int,(int,int))|tuple codes: mappings from
+    symbols to codes
     @rtype: bytes
 
     >>> d = {0: "0", 1: "10", 2: "11"}
@@ -216,19 +669,97 @@ def generate_compressed(text, codes):
     >>> result = generate_compressed(text, d)
     >>> [byte_to_bits(byte) for byte in result]
     ['10111001', '10000000']
+    >>> d = {0: (0, 1), 1: (2, 2), 2: (3, 2)}
+    >>> [byte_to_bits(byte) for byte in generate_compressed(text, d)]
+    ['10111001', '10000000']
     """
-    # get codes
-    result = []
-    temp = ""
-    for i in text:
-        temp += codes.get(i, "")
-    # complement
-    while len(temp) % 8 != 0:
-        temp += "0"
-    # take byte into list
-    for i in range(0, len(temp), 8):
-        result.append(bits_to_byte(temp[i: i + 8]))
-    return bytes(result)
+    return b"".join(iter_compressed([text], codes))
+
+
+def iter_compressed(chunks, codes, offsets=None, interval=None):
+    """ Yield the compressed form of the bytes objects in chunks piece by
+    piece, using mapping in codes for each symbol.
+
+    The codes of consecutive chunks are packed together as if chunks were
+    a single text, so the pieces joined are what generate_compressed returns.
+    If offsets is a list, the bit offset in the compressed text where each
+    chunk starts is appended to it, or where every interval symbols of the
+    text start if interval is given, whatever the size of the chunks.
+
+    @param iterable[bytes] chunks: bytes objects to compress in order
+    @param dict(int,str)|dict(int,(int,int))|tuple codes: mappings from
+    symbols to codes, or a table from build_encode_table
+    @param list[int]|None offsets: where to record the bit offsets
+    @param int|None interval: symbols between offsets, or None for one
+    offset per chunk
+    @rtype: generator[bytearray]
+
+    >>> d = {0: "0", 1: "10", 2: "11"}
+    >>> offsets = []
+    >>> pieces = iter_compressed([bytes([1, 2]), bytes([1, 0, 2])], d, offsets)
+    >>> [byte_to_bits(byte) for byte in b"".join(pieces)]
+    ['10111001', '10000000']
+    >>> offsets
+    [0, 4]
+    >>> offsets = []
+    >>> _ = list(iter_compressed([bytes([1, 2, 1]), bytes([0, 2])], d,
+    ...                          offsets, 2))
+    >>> offsets
+    [0, 4, 7]
+    """
+    values, lengths = codes if isinstance(codes, tuple) \
+        else build_encode_table(codes)
+    acc = nbits = written = position = 0
+    for text in chunks:
+        if offsets is None:
+            marks = ()
+        elif interval is None:
+            marks = (0,)
+        else:
+            marks = range(-position % interval, len(text), interval)
+        result = bytearray()
+        start = 0
+        # encode up to each mark, then record the offset reached there
+        for end in (*marks, None):
+            for symbol in text[start:end] if marks else text:
+                length = lengths[symbol]
+                acc = (acc << length) | values[symbol]
+                nbits += length
+                if nbits >= 64:
+                    # write out whole bytes, keeping the leftover bits in acc
+                    nbits -= 64
+                    result += (acc >> nbits).to_bytes(8, "big")
+                    acc &= (1 << nbits) - 1
+            if end is not None:
+                offsets.append((written + len(result)) * 8 + nbits)
+                start = end
+        written += len(result)
+        position += len(text)
+        yield result
+    # complement the last byte with zeros
+    nbytes = (nbits + 7) // 8
+    yield bytearray((acc << (nbytes * 8 - nbits)).to_bytes(nbytes, "big"))
+
+
+def build_encode_table(codes):
+    """ Return lists of the code value and code length of each symbol,
+    indexed by symbol, for iter_compressed.
+
+    @param dict(int,str)|dict(int,(int,int)) codes: mappings from symbols
+    to codes
+    @rtype: (list[int], list[int])
+
+    >>> values, lengths = build_encode_table({0: "0", 1: "10", 2: "11"})
+    >>> values[:3], lengths[:3]
+    ([0, 2, 3], [1, 2, 2])
+    """
+    num_symbols = max([256] + [symbol + 1 for symbol in codes])
+    values, lengths = [0] * num_symbols, [0] * num_symbols
+    for symbol, code in codes.items():
+        if isinstance(code, str):
+            code = (int(code, 2) if code else 0, len(code))
+        values[symbol], lengths[symbol] = code
+    return values, lengths
 
 
 def tree_to_bytes(tree):
@@ -252,19 +783,19 @@ def tree_to_bytes(tree):
     >>> list(tree_to_bytes(tree))
     [0, 3, 0, 2, 1, 0, 0, 5]
     """
-    lst_bytes = []
-    if not (tree.left is None and tree.right is None):
-        lst_bytes.extend(tree_to_bytes(tree.left))
-        lst_bytes.extend(tree_to_bytes(tree.right))
-        if tree.left.is_leaf():
-            lst_bytes.extend([0, tree.left.symbol])
-        if not tree.left.is_leaf():
-            lst_bytes.extend([1, tree.left.number])
-        if tree.right.is_leaf():
-            lst_bytes.extend([0, tree.right.symbol])
-        if not tree.right.is_leaf():
-            lst_bytes.extend([1, tree.right.number])
-    return bytes(lst_bytes)
+    if tree.is_leaf():
+        return b""
+    # 4 bytes for each of the numbered internal nodes
+    result = bytearray(4 * (tree.number + 1))
+    pos = 0
+    for node in _iter_internal_postorder(tree):
+        for child in (node.left, node.right):
+            if child.is_leaf():
+                result[pos:pos + 2] = bytes([0, child.symbol])
+            else:
+                result[pos:pos + 2] = bytes([1, child.number])
+            pos += 2
+    return bytes(result)
 
 
 def num_nodes_to_bytes(tree):
@@ -291,25 +822,340 @@ def size_to_bytes(size):
     return size.to_bytes(4, "little")
 
 
-def compress(in_file, out_file):
-    """ Compress contents of in_file and store results in out_file.
+def lengths_to_bytes(lengths):
+    """ Return a bytes representation of the code lengths: the number of
+    symbols minus one, then a (symbol, length) pair for each symbol.
+
+    @param dict(int,int) lengths: mappings from symbols to code lengths
+    @rtype: bytes
+
+    >>> list(lengths_to_bytes({7: 2, 3: 1, 2: 2}))
+    [2, 2, 2, 3, 1, 7, 2]
+    """
+    result = bytearray([len(lengths) - 1])
+    for symbol in sorted(lengths):
+        result += bytes([symbol, lengths[symbol]])
+    return bytes(result)
+
+
+def _build_tree(freq, max_code_length, verbose=True):
+    """ Return the Huffman tree compress uses for freq, with codes of at
+    most max_code_length bits if it is not None, and print its bits per
+    symbol if verbose.
+
+    @param dict(int,int) freq: a frequency dictionary
+    @param int|None max_code_length: the longest code allowed, if any
+    @param bool verbose: whether to print the bits per symbol
+    @rtype: HuffmanNode
+    """
+    tree = huffman_tree(freq)
+    if max_code_length is not None:
+        optimal = avg_length(tree, freq)
+        tree = lengths_to_tree(limited_code_lengths(freq, max_code_length))
+        if verbose:
+            print("Length limit penalty:", avg_length(tree, freq) - optimal)
+    if verbose:
+        print("Bits per symbol:", avg_length(tree, freq))
+    return tree
+
+
+def index_to_bytes(offsets, interval):
+    """ Return a bytes representation of a seek index whose entry i is
+    the bit offset in the body of byte i * interval of the input.
+
+    Each offset takes 8 bytes, followed by the interval, the number of
+    entries and INDEX_MAGIC, so the index can be found from the end of a file.
+
+    @param list[int] offsets: bit offsets of every interval bytes
+    @param int interval: number of input bytes between entries
+    @rtype: bytes
+
+    >>> buf = index_to_bytes([0, 300], 10)
+    >>> len(buf), buf[-12:]
+    (28, b'\\n\\x00\\x00\\x00\\x02\\x00\\x00\\x00HIDX')
+    """
+    result = bytearray()
+    for offset in offsets:
+        result += offset.to_bytes(8, "little")
+    return bytes(result + size_to_bytes(interval) +
+                 size_to_bytes(len(offsets)) + INDEX_MAGIC)
+
+
+def coded_size(freq, lengths):
+    """ Return the number of bytes that coding text with frequencies freq
+    using codes of lengths lengths takes, without any header.
+
+    @param dict(int,int) freq: a frequency dictionary
+    @param dict(int,int) lengths: mappings from symbols to code lengths
+    @rtype: int
+
+    >>> coded_size({0: 5, 1: 2, 2: 2}, {0: 1, 1: 2, 2: 2})
+    2
+    """
+    return (sum(count * lengths[symbol] for symbol, count in freq.items())
+            + 7) // 8
+
+
+def entropy_size(freq):
+    """ Return the fewest bytes that any code for single symbols can take
+    for a text with frequencies freq, without any header, which is its
+    entropy.
+
+    @param dict(int,int) freq: a frequency dictionary
+    @rtype: int
+
+    >>> entropy_size({0: 8, 1: 8})
+    2
+    >>> entropy_size({0: 5})
+    0
+    """
+    total = sum(freq.values())
+    return math.ceil(sum(count * math.log2(total / count)
+                         for count in freq.values()) / 8)
+
+
+def store_pays(freq, size):
+    """ Return whether a text of size bytes, whose symbols to code have
+    frequencies freq, is better stored, because even codes as short as
+    its entropy, behind the smallest header, would not save STORE_SAVING
+    of size.
+
+    Only the counts are needed, so this is decided before building a tree.
+
+    @param dict(int,int) freq: frequencies of the symbols to code
+    @param int size: bytes in the text
+    @rtype: bool
+
+    >>> store_pays({symbol: 1 for symbol in range(256)}, 256)
+    True
+    >>> store_pays({0: 900, 1: 100}, 1000)
+    False
+    """
+    # magic, format, code lengths and size, as for canonical codes
+    header_size = 3 + 2 * len(freq) + 4
+    return header_size + entropy_size(freq) > \
+        (1 - STORE_SAVING) * size + STORED_HEADER_SIZE
+
+
+def _flag_header(header, flags):
+    """ Return header with flags set in its format byte, preceded by
+    HEADER_MAGIC and FORMAT_TREE if it is an old-style tree header.
+
+    @param bytes header: the header of a compressed file
+    @param int flags: INDEXED, CHECKSUMMED, both or neither
+    @rtype: bytes
+
+    >>> list(_flag_header(bytes([3, 1, 2]), INDEXED))
+    [0, 128, 3, 1, 2]
+    >>> _flag_header(bytes([HEADER_MAGIC, FORMAT_STORED]), CHECKSUMMED)
+    b'\\x00F'
+    """
+    if not flags:
+        return header
+    if header[0] != HEADER_MAGIC:
+        header = bytes([HEADER_MAGIC, FORMAT_TREE]) + header
+    return header[:1] + bytes([header[1] | flags]) + header[2:]
+
+
+def _compress_empty(out_file, checksum):
+    """ Write a FORMAT_STORED file of no bytes to out_file, with its
+    CRC-32 if checksum.
 
-    @param str in_file: input file whose contents we want to compress
     @param str out_file: output file, where we store our compressed result
+    @param bool checksum: whether to write the CRC-32 of no bytes
     @rtype: NoneType
     """
-    with open(in_file, "rb") as f1:
-        text = f1.read()
+    with open(out_file, "wb") as f:
+        f.write(_flag_header(bytes([HEADER_MAGIC, FORMAT_STORED]),
+                             CHECKSUMMED if checksum else 0) +
+                size_to_bytes(0))
+        if checksum:
+            f.write(checksums_to_bytes(0))
+
+
+def compress(in_file, out_file, chunk_size=CHUNK_SIZE, canonical=False,
+             max_code_length=None, index_interval=None, use_mmap=False,
+             verbose=True, stats=None, store=False, checksum=False,
+             rle=None):
+    """ Compress contents of in_file and store results in out_file, and
+    return the average number of bits per byte of in_file of the codes
+    used, or 8.0 if in_file was stored.
+
+    in_file is read twice, chunk_size bytes at a time: once to count
+    frequencies and once to encode, so memory use does not grow with its size.
+    If canonical, canonical codes are used and only their lengths are stored
+    in the header instead of the tree. If max_code_length is given, no code
+    is longer than that, at the price of a few more bits per symbol.
+    If index_interval is given, a seek index with the bit offset of every
+    index_interval bytes of in_file is written after the body, and INDEXED
+    is set in the header, so that read_range can start decoding close to
+    any byte.
+    If use_mmap, in_file is memory-mapped instead of read, and its chunks
+    are memoryviews of the map rather than copies.
+    If stats is given, the time, bytes and memory blocks of the read,
+    count, tree, header, encode and write stages are added to it, with all
+    the reads or writes of a stage counted as one call and no memory
+    blocks; otherwise nothing is recorded.
+    If store, in_file is copied with a FORMAT_STORED header instead when
+    store_pays finds from the byte counts, before any tree is built, that
+    coding would not save STORE_SAVING of its size, as for data that is
+    already compressed. An empty in_file is always stored.
+    If checksum, the CRC-32 of in_file is computed while encoding and
+    written after the body and any seek index, for uncompress and verify
+    to check, and CHECKSUMMED is set in the header.
+    If rle, in_file is run-length coded as it is read, and the bytes left
+    are given canonical codes in FORMAT_RLE, which cannot have a seek
+    index. If rle is None, run-length coding is used when there is no
+    index_interval and estimate_rle_saving finds that it saves RLE_SAVING
+    of samples of in_file, as for images with long runs of one colour.
+
+    @param str in_file: input file whose contents we want to compress
+    @param str out_file: output file, where we store our compressed result
+    @param int chunk_size: most bytes of in_file held in memory at once
+    @param bool canonical: whether to use canonical codes
+    @param int|None max_code_length: the longest code allowed, if any
+    @param int|None index_interval: bytes of in_file between index entries
+    @param bool use_mmap: whether to memory-map in_file
+    @param bool verbose: whether to print the bits per symbol
+    @param Stats|None stats: where to record each stage, if anywhere
+    @param bool store: whether to store in_file if coding does not pay
+    @param bool checksum: whether to write the CRC-32 of in_file
+    @param bool|None rle: whether to run-length code in_file, or None to
+    decide from samples of it
+    @rtype: float
+    """
+    if rle and index_interval:
+        raise ValueError("run-length coded files cannot have a seek index")
+    if not os.path.getsize(in_file):
+        # nothing to code, and an empty file cannot be memory-mapped
+        _compress_empty(out_file, checksum)
+        return 8.0
+    if stats is None:
+        stats = NullStats()
+    with open(in_file, "rb") as f1, \
+            (map_file(f1) if use_mmap else nullcontext()) as view:
+        with stats.stage("count") as record:
+            in_size = os.fstat(f1.fileno()).st_size
+            if rle is None:
+                rle = not index_interval and \
+                    estimate_rle_saving(f1) >= RLE_SAVING
+            chunks = iter_views(view, chunk_size) if use_mmap \
+                else stats.iterate("read", iter_chunks(f1, chunk_size))
+            freq = make_freq_dict(iter_rle(chunks) if rle else
+                                  view if use_mmap else chunks)
+            # the number of symbols coded, which run-length coding reduces
+            size = sum(freq.values())
+            record.bytes_in += in_size
+        stored = store and store_pays(freq, in_size)
+        if not stored:
+            with stats.stage("tree"):
+                tree = _build_tree(freq, max_code_length, verbose)
+            with stats.stage("header") as record:
+                if rle:
+                    lengths = get_code_lengths(tree)
+                    codes = canonical_codes(lengths)
+                    header = (bytes([HEADER_MAGIC, FORMAT_RLE]) +
+                              lengths_to_bytes(lengths) +
+                              size_to_bytes(in_size))
+                elif canonical or tree.is_leaf():
+                    # a tree header cannot hold a single leaf
+                    lengths = get_code_lengths(tree)
+                    codes = canonical_codes(lengths)
+                    header = (bytes([HEADER_MAGIC, FORMAT_CANONICAL]) +
+                              lengths_to_bytes(lengths))
+                else:
+                    codes = get_codes(tree)
+                    number_nodes(tree)
+                    header = num_nodes_to_bytes(tree) + tree_to_bytes(tree)
+                flags = (INDEXED if index_interval else 0) | \
+                    (CHECKSUMMED if checksum else 0)
+                header = _flag_header(header, flags) + size_to_bytes(size)
+                record.bytes_out += len(header)
+        if use_mmap:
+            chunks = iter_views(view, chunk_size)
+        else:
+            f1.seek(0)
+            chunks = iter_chunks(f1, chunk_size)
+        crc = [0]
+        if checksum:
+            chunks = _iter_checksummed(chunks, crc)
+        if stored:
+            with open(out_file, "wb") as f2:
+                _write(stats, f2, _flag_header(
+                    bytes([HEADER_MAGIC, FORMAT_STORED]),
+                    CHECKSUMMED if checksum else 0) + size_to_bytes(in_size))
+                _copy(stats, chunks, f2)
+                if checksum:
+                    _write(stats, f2, checksums_to_bytes(crc[0]))
+            return 8.0
+        with open(out_file, "wb") as f2:
+            _write(stats, f2, header)
+            offsets = [] if index_interval else None
+            chunks = stats.iterate("read", chunks)
+            with stats.stage("encode") as record, closing(iter_compressed(
+                    iter_rle(chunks) if rle else chunks, codes,
+                    offsets, index_interval)) as pieces:
+                record.bytes_out += stats.write("write", f2, pieces)
+                record.bytes_in += in_size
+            if index_interval:
+                _write(stats, f2, index_to_bytes(offsets, index_interval))
+            if checksum:
+                _write(stats, f2, checksums_to_bytes(crc[0]))
+    if rle:
+        return avg_length(tree, freq) * size / in_size
+    return avg_length(tree, freq)
+
+
+def compress_bytes(text, max_code_length=None, store=True):
+    """ Return text compressed in memory, in the same format compress
+    writes with canonical codes, or stored if coding would not save
+    STORE_SAVING of it (or text is empty) and store.
+
+    @param bytes text: a bytes object
+    @param int|None max_code_length: the longest code allowed, if any
+    @param bool store: whether to store text if coding does not pay
+    @rtype: bytes
+
+    >>> buf = compress_bytes(b"abracadabra" * 10)
+    >>> len(buf), uncompress_bytes(buf) == b"abracadabra" * 10
+    (46, True)
+    >>> compress_bytes(b"ab")
+    b'\\x00\\x06\\x02\\x00\\x00\\x00ab'
+    """
     freq = make_freq_dict(text)
-    tree = huffman_tree(freq)
-    codes = get_codes(tree)
-    number_nodes(tree)
-    print("Bits per symbol:", avg_length(tree, freq))
-    result = (num_nodes_to_bytes(tree) + tree_to_bytes(tree) +
-              size_to_bytes(len(text)))
-    result += generate_compressed(text, codes)
-    with open(out_file, "wb") as f2:
-        f2.write(result)
+    if not freq or store and store_pays(freq, len(text)):
+        return (bytes([HEADER_MAGIC, FORMAT_STORED]) +
+                size_to_bytes(len(text)) + bytes(text))
+    lengths = get_code_lengths(_build_tree(freq, max_code_length, False))
+    header = (bytes([HEADER_MAGIC, FORMAT_CANONICAL]) +
+              lengths_to_bytes(lengths) + size_to_bytes(len(text)))
+    return header + generate_compressed(text, canonical_codes(lengths))
+
+
+def _copy(stats, chunks, f):
+    """ Write each of chunks to f, as part of the read and write stages of
+    stats.
+
+    No chunk is referred to after this returns, so chunks may be views of
+    a memory map about to be closed.
+
+    @param Stats|NullStats stats: where to record the reads and writes
+    @param iterable chunks: bytes-like objects
+    @param file f: a file opened for writing in binary mode
+    @rtype: NoneType
+    """
+    stats.write("write", f, stats.iterate("read", chunks))
+
+
+def _write(stats, f, data):
+    """ Write data to f as part of the write stage of stats.
+
+    @param Stats|NullStats stats: where to record the write
+    @param file f: a file opened for writing in binary mode
+    @param bytes data: what to write
+    @rtype: NoneType
+    """
+    stats.write("write", f, [data])
 
 
 # ====================
@@ -333,17 +1179,33 @@ def generate_tree_general(node_lst, root_index):
 HuffmanNode(12, None, None)), \
 HuffmanNode(None, HuffmanNode(5, None, None), HuffmanNode(7, None, None)))
     """
-    tree = HuffmanNode()
-    root_node = node_lst[root_index]
-    if root_node.l_type == 0:
-        tree.left = HuffmanNode(root_node.l_data)
-    else:
-        tree.left = generate_tree_general(node_lst, root_node.l_data)
-    if root_node.r_type == 0:
-        tree.right = HuffmanNode(root_node.r_data)
-    else:
-        tree.right = generate_tree_general(node_lst, root_node.r_data)
-    return tree
+    # find the nodes below root_index, each after its parent
+    order = []
+    stack = [root_index]
+    while stack:
+        index = stack.pop()
+        order.append(index)
+        if len(order) > len(node_lst):
+            raise ValueError("node list does not describe a tree")
+        read_node = node_lst[index]
+        if read_node.l_type == 1:
+            stack.append(read_node.l_data)
+        if read_node.r_type == 1:
+            stack.append(read_node.r_data)
+    # then build them bottom up
+    trees = {}
+    for index in reversed(order):
+        read_node = node_lst[index]
+        if read_node.l_type == 0:
+            left = HuffmanNode(read_node.l_data)
+        else:
+            left = trees[read_node.l_data]
+        if read_node.r_type == 0:
+            right = HuffmanNode(read_node.r_data)
+        else:
+            right = trees[read_node.r_data]
+        trees[index] = HuffmanNode(None, left, right)
+    return trees[root_index]
 
 
 def generate_tree_postorder(node_lst, root_index):
@@ -401,6 +1263,221 @@ HuffmanNode(None, HuffmanNode(10, None, None), HuffmanNode(12, None, None)))
     return tree
 
 
+def build_decode_table(codes, table_bits=TABLE_BITS):
+    """ Return a lookup table for decoding with the (value, length) codes.
+
+    The table is a tuple (bits, outs, used, long_codes, max_len). Entry i of
+    outs holds every symbol that can be fully decoded from the bits-wide
+    prefix i, and used[i] is how many bits those symbols take. Codes longer
+    than bits have used[i] == 0 and are found bit by bit in long_codes,
+    keyed by the code value with a 1 bit prepended.
+
+    Entries of outs are bytes, or arrays if any symbol is over 255.
+
+    @param dict(int,(int,int)) codes: mappings from symbols to code pairs
+    @param int table_bits: most bits looked up at once
+    @rtype: tuple
+
+    >>> codes = {0: (0, 1), 1: (2, 2), 2: (3, 2)}
+    >>> bits, outs, used, long_codes, max_len = build_decode_table(codes)
+    >>> bits, max_len, long_codes
+    (2, 2, {})
+    >>> outs, used
+    ([b'\\x00\\x00', b'\\x00', b'\\x01', b'\\x02'], [2, 1, 2, 2])
+    >>> build_decode_table(codes, 1)[1:4]
+    ([b'\\x00', b''], [1, 0], {6: 1, 7: 2})
+    """
+    max_len = max([length for _, length in codes.values()] + [0])
+    bits = min(table_bits, max_len)
+    size = 1 << bits
+    mask = size - 1
+    # single symbol entries first, then chain them into multi symbol ones
+    first, used, long_codes = _first_symbols(codes, bits)
+    wide = max([0] + list(codes)) > 255
+    outs = [array("I") if wide else b""] * size
+    chained = [0] * size
+    for i in range(size):
+        total = used[i]
+        if total == 0 and max_len > 0:
+            continue
+        symbols = [first[i]]
+        while total < bits:
+            nxt = (i << total) & mask
+            if used[nxt] == 0 or total + used[nxt] > bits:
+                break
+            symbols.append(first[nxt])
+            total += used[nxt]
+        outs[i] = array("I", symbols) if wide else bytes(symbols)
+        chained[i] = total
+    return bits, outs, chained, long_codes, max_len
+
+
+def _first_symbols(codes, bits):
+    """ Return (first, used, long_codes) for the (value, length) codes,
+    where entry i of first is the symbol whose code starts the bits-wide
+    prefix i and used[i] is its length, or 0 if it is longer than bits, in
+    which case it is in long_codes, keyed by the code value with a 1 bit
+    prepended.
+
+    @param dict(int,(int,int)) codes: mappings from symbols to code pairs
+    @param int bits: bits looked up at once
+    @rtype: (list[int], list[int], dict(int,int))
+
+    >>> _first_symbols({0: (0, 1), 1: (2, 2), 2: (3, 2)}, 1)
+    ([0, 0], [1, 0], {6: 1, 7: 2})
+    """
+    size = 1 << bits
+    first = [0] * size
+    used = [0] * size
+    long_codes = {}
+    for symbol, (value, length) in codes.items():
+        if length > bits:
+            long_codes[value | (1 << length)] = symbol
+        else:
+            start = value << (bits - length)
+            count = 1 << (bits - length)
+            first[start:start + count] = [symbol] * count
+            used[start:start + count] = [length] * count
+    return first, used, long_codes
+
+
+def decode_with_table(table, text, size):
+    """ Use a table from build_decode_table to decompress size bytes
+    from text.
+
+    The result is an array instead if any symbol is over 255.
+
+    @param tuple table: a decoding table built by build_decode_table
+    @param bytes text: text to decompress
+    @param int size: how many bytes to decompress from text.
+    @rtype: bytes|array
+
+    >>> table = build_decode_table({0: (0, 1), 1: (2, 2), 2: (3, 2)})
+    >>> list(decode_with_table(table, bytes([0b10111000]), 4))
+    [1, 2, 1, 0]
+    >>> table = build_decode_table({0: (0, 1), 300: (1, 1)})
+    >>> decode_with_table(table, bytes([0b01000000]), 3)
+    array('I', [0, 300, 0])
+    """
+    pieces = iter_uncompressed(table, [text], size)
+    if isinstance(table[1][0], bytes):
+        return b"".join(pieces)
+    result = array("I")
+    for piece in pieces:
+        result += piece
+    return result
+
+
+def iter_uncompressed(table, chunks, size, skip_bits=0):
+    """ Use a table from build_decode_table to decompress size bytes from
+    the bytes objects in chunks, yielding the result piece by piece.
+
+    The first skip_bits bits of the first chunk are not part of the
+    compressed text.
+
+    @param tuple table: a decoding table built by build_decode_table
+    @param iterable[bytes] chunks: compressed text split in order
+    @param int size: how many bytes to decompress in total
+    @param int skip_bits: number of bits before the compressed text, 0 to 7
+    @rtype: generator[bytes|bytearray]
+
+    >>> table = build_decode_table({0: (0, 1), 1: (2, 2), 2: (3, 2)})
+    >>> pieces = iter_uncompressed(table, [bytes([0b10111001, 0b10000000])], 5)
+    >>> list(b"".join(pieces))
+    [1, 2, 1, 0, 2]
+    """
+    bits, outs, used, long_codes, max_len = table
+    if max_len == 0:
+        # a tree with a single leaf spends no bits on each symbol
+        for start in range(0, size, CHUNK_SIZE):
+            yield outs[0] * min(CHUNK_SIZE, size - start)
+        return
+    acc = nbits = 0
+    tail = b""
+    chunks = iter(chunks)
+    if skip_bits:
+        # keep the wanted bits of the first byte as leftover bits
+        tail = bytes(next(chunks, b""))
+        if tail:
+            acc, nbits, tail = tail[0], 8 - skip_bits, tail[1:]
+    for chunk in chunks:
+        text = tail + chunk if tail else chunk
+        result, acc, nbits, pos = _decode_chunk(table, text, size,
+                                                acc, nbits, False)
+        tail = bytes(text[pos:])
+        size -= len(result)
+        yield result
+    yield _decode_chunk(table, tail, size, acc, nbits, True)[0]
+
+
+def _decode_chunk(table, text, size, acc, nbits, final):
+    """ Decode at most size bytes from text, after the nbits leftover bits
+    in acc. Return the result, the new leftover (acc, nbits) and the
+    position in text where decoding stopped.
+
+    Unless final, decoding stops while every code is still covered by text,
+    and the rest of text should be put in front of the next chunk. A final
+    chunk is padded with zeros, and ValueError is raised as soon as decoding
+    runs past the padding a code could need, so that a size text cannot
+    hold fails without decoding it.
+
+    @param tuple table: a decoding table built by build_decode_table
+    @param bytes text: text to decompress
+    @param int size: most bytes to decompress
+    @param int acc: leftover bits of the previous chunk
+    @param int nbits: number of leftover bits in acc
+    @param bool final: whether text is the end of the compressed text
+    @rtype: (bytearray, int, int, int)
+    """
+    bits, outs, used, long_codes, max_len = table
+    need = max(bits, max_len)
+    result = bytearray() if isinstance(outs[0], bytes) else array("I")
+    pos = 0
+    n = len(text)
+    stop = float("inf") if final else n - need // 8 - 3
+    # past this, a final chunk is being decoded from padding alone
+    padded = n + need // 8 + 1
+    mask = (1 << bits) - 1
+    while len(result) < size and pos < stop:
+        if nbits < bits:
+            if pos + 1 < n:
+                # two bytes at a time always cover a table lookup
+                acc = ((acc & ((1 << nbits) - 1)) << 16 |
+                       text[pos] << 8 | text[pos + 1])
+                pos += 2
+                nbits += 16
+            while nbits < bits:
+                acc = ((acc & ((1 << nbits) - 1)) << 8) | (
+                    text[pos] if pos < n else 0)
+                pos += 1
+                nbits += 8
+            if pos > padded:
+                raise ValueError("compressed data is truncated")
+        index = (acc >> (nbits - bits)) & mask
+        length = used[index]
+        if length:
+            result += outs[index]
+            nbits -= length
+            continue
+        # the code is longer than the table, finish it one bit at a time
+        nbits -= bits
+        code = index | (1 << bits)
+        while code not in long_codes:
+            if code >> (max_len + 1):
+                raise ValueError("invalid code in compressed data")
+            if nbits == 0:
+                acc = text[pos] if pos < n else 0
+                pos += 1
+                nbits = 8
+            nbits -= 1
+            code = (code << 1) | ((acc >> nbits) & 1)
+        result.append(long_codes[code])
+    if final and (pos - n) * 8 > need + 7:
+        raise ValueError("compressed data is truncated")
+    del result[size:]
+    return result, acc, nbits, pos
+
+
 def generate_uncompressed(tree, text, size):
     """ Use Huffman tree to decompress size bytes from text.
 
@@ -408,29 +1485,15 @@ def generate_uncompressed(tree, text, size):
     @param bytes text: text to decompress
     @param int size: how many bytes to decompress from text.
     @rtype: bytes
+
+    >>> tree = HuffmanNode(None, HuffmanNode(0), \
+    HuffmanNode(None, HuffmanNode(1), HuffmanNode(2)))
+    >>> list(generate_uncompressed(tree, bytes([0b10111001, 0b10000000]), 5))
+    [1, 2, 1, 0, 2]
     """
-    # get code from tree and create a dict{code: symbol}
-    codes = get_codes(tree)
-    d = {}
-    for key, value in codes.items():
-        d[value] = key
-    # get string with all bits
-    temp = ""
-    for byte in text:
-        temp += byte_to_bits(byte)
-    # find byte corresponding to bits
-    result = []
-    current = ""
-    index = 0
-    count = 0
-    while count < size:
-        current += temp[index]
-        if current in d:
-            result.append(d[current])
-            current = ""
-            count += 1
-        index += 1
-    return bytes(result)
+    pairs = get_code_pairs(tree)
+    table = decode_cache.get(codes_key(pairs), lambda: pairs)[1]
+    return decode_with_table(table, text, size)
 
 
 def bytes_to_nodes(buf):
@@ -465,54 +1528,2384 @@ def bytes_to_size(buf):
     return int.from_bytes(buf, "little")
 
 
-def uncompress(in_file, out_file):
-    """ Uncompress contents of in_file and store results in out_file.
+def bytes_to_lengths(buf):
+    """ Return the code lengths corresponding to the (symbol, length) pairs
+    in buf.
 
-    @param str in_file: input file to uncompress
-    @param str out_file: output file that will hold the uncompressed results
-    @rtype: NoneType
+    @param bytes buf: a bytes object
+    @rtype: dict(int,int)
+
+    >>> bytes_to_lengths(bytes([2, 2, 3, 1, 7, 2]))
+    {2: 2, 3: 1, 7: 2}
     """
-    with open(in_file, "rb") as f:
-        num_nodes = f.read(1)[0]
-        buf = f.read(num_nodes * 4)
-        node_lst = bytes_to_nodes(buf)
-        # use generate_tree_general or generate_tree_postorder here
-        tree = generate_tree_general(node_lst, num_nodes - 1)
-        size = bytes_to_size(f.read(4))
-        with open(out_file, "wb") as g:
-            text = f.read()
-            g.write(generate_uncompressed(tree, text, size))
+    return {buf[i]: buf[i + 1] for i in range(0, len(buf), 2)}
 
 
-# ====================
-# Other functions
+class DecodeTableCache:
+    """ A least recently used cache of codes with their decoding tables,
+    keyed by the serialized header or the codes they were built from.
 
-def improve_tree(tree, freq_dict):
-    """ Improve the tree as much as possible, without changing its shape,
-    by swapping nodes. The improvements are with respect to freq_dict.
+    === Attributes ===
+    @param int maxsize: most tables kept; none are kept if 0
+    @param int hits: number of lookups that found a table
+    @param int misses: number of lookups that built a table
+    """
 
-    @param HuffmanNode tree: Huffman tree rooted at 'tree'
-    @param dict(int,int) freq_dict: frequency dictionary
-    @rtype: NoneType
+    def __init__(self, maxsize=DECODE_CACHE_SIZE):
+        """ Create an empty cache keeping at most maxsize tables.
 
-    >>> left = HuffmanNode(None, HuffmanNode(99), HuffmanNode(100))
-    >>> right = HuffmanNode(None, HuffmanNode(101), \
-    HuffmanNode(None, HuffmanNode(97), HuffmanNode(98)))
-    >>> tree = HuffmanNode(None, left, right)
-    >>> freq = {97: 26, 98: 23, 99: 20, 100: 16, 101: 15}
-    >>> improve_tree(tree, freq)
-    >>> avg_length(tree, freq)
-    2.31
-    """
-    # get list(frequency, symbol) from high frequency to low frequency
-    lst = []
-    for key, value in freq_dict.items():
-        lst.append((value, key))
-    lst.sort(reverse=True)
-    # levelorder visited and change symbol of leaf
-    nodes = [tree]
-    while len(nodes) != 0:
-        next_node = nodes.pop(0)
+        @param DecodeTableCache self: this DecodeTableCache
+        @param int maxsize: most tables kept
+        @rtype: NoneType
+        """
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """ Return the number of tables kept.
+
+        @param DecodeTableCache self: this DecodeTableCache
+        @rtype: int
+        """
+        return len(self._entries)
+
+    def get(self, key, make_codes, build=None):
+        """ Return (codes, table) cached under key, or else call make_codes
+        for the codes, build their table and cache both, dropping the least
+        recently used entry if there are more than maxsize.
+
+        @param DecodeTableCache self: this DecodeTableCache
+        @param object key: hashable key, such as the header bytes
+        @param callable make_codes: returns the codes if key is missing
+        @param callable|None build: builds the table from the codes, or
+        build_decode_table if None
+        @rtype: (dict(int,(int,int)), tuple)
+
+        >>> cache = DecodeTableCache(1)
+        >>> codes = cache.get(b"a", lambda: {0: (0, 1), 1: (1, 1)})[0]
+        >>> cache.get(b"a", lambda: {})[0] == codes
+        True
+        >>> _ = cache.get(b"b", lambda: {0: (0, 1), 1: (1, 1)})
+        >>> len(cache), cache.hits, cache.misses
+        (1, 1, 2)
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        codes = make_codes()
+        entry = (codes, (build or build_decode_table)(codes))
+        if self.maxsize > 0:
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """ Drop all tables and reset the counters.
+
+        @param DecodeTableCache self: this DecodeTableCache
+        @rtype: NoneType
+        """
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+
+# Tables shared by every decoder in this process
+decode_cache = DecodeTableCache()
+
+
+def codes_key(codes):
+    """ Return a decode_cache key for codes.
+
+    @param dict(int,(int,int)) codes: mappings from symbols to code pairs
+    @rtype: tuple
+
+    >>> codes_key({1: (1, 1), 0: (0, 1)})
+    (None, ((0, (0, 1)), (1, (1, 1))))
+    """
+    return None, tuple(sorted(codes.items()))
+
+
+def read_codes(f):
+    """ Read the codes stored in the header of the compressed file f, and
+    return the header format with the codes as a dict mapping symbols to
+    (value, length) pairs.
+
+    Both old-style headers holding the tree and versioned headers holding
+    canonical code lengths are understood. Symbols may be over 255 in
+    FORMAT_SYMBOLS, and FORMAT_ADAPTIVE and FORMAT_STORED have no codes,
+    giving None.
+    FORMAT_DICTIONARY codes come from the registered dictionary named in
+    the header.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: (int, dict(int,(int,int))|None)
+    """
+    return read_decoder(f)[:2]
+
+
+def read_decoder(f):
+    """ Read the header of the compressed file f like read_codes, and
+    return the header format, the codes and their decoding table.
+
+    Tables for tree and code length headers come from decode_cache, so
+    headers seen before are neither parsed nor built again.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: (int, dict(int,(int,int))|None, tuple|None)
+    """
+    num_nodes = f.read(1)[0]
+    header_format = FORMAT_TREE
+    if num_nodes == HEADER_MAGIC:
+        header_format = f.read(1)[0] & ~(INDEXED | CHECKSUMMED)
+        if header_format == FORMAT_TREE:
+            num_nodes = f.read(1)[0]
+    if header_format == FORMAT_TREE:
+        buf = f.read(num_nodes * 4)
+        # use generate_tree_general or generate_tree_postorder here
+        codes, table = decode_cache.get(
+            (FORMAT_TREE, buf), lambda: get_code_pairs(generate_tree_general(
+                bytes_to_nodes(buf), num_nodes - 1)))
+        return FORMAT_TREE, codes, table
+    if header_format in (FORMAT_CANONICAL, FORMAT_BLOCKS, FORMAT_RLE):
+        num_symbols = f.read(1)[0] + 1
+        buf = f.read(num_symbols * 2)
+        codes, table = decode_cache.get(
+            (FORMAT_CANONICAL, buf),
+            lambda: canonical_codes(bytes_to_lengths(buf)))
+        return header_format, codes, table
+    if header_format == FORMAT_SYMBOLS:
+        codes = canonical_codes(read_symbol_lengths(f))
+        return header_format, codes, build_decode_table(codes)
+    if header_format in (FORMAT_ADAPTIVE, FORMAT_STORED):
+        return header_format, None, None
+    if header_format == FORMAT_DICTIONARY:
+        codes, _, table, _ = get_dictionary(read_varint(f))
+        return header_format, codes, table
+    if header_format == FORMAT_CONTEXT:
+        buf, codes = _read_context_codes(f)
+        codes, table = decode_cache.get((FORMAT_CONTEXT, buf), lambda: codes,
+                                        build_context_tables)
+        return header_format, codes, table
+    raise ValueError("unknown header format {}".format(header_format))
+
+
+def uncompress(in_file, out_file, chunk_size=CHUNK_SIZE, workers=None,
+               use_mmap=False, stats=None):
+    """ Uncompress contents of in_file and store results in out_file.
+
+    Files in the block format are decoded by workers processes, or one per
+    CPU if workers is None. Otherwise, if use_mmap, in_file is
+    memory-mapped instead of read, and the result is written into a memory
+    map of out_file preallocated to the uncompressed size.
+    If stats is given, the time, bytes and memory blocks of the header,
+    read, decode and write stages are added to it, with reads and writes
+    counted as in compress; otherwise nothing is recorded. Reads and writes
+    are part of the decode stage in formats other than the tree and
+    canonical ones, or with use_mmap.
+    If in_file ends with checksums, the output is checked against them as
+    it is written, and ValueError is raised if it does not match.
+    The output is written to out_file + PARTIAL_SUFFIX and renamed to
+    out_file once it is complete and checked, so when decoding fails or a
+    checksum does not match, nothing is left behind and out_file is as it
+    was.
+
+    @param str in_file: input file to uncompress
+    @param str out_file: output file that will hold the uncompressed results
+    @param int chunk_size: most bytes of in_file held in memory at once
+    @param int|None workers: number of processes for the block format
+    @param bool use_mmap: whether to memory-map in_file and out_file
+    @param Stats|None stats: where to record each stage, if anywhere
+    @rtype: NoneType
+    """
+    partial = out_file + PARTIAL_SUFFIX
+    try:
+        _uncompress(in_file, partial, chunk_size, workers, use_mmap, stats)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(partial)
+        raise
+    os.replace(partial, out_file)
+
+
+def _uncompress(in_file, out_file, chunk_size, workers, use_mmap, stats):
+    """ Uncompress contents of in_file into out_file as uncompress does,
+    leaving whatever was written in out_file if it fails.
+
+    @param str in_file: input file to uncompress
+    @param str out_file: output file that will hold the uncompressed results
+    @param int chunk_size: most bytes of in_file held in memory at once
+    @param int|None workers: number of processes for the block format
+    @param bool use_mmap: whether to memory-map in_file and out_file
+    @param Stats|None stats: where to record each stage, if anywhere
+    @rtype: NoneType
+    """
+    if stats is None:
+        stats = NullStats()
+    with open(in_file, "rb") as f, stats.stage("decode") as record:
+        record.bytes_in += os.fstat(f.fileno()).st_size
+        with stats.stage("header"):
+            header_format, codes, table = read_decoder(f)
+        if header_format == FORMAT_BLOCKS:
+            _uncompress_blocks(f, codes, out_file, workers)
+            return
+        if header_format == FORMAT_SYMBOLS:
+            with open(out_file, "wb") as g:
+                for piece in _iter_symbols_text(f, table, chunk_size):
+                    g.write(piece)
+            return
+        if header_format == FORMAT_ADAPTIVE:
+            with open(out_file, "wb") as g:
+                for block in iter_adaptive_blocks(f):
+                    g.write(block)
+            return
+        if header_format == FORMAT_DICTIONARY:
+            f.seek(0)
+            with open(out_file, "wb") as g:
+                g.write(uncompress_message(f.read()))
+            return
+        size, coded = _read_sizes(f, header_format)
+        record.bytes_out += size
+        body_start = f.tell()
+        checksums = read_checksums(f)
+        f.seek(body_start)
+        crc = [0]
+        if header_format == FORMAT_STORED:
+            with open(out_file, "wb") as g:
+                _copy(stats, _iter_checksummed(
+                    iter_chunks(f, chunk_size, size), crc), g)
+        elif use_mmap:
+            with map_file(f) as view, closing(_iter_checksummed(
+                    _iter_body(header_format, table, iter_views(
+                        view[body_start:], chunk_size), coded),
+                    crc)) as pieces:
+                write_mapped(out_file, pieces, size)
+        else:
+            with open(out_file, "wb") as g:
+                stats.write("write", g, _iter_checksummed(_iter_body(
+                    header_format, table, stats.iterate(
+                        "read", iter_chunks(f, chunk_size)), coded), crc))
+        if checksums is not None and crc[0] != checksums[0]:
+            raise ValueError("checksum mismatch in " + in_file)
+
+
+def _read_sizes(f, header_format):
+    """ Read the sizes after the codes in the header of the compressed file
+    f in header_format, and return the size of its contents and the number
+    of symbols coded in its body, which is less for FORMAT_RLE.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @param int header_format: the format of f
+    @rtype: (int, int)
+    """
+    size = bytes_to_size(f.read(4))
+    if header_format == FORMAT_RLE:
+        return size, bytes_to_size(f.read(4))
+    return size, size
+
+
+def _iter_body(header_format, table, chunks, coded):
+    """ Yield the decoded pieces of the body of a file in the tree,
+    canonical, run-length coded or context format, given in chunks, from
+    which coded symbols are decoded with table.
+
+    @param int header_format: the format of the file
+    @param tuple table: a decoding table built by build_decode_table
+    @param iterable chunks: the body, in bytes-like objects
+    @param int coded: the number of symbols coded in the body
+    @rtype: generator[bytes]
+    """
+    if header_format == FORMAT_CONTEXT:
+        yield from iter_uncompressed_context(table, chunks, coded)
+        return
+    pieces = iter_uncompressed(table, chunks, coded)
+    if header_format == FORMAT_RLE:
+        pieces = iter_unrle(pieces)
+    yield from pieces
+
+
+def uncompress_bytes(buf):
+    """ Return the uncompressed contents of buf, compressed in memory by
+    compress_bytes or read from a file in any format but the block format.
+
+    @param bytes buf: a compressed bytes object
+    @rtype: bytes
+
+    >>> uncompress_bytes(compress_bytes(b""))
+    b''
+    """
+    f = io.BytesIO(buf)
+    header_format, codes, table = read_decoder(f)
+    if header_format == FORMAT_ADAPTIVE:
+        return b"".join(iter_adaptive_blocks(f))
+    if header_format == FORMAT_DICTIONARY:
+        return uncompress_message(buf)
+    if header_format == FORMAT_SYMBOLS:
+        return b"".join(_iter_symbols_text(f, table))
+    if header_format == FORMAT_BLOCKS:
+        raise ValueError("the block format is read from files by uncompress")
+    size, coded = _read_sizes(f, header_format)
+    if header_format == FORMAT_STORED:
+        return buf[STORED_HEADER_SIZE:STORED_HEADER_SIZE + size]
+    if header_format in (FORMAT_RLE, FORMAT_CONTEXT):
+        return b"".join(_iter_body(header_format, table, [buf[f.tell():]],
+                                   coded))
+    return decode_with_table(table, buf[f.tell():], size)
+
+
+def declared_size(buf):
+    """ Return the size of the contents that the compressed bytes buf
+    declares in its header, without reading its codes or body, or None if
+    its format does not declare one up front or the header is cut short.
+
+    @param bytes buf: a compressed bytes object
+    @rtype: int|None
+
+    >>> declared_size(compress_bytes(b"abracadabra" * 10))
+    110
+    >>> declared_size(bytes([HEADER_MAGIC, FORMAT_STORED]) + bytes(2)) is None
+    True
+    """
+    try:
+        header_format = buf[1] & ~(INDEXED | CHECKSUMMED) \
+            if buf[0] == HEADER_MAGIC else None
+        if buf[0] != HEADER_MAGIC:
+            pos = 1 + buf[0] * 4
+        elif header_format == FORMAT_TREE:
+            pos = 3 + buf[2] * 4
+        elif header_format in (FORMAT_CANONICAL, FORMAT_BLOCKS, FORMAT_RLE):
+            pos = 3 + (buf[2] + 1) * 2
+        elif header_format == FORMAT_CONTEXT:
+            pos = 259
+            for _ in range(buf[2] + 1):
+                pos += 1 + (buf[pos] + 1) * 2
+        elif header_format == FORMAT_DICTIONARY:
+            pos = bytes_to_varint(buf, 2)[1] + DICTIONARY_FINGERPRINT_SIZE
+            return bytes_to_varint(buf, pos)[0]
+        elif header_format == FORMAT_STORED:
+            pos = 2
+        else:
+            return None
+    except (IndexError, ValueError):
+        # a header cut short, which decoding reports
+        return None
+    return bytes_to_size(buf[pos:pos + 4]) if pos + 4 <= len(buf) else None
+
+
+def read_index(f):
+    """ Return (interval, offsets) of the seek index at the end of the
+    compressed file f, or None if INDEXED is not set in its header.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: (int, list[int])|None
+    """
+    f.seek(0)
+    head = f.read(2)
+    if len(head) < 2 or head[0] != HEADER_MAGIC or not head[1] & INDEXED:
+        return None
+    end = _checksums_start(f)
+    f.seek(max(end - 12, 0))
+    trailer = f.read(12)
+    if trailer[8:] != INDEX_MAGIC:
+        raise ValueError("seek index is missing")
+    count = bytes_to_size(trailer[4:8])
+    f.seek(end - 12 - 8 * count)
+    buf = f.read(8 * count)
+    return (bytes_to_size(trailer[:4]),
+            [int.from_bytes(buf[i:i + 8], "little")
+             for i in range(0, len(buf), 8)])
+
+
+def _slice_pieces(pieces, start, length):
+    """ Return length bytes from byte start of the text yielded in pieces,
+    taking no more pieces than needed.
+
+    @param generator[bytes] pieces: the text, in order
+    @param int start: first byte wanted
+    @param int length: number of bytes wanted
+    @rtype: bytes
+
+    >>> _slice_pieces((piece for piece in [b"ab", b"cd", b"ef"]), 1, 2)
+    b'bc'
+    """
+    result = bytearray()
+    with closing(pieces):
+        for piece in pieces:
+            result += piece
+            if len(result) >= start + length:
+                break
+    return bytes(result[start:start + length])
+
+
+def read_range(in_file, start, length):
+    """ Return length bytes of the uncompressed contents of in_file from
+    byte start, or fewer if they run past the end.
+
+    Only the part of the body holding the range is decoded when in_file
+    has a seek index or is in the block format; otherwise decoding starts
+    from the beginning, up to the range for FORMAT_ADAPTIVE, or whole for
+    FORMAT_SYMBOLS and FORMAT_DICTIONARY, and up to the range for
+    FORMAT_RLE and FORMAT_CONTEXT. FORMAT_STORED files are just read.
+
+    @param str in_file: compressed file to read from
+    @param int start: first uncompressed byte wanted
+    @param int length: number of uncompressed bytes wanted
+    @rtype: bytes
+    """
+    if start < 0:
+        raise ValueError("start of a range cannot be negative")
+    with open(in_file, "rb") as f:
+        header_format, codes, table = read_decoder(f)
+        if header_format == FORMAT_SYMBOLS:
+            return _slice_pieces(_iter_symbols_text(f, table), start,
+                                 length)
+        if header_format == FORMAT_ADAPTIVE:
+            return _read_range_adaptive(f, start, length)
+        if header_format == FORMAT_DICTIONARY:
+            f.seek(0)
+            return uncompress_message(f.read())[start:start + length]
+        if header_format == FORMAT_STORED:
+            size = bytes_to_size(f.read(4))
+            f.seek(STORED_HEADER_SIZE + min(start, size))
+            return f.read(max(min(length, size - start), 0))
+        if header_format == FORMAT_BLOCKS:
+            return _read_range_blocks(f, table, start, length)
+        if header_format in (FORMAT_RLE, FORMAT_CONTEXT):
+            coded = _read_sizes(f, header_format)[1]
+            return _slice_pieces(_iter_body(header_format, table,
+                                            iter_chunks(f), coded),
+                                 start, length)
+        size = bytes_to_size(f.read(4))
+        body_start = f.tell()
+        end = min(start + length, size)
+        if start >= end:
+            return b""
+        index = read_index(f)
+        if index is None:
+            interval, offsets = size, [0]
+        else:
+            interval, offsets = index
+        first, last = start // interval, (end - 1) // interval + 1
+        f.seek(body_start + offsets[first] // 8)
+        if last < len(offsets):
+            buf = f.read((offsets[last] + 7) // 8 - offsets[first] // 8)
+        else:
+            buf = f.read()
+        pieces = iter_uncompressed(table, [buf], end - first * interval,
+                                   offsets[first] % 8)
+        return b"".join(pieces)[start - first * interval:]
+
+
+# ====================
+# Functions for block-parallel compression
+
+
+def _read_block(block):
+    """ Return the bytes of block, given as (path, start, length).
+
+    @param (str,int,int) block: length bytes from start in the file at path
+    @rtype: bytes
+    """
+    path, start, length = block
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+def _count_block(block):
+    """ Return how many times each of the 256 bytes occurs in block, with
+    the CRC-32 of block.
+
+    @param (str,int,int) block: length bytes from start in the file at path
+    @rtype: (list[int], int)
+    """
+    counts = [0] * 256
+    text = _read_block(block)
+    _count_bytes(text, counts)
+    return counts, zlib.crc32(text)
+
+
+def _compress_block(task):
+    """ Return the compressed form of a block, for task (block, codes), or
+    the block itself if codes is None.
+
+    @param ((str,int,int),dict(int,(int,int))|None) task: a block and its
+    codes
+    @rtype: bytes
+    """
+    block, codes = task
+    if codes is None:
+        return _read_block(block)
+    return generate_compressed(_read_block(block), codes)
+
+
+def _uncompress_block(task):
+    """ Return the size bytes decoded from a compressed block, for task
+    (block, size, codes, crc), or the block itself if codes is None.
+    Raise ValueError if crc is not None and is not the CRC-32 of the result.
+
+    @param ((str,int,int),int,dict(int,(int,int))|None,int|None) task: a
+    compressed block, its original size, its codes and its checksum
+    @rtype: bytes
+    """
+    block, size, codes, crc = task
+    if codes is None:
+        text = _read_block(block)
+    else:
+        table = decode_cache.get(codes_key(codes), lambda: codes)[1]
+        text = decode_with_table(table, _read_block(block), size)
+    if crc is not None and zlib.crc32(text) != crc:
+        raise ValueError("checksum mismatch in the block at byte {} of {}"
+                         .format(block[1], block[0]))
+    return text
+
+
+def _imap(executor, function, items, workers):
+    """ Yield function(item) for each of items in order, running them in
+    executor with at most twice workers of them submitted at once.
+
+    @param Executor executor: where function is run
+    @param callable function: a function of one argument
+    @param iterable items: arguments for function
+    @param int workers: number of workers of executor
+    @rtype: generator
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def compress_blocks(in_file, out_file, block_size=BLOCK_SIZE, workers=None,
+                    max_code_length=None, checksum=False, store=False,
+                    verbose=False):
+    """ Compress contents of in_file into out_file as independently encoded
+    blocks of block_size bytes, using workers processes, or one per CPU if
+    workers is None.
+
+    All blocks share one set of canonical codes. The header records where
+    each block starts in the body and its original size, followed by the
+    blocks themselves. If store, blocks for which the codes would not save
+    STORE_SAVING of their size are stored as they are, with STORED_BLOCK
+    set in their size. If checksum, the CRC-32 of each block, computed while
+    counting it, and of all of in_file are written after the blocks.
+    An empty in_file has no codes, so it is written as an empty
+    FORMAT_STORED file, as compress_bytes does. If verbose, the bits per
+    symbol of the codes are printed, as compress does.
+
+    @param str in_file: input file whose contents we want to compress
+    @param str out_file: output file, where we store our compressed result
+    @param int block_size: number of bytes of in_file in each block
+    @param int|None workers: number of processes
+    @param int|None max_code_length: the longest code allowed, if any
+    @param bool checksum: whether to write CRC-32s of the blocks and in_file
+    @param bool store: whether to store blocks if coding does not pay
+    @param bool verbose: whether to print the bits per symbol
+    @rtype: NoneType
+    """
+    workers = workers or os.cpu_count()
+    size = os.path.getsize(in_file)
+    if not size:
+        _compress_empty(out_file, checksum)
+        return
+    blocks = [(in_file, start, min(block_size, size - start))
+              for start in range(0, size, block_size)]
+    with _process_pool(workers) as executor:
+        counts = [0] * 256
+        stored = []
+        all_counts, crcs = zip(*_imap(executor, _count_block, blocks,
+                                      workers)) if blocks else ((), ())
+        for block_counts in all_counts:
+            for symbol in range(256):
+                counts[symbol] += block_counts[symbol]
+        freq = {symbol: count for symbol, count in enumerate(counts) if count}
+        lengths = get_code_lengths(_build_tree(freq, max_code_length,
+                                               verbose))
+        codes = canonical_codes(lengths)
+        for block, block_counts in zip(blocks, all_counts):
+            stored.append(store and coded_size(dict(enumerate(block_counts)),
+                                     dict.fromkeys(range(256), 0) | lengths)
+                          > (1 - STORE_SAVING) * block[2])
+        with open(out_file, "wb") as f:
+            f.write(_flag_header(bytes([HEADER_MAGIC, FORMAT_BLOCKS]),
+                                 CHECKSUMMED if checksum else 0) +
+                    lengths_to_bytes(lengths) + size_to_bytes(size) +
+                    size_to_bytes(len(blocks)))
+            # leave room for the (offset, size) of each block
+            table_start = f.tell()
+            f.write(bytes(8 * len(blocks)))
+            body_start = f.tell()
+            table = bytearray()
+            bodies = _imap(executor, _compress_block,
+                           [(block, None if is_stored else codes)
+                            for block, is_stored in zip(blocks, stored)],
+                           workers)
+            for block, is_stored, body in zip(blocks, stored, bodies):
+                table += size_to_bytes(f.tell() - body_start)
+                table += size_to_bytes(block[2] |
+                                       (STORED_BLOCK if is_stored else 0))
+                f.write(body)
+            if checksum:
+                whole = 0
+                for block, crc in zip(blocks, crcs):
+                    whole = crc32_combine(whole, crc, block[2])
+                f.write(checksums_to_bytes(whole, crcs))
+            f.seek(table_start)
+            f.write(table)
+
+
+def _read_block_table(f):
+    """ Return (block, size, stored) for each block of the block format
+    file f, whose header has been read up to its codes, where block is
+    (path, start, length) of its compressed bytes, size is its original
+    size and stored is whether it was stored without coding.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: list[((str,int,int),int,bool)]
+    """
+    bytes_to_size(f.read(4))
+    num_blocks = bytes_to_size(f.read(4))
+    table = f.read(8 * num_blocks)
+    body_start = f.tell()
+    offsets = [bytes_to_size(table[i:i + 4]) for i in range(0, len(table), 8)]
+    offsets.append(_checksums_start(f) - body_start)
+    sizes = [bytes_to_size(table[i + 4:i + 8])
+             for i in range(0, len(table), 8)]
+    return [((f.name, body_start + offsets[i], offsets[i + 1] - offsets[i]),
+             sizes[i] & ~STORED_BLOCK, bool(sizes[i] & STORED_BLOCK))
+            for i in range(num_blocks)]
+
+
+def _read_range_blocks(f, table, start, length):
+    """ Return length bytes of the uncompressed contents of the block format
+    file f from byte start, decoding only the blocks holding them.
+
+    @param file f: a compressed file opened for reading in binary mode,
+    whose header has been read up to its codes
+    @param tuple table: a decoding table built by build_decode_table
+    @param int start: first uncompressed byte wanted
+    @param int length: number of uncompressed bytes wanted
+    @rtype: bytes
+    """
+    result = bytearray()
+    block_start = 0
+    for block, size, stored in _read_block_table(f):
+        block_end = block_start + size
+        if block_start < start + length and start < block_end:
+            text = _read_block(block) if stored \
+                else decode_with_table(table, _read_block(block), size)
+            result += text[max(start - block_start, 0):
+                           start + length - block_start]
+        block_start = block_end
+    return bytes(result)
+
+
+def _uncompress_blocks(f, codes, out_file, workers):
+    """ Uncompress the rest of the block format file f, whose header has
+    been read up to its codes, and store the result in out_file.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @param dict(int,(int,int)) codes: the codes of all blocks
+    @param str out_file: output file that will hold the uncompressed results
+    @param int|None workers: number of processes, or one per CPU if None
+    @rtype: NoneType
+    """
+    workers = workers or os.cpu_count()
+    tasks, whole = _block_tasks(f, codes)
+    crc = [0]
+    with _process_pool(workers) as executor, \
+            open(out_file, "wb") as g:
+        for piece in _iter_checksummed(_imap(
+                executor, _uncompress_block, tasks, workers), crc):
+            g.write(piece)
+    if whole is not None and crc[0] != whole:
+        raise ValueError("checksum mismatch in " + f.name)
+
+
+def _block_tasks(f, codes):
+    """ Return the tasks of _uncompress_block for the rest of the block
+    format file f, whose header has been read up to its codes, with the
+    CRC-32 of all of its contents, or None if it has no checksums.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @param dict(int,(int,int)) codes: the codes of all blocks
+    @rtype: (list[tuple], int|None)
+    """
+    start = f.tell()
+    checksums = read_checksums(f)
+    f.seek(start)
+    blocks = _read_block_table(f)
+    if checksums is None:
+        crcs, whole = [None] * len(blocks), None
+    else:
+        whole, crcs = checksums
+        if len(crcs) != len(blocks):
+            raise ValueError("{} has {} blocks but {} checksums".format(
+                f.name, len(blocks), len(crcs)))
+    return [(block, size, None if stored else codes, crc)
+            for (block, size, stored), crc in zip(blocks, crcs)], whole
+
+
+# ====================
+# Functions for checksums
+
+
+def checksums_to_bytes(whole, block_crcs=()):
+    """ Return a bytes representation of the CRC-32 whole of the contents
+    of a compressed file, and of each of its blocks if it has any.
+
+    The CRC-32 of each block takes 4 bytes, followed by the number of
+    blocks, whole and CHECKSUM_MAGIC, so the checksums can be found from
+    the end of a file.
+
+    @param int whole: CRC-32 of all of the uncompressed contents
+    @param iterable[int] block_crcs: CRC-32 of each uncompressed block
+    @rtype: bytes
+
+    >>> checksums_to_bytes(zlib.crc32(b"abc"))
+    b'\\x00\\x00\\x00\\x00\\xc2A$5HCRC'
+    >>> len(checksums_to_bytes(0, [1, 2]))
+    20
+    """
+    result = bytearray()
+    for crc in block_crcs:
+        result += size_to_bytes(crc)
+    return bytes(result + size_to_bytes(len(result) // 4) +
+                 size_to_bytes(whole) + CHECKSUM_MAGIC)
+
+
+def crc32_combine(crc1, crc2, length2):
+    """ Return the CRC-32 of two texts one after the other, from the
+    CRC-32 crc1 of the first, and the CRC-32 crc2 and length length2 of
+    the second, without reading either of them again.
+
+    A CRC-32 is linear in the value it starts from, so starting the second
+    text from crc1 instead of 0 changes it by what it changes the CRC-32 of
+    length2 zero bytes.
+
+    @param int crc1: CRC-32 of the first text
+    @param int crc2: CRC-32 of the second text
+    @param int length2: number of bytes of the second text
+    @rtype: int
+
+    >>> crc = crc32_combine(zlib.crc32(b"abc"), zlib.crc32(b"defg"), 4)
+    >>> crc == zlib.crc32(b"abcdefg")
+    True
+    >>> crc32_combine(0, zlib.crc32(b"abc"), 3) == zlib.crc32(b"abc")
+    True
+    """
+    zeros = bytes(length2)
+    return zlib.crc32(zeros, crc1) ^ zlib.crc32(zeros) ^ crc2
+
+
+def read_checksums(f):
+    """ Return (whole, block_crcs) of the checksums at the end of the
+    compressed file f, or None if CHECKSUMMED is not set in its header.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: (int, list[int])|None
+
+    >>> head = bytes([HEADER_MAGIC, FORMAT_STORED | CHECKSUMMED])
+    >>> read_checksums(io.BytesIO(head + checksums_to_bytes(7, [1, 2])))
+    (7, [1, 2])
+    >>> read_checksums(io.BytesIO(head[:1] + bytes([FORMAT_STORED]) +
+    ...                           checksums_to_bytes(7))) is None
+    True
+    """
+    f.seek(0)
+    head = f.read(2)
+    if len(head) < 2 or head[0] != HEADER_MAGIC or \
+            not head[1] & CHECKSUMMED:
+        return None
+    end = f.seek(0, os.SEEK_END)
+    f.seek(max(end - 12, 0))
+    trailer = f.read(12)
+    if trailer[8:] != CHECKSUM_MAGIC:
+        raise ValueError("checksums are missing")
+    count = bytes_to_size(trailer[:4])
+    if 12 + 4 * count > end:
+        raise ValueError("checksums are missing")
+    f.seek(end - 12 - 4 * count)
+    buf = f.read(4 * count)
+    return (bytes_to_size(trailer[4:8]),
+            [bytes_to_size(buf[i:i + 4]) for i in range(0, len(buf), 4)])
+
+
+def _checksums_start(f):
+    """ Return where the checksums at the end of the compressed file f
+    start, or its size if it has none.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: int
+    """
+    checksums = read_checksums(f)
+    end = f.seek(0, os.SEEK_END)
+    if checksums is None:
+        return end
+    return end - 12 - 4 * len(checksums[1])
+
+
+def _iter_checksummed(chunks, crc):
+    """ Yield each of chunks, keeping crc[0] the CRC-32 of all of them so
+    far, starting from its value.
+
+    @param iterable chunks: bytes-like objects
+    @param list[int] crc: a running CRC-32
+    @rtype: generator
+
+    >>> crc = [0]
+    >>> list(_iter_checksummed([b"a", b"bc"], crc))
+    [b'a', b'bc']
+    >>> crc[0] == zlib.crc32(b"abc")
+    True
+    """
+    for chunk in chunks:
+        crc[0] = zlib.crc32(chunk, crc[0])
+        yield chunk
+
+
+def verify(in_file, chunk_size=CHUNK_SIZE, workers=None,
+           require_checksum=False):
+    """ Decode in_file without writing the result anywhere, check it
+    against the checksums of in_file, if it has any, and return the number
+    of bytes it decodes to.
+
+    Raise ValueError if in_file is damaged: if it does not decode, decodes
+    to a different number of bytes than its header says, or does not match
+    its checksums. Only files written by compress, compress_blocks and
+    compress_context can have checksums; the other formats are checked by
+    decoding them. Blocks are decoded by workers processes, or one per CPU
+    if workers is None.
+
+    @param str in_file: a compressed file
+    @param int chunk_size: most bytes of in_file held in memory at once
+    @param int|None workers: number of processes for the block format
+    @param bool require_checksum: whether a file without checksums is
+    damaged
+    @rtype: int
+    """
+    workers = workers or os.cpu_count()
+    with open(in_file, "rb") as f:
+        checksums = read_checksums(f)
+        if checksums is None and require_checksum:
+            raise ValueError(in_file + " has no checksum")
+        f.seek(0)
+        crc = [0]
+        try:
+            header_format, codes, table = read_decoder(f)
+            if header_format == FORMAT_BLOCKS:
+                tasks, whole = _block_tasks(f, codes)
+                with _process_pool(workers) as executor:
+                    size = sum(len(piece) for piece in _iter_checksummed(
+                        _imap(executor, _uncompress_block, tasks, workers),
+                        crc))
+                return _check(in_file, size, size, crc[0], whole)
+            if header_format == FORMAT_SYMBOLS:
+                return sum(len(piece) for piece in
+                           _iter_symbols_text(f, table, chunk_size))
+            if header_format == FORMAT_ADAPTIVE:
+                return sum(len(block) for block in iter_adaptive_blocks(f))
+            if header_format == FORMAT_DICTIONARY:
+                f.seek(0)
+                return len(uncompress_message(f.read()))
+            size, coded = _read_sizes(f, header_format)
+            if header_format == FORMAT_STORED:
+                pieces = iter_chunks(f, chunk_size, size)
+            else:
+                pieces = _iter_body(header_format, table,
+                                    iter_chunks(f, chunk_size), coded)
+            decoded = sum(len(piece)
+                          for piece in _iter_checksummed(pieces, crc))
+        except (EOFError, IndexError, KeyError) as error:
+            raise ValueError("{} does not decode: {}".format(
+                in_file, error)) from error
+    return _check(in_file, size, decoded, crc[0],
+                  None if checksums is None else checksums[0])
+
+
+def _check(in_file, size, decoded, crc, whole):
+    """ Return size if the contents of in_file decoded to size bytes with
+    CRC-32 whole, or whole is None, given that they decoded to decoded
+    bytes with CRC-32 crc, or raise ValueError otherwise.
+
+    @param str in_file: a compressed file
+    @param int size: bytes in_file should decode to
+    @param int decoded: bytes in_file decoded to
+    @param int crc: CRC-32 of what in_file decoded to
+    @param int|None whole: CRC-32 stored in in_file, if any
+    @rtype: int
+
+    >>> _check("a.huf", 3, 3, 5, None)
+    3
+    >>> _check("a.huf", 3, 2, 5, None)
+    Traceback (most recent call last):
+    ...
+    ValueError: a.huf decodes to 2 bytes instead of 3
+    """
+    if decoded != size:
+        raise ValueError("{} decodes to {} bytes instead of {}".format(
+            in_file, decoded, size))
+    if whole is not None and crc != whole:
+        raise ValueError("checksum mismatch in " + in_file)
+    return size
+
+
+# ====================
+# Functions for run-length coding
+
+
+def _rle_encode(text):
+    """ Return the run-length coding of text, in which every RLE_RUN equal
+    bytes in a row are followed by a count of up to RLE_MAX_COUNT more
+    repeats of them, which are left out.
+
+    @param bytes text: text to code
+    @rtype: bytes
+
+    >>> _rle_encode(b"abbbbbbbcccc")
+    b'abbbb\\x03cccc\\x00'
+    >>> len(_rle_encode(bytes(1000)))
+    20
+    """
+    max_run = RLE_RUN + RLE_MAX_COUNT
+    result = bytearray()
+    last = 0
+    for match in RUN_PATTERN.finditer(text):
+        start, end = match.span()
+        result += text[last:start]
+        byte = match.group(1)
+        groups, rest = divmod(end - start, max_run)
+        result += (byte * RLE_RUN + bytes([RLE_MAX_COUNT])) * groups
+        if rest >= RLE_RUN:
+            result += byte * RLE_RUN + bytes([rest - RLE_RUN])
+        else:
+            result += byte * rest
+        last = end
+    result += text[last:]
+    return bytes(result)
+
+
+def iter_rle(chunks):
+    """ Yield the run-length coding of the bytes in chunks, as _rle_encode
+    codes them all at once.
+
+    The run at the end of each chunk may go on in the next one, so it is
+    held back, except for the groups of RLE_RUN + RLE_MAX_COUNT bytes it
+    fills, which is all a run is coded as.
+
+    @param iterable chunks: bytes-like objects
+    @rtype: generator[bytes]
+
+    >>> b"".join(iter_rle([b"abb", b"bbb", b"bbcccc"]))
+    b'abbbb\\x03cccc\\x00'
+    """
+    max_run = RLE_RUN + RLE_MAX_COUNT
+    carry = b""
+    for chunk in chunks:
+        text = carry + bytes(chunk)
+        if not text:
+            continue
+        run = len(text) - len(text.rstrip(text[-1:]))
+        split = len(text) - run % max_run
+        carry = text[split:]
+        if split:
+            yield _rle_encode(text[:split])
+    if carry:
+        yield _rle_encode(carry)
+
+
+def _rle_decode(text):
+    """ Return (decoded, rest) where decoded is the run-length coded text
+    decoded as far as is certain, and rest is the run at its end, which
+    the bytes after text may still turn into a coded run.
+
+    @param bytes text: run-length coded text
+    @rtype: (bytes, bytes)
+
+    >>> _rle_decode(b"abbbb\\x03cccc")
+    (b'abbbbbbb', b'cccc')
+    """
+    result = bytearray()
+    last = 0
+    for match in RUN_CODE_PATTERN.finditer(text):
+        result += text[last:match.start()]
+        result += match.group(1) * (RLE_RUN + match.group(2)[0])
+        last = match.end()
+    rest = text[last:]
+    split = len(rest.rstrip(rest[-1:]))
+    result += rest[:split]
+    return bytes(result), rest[split:]
+
+
+def iter_unrle(pieces):
+    """ Yield the bytes whose run-length coding is the bytes in pieces.
+
+    @param iterable pieces: bytes-like objects
+    @rtype: generator[bytes]
+
+    >>> b"".join(iter_unrle([b"abbb", b"b\\x03ccc", b"c\\x00"]))
+    b'abbbbbbbcccc'
+    >>> list(iter_unrle([b"aaaa"]))
+    Traceback (most recent call last):
+    ...
+    ValueError: run-length coded data is truncated
+    """
+    carry = b""
+    for piece in pieces:
+        decoded, carry = _rle_decode(carry + bytes(piece))
+        if decoded:
+            yield decoded
+    if len(carry) >= RLE_RUN:
+        raise ValueError("run-length coded data is truncated")
+    if carry:
+        yield carry
+
+
+def estimate_rle_saving(f, samples=RLE_SAMPLES, sample_size=RLE_SAMPLE_SIZE):
+    """ Return the fraction of its size that run-length coding saves on
+    samples pieces of sample_size bytes spread evenly through the file f,
+    or on all of f if it is no bigger than they are.
+
+    @param file f: a file opened for reading in binary mode
+    @param int samples: number of pieces
+    @param int sample_size: bytes in each piece
+    @rtype: float
+
+    >>> round(estimate_rle_saving(io.BytesIO(bytes(10000) + b"abc" * 999)),
+    ...       2)
+    0.75
+    >>> estimate_rle_saving(io.BytesIO(b"abc" * 1000))
+    0.0
+    """
+    size = f.seek(0, os.SEEK_END)
+    starts = [0] if size <= samples * sample_size else \
+        [size * i // samples for i in range(samples)]
+    total = saved = 0
+    for start in starts:
+        f.seek(start)
+        sample = f.read(sample_size if len(starts) > 1 else size)
+        total += len(sample)
+        saved += len(sample) - len(_rle_encode(sample))
+    f.seek(0)
+    return saved / total if total else 0.0
+
+
+# ====================
+# Functions for order-1 context modelling
+
+
+def iter_context_pairs(chunks, prev=0):
+    """ Yield each of chunks as an array of the pair prev << 8 | byte for
+    each byte in it, where prev is the byte before it, or prev for the first
+    byte of the first chunk.
+
+    Coding these pairs with the codes of context_codes codes each byte
+    with the codes of the byte before it.
+
+    @param iterable chunks: bytes-like objects
+    @param int prev: the byte taken to come before chunks
+    @rtype: generator[array]
+
+    >>> [list(pairs) for pairs in iter_context_pairs([b"ab", b"c"])]
+    [[97, 24930], [25187]]
+    """
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        buf = bytearray(2 * len(chunk))
+        buf[0::2] = chunk
+        buf[1::2] = bytes([prev]) + bytes(chunk[:-1])
+        prev = chunk[-1]
+        pairs = array("H", buf)
+        if sys.byteorder == "big":
+            pairs.byteswap()
+        yield pairs
+
+
+def _context_lengths(freq, max_code_length):
+    """ Return code lengths for the bytes with frequencies freq, giving a
+    single byte a 1-bit code.
+
+    @param dict(int,int) freq: a frequency dictionary
+    @param int|None max_code_length: the longest code allowed, if any
+    @rtype: dict(int,int)
+    """
+    if len(freq) == 1:
+        return {symbol: 1 for symbol in freq}
+    if max_code_length is not None:
+        return limited_code_lengths(freq, max_code_length)
+    return get_code_lengths(huffman_array_tree(freq))
+
+
+def context_code_lengths(freq, max_code_length=None):
+    """ Return (context_map, clusters) for the pairs counted in freq by
+    make_freq_dict(iter_context_pairs(...)), where clusters is a list of
+    code lengths and the bytes after byte b are coded with the lengths
+    clusters[context_map[b]].
+
+    A byte gets lengths of its own if they save more than their size in
+    the header over the lengths for all bytes. The rest share the lengths
+    for the bytes that follow them.
+
+    @param dict(int,int) freq: frequencies of pairs prev << 8 | byte
+    @param int|None max_code_length: the longest code allowed, if any
+    @rtype: (list[int], list[dict(int,int)])
+
+    >>> pairs = iter_context_pairs([b"ab" * 100 + b"bbc"])
+    >>> context_map, clusters = context_code_lengths(make_freq_dict(pairs))
+    >>> context_map[ord("a")], context_map[ord("b")], len(clusters)
+    (0, 1, 2)
+    >>> clusters[0]
+    {97: 1, 98: 1}
+    """
+    contexts = {}
+    for pair, count in freq.items():
+        contexts.setdefault(pair >> 8, {})[pair & 255] = count
+    total = Counter()
+    for counts in contexts.values():
+        total.update(counts)
+    shared = _context_lengths(total, max_code_length) if total else {}
+    own = {}
+    for prev, counts in contexts.items():
+        lengths = _context_lengths(counts, max_code_length)
+        if coded_size(counts, shared) - coded_size(counts, lengths) > \
+                1 + 2 * len(lengths):
+            own[prev] = lengths
+    merged = Counter()
+    for prev, counts in contexts.items():
+        if prev not in own:
+            merged.update(counts)
+    clusters = []
+    if merged or not own:
+        clusters.append(_context_lengths(merged or {0: 1}, max_code_length))
+    context_map = [0] * 256
+    for prev, lengths in own.items():
+        context_map[prev] = len(clusters)
+        clusters.append(lengths)
+    return context_map, clusters
+
+
+def context_codes(context_map, cluster_codes):
+    """ Return codes for the pairs of iter_context_pairs that code each
+    byte with cluster_codes[context_map[b]], where b is the byte before it.
+
+    @param list[int] context_map: the cluster of the bytes after each byte
+    @param list[dict(int,(int,int))] cluster_codes: codes of each cluster
+    @rtype: dict(int,(int,int))
+
+    >>> codes = context_codes([0, 1] + [0] * 254,
+    ...                       [{0: (0, 1), 1: (1, 1)}, {0: (1, 1), 1: (0, 1)}])
+    >>> codes[0 << 8 | 1], codes[1 << 8 | 1]
+    ((1, 1), (0, 1))
+    """
+    return {prev << 8 | symbol: code
+            for prev in range(256)
+            for symbol, code in cluster_codes[context_map[prev]].items()}
+
+
+def context_header(context_map, clusters):
+    """ Return the header of a FORMAT_CONTEXT file up to its size: the
+    number of clusters minus one, context_map and the code lengths of each
+    cluster.
+
+    @param list[int] context_map: the cluster of the bytes after each byte
+    @param list[dict(int,int)] clusters: code lengths of each cluster
+    @rtype: bytes
+    """
+    return (bytes([HEADER_MAGIC, FORMAT_CONTEXT, len(clusters) - 1]) +
+            bytes(context_map) +
+            b"".join(lengths_to_bytes(lengths) for lengths in clusters))
+
+
+def _read_context_codes(f):
+    """ Read the header of the FORMAT_CONTEXT file f after its format byte
+    and up to its size, and return it with (context_map, cluster_codes).
+
+    @param file f: a compressed file opened for reading in binary mode
+    @rtype: (bytes, (list[int], list[dict(int,(int,int))]))
+    """
+    buf = f.read(257)
+    clusters = []
+    for _ in range(buf[0] + 1):
+        num_symbols = f.read(1)
+        lengths = f.read((num_symbols[0] + 1) * 2)
+        buf += num_symbols + lengths
+        clusters.append(canonical_codes(bytes_to_lengths(lengths)))
+    return buf, (list(buf[1:257]), clusters)
+
+
+def build_context_tables(codes, table_bits=CONTEXT_TABLE_BITS):
+    """ Return decoding tables for codes (context_map, cluster_codes), as
+    (bits, max_len, tables) where tables[b] is (outs, used, long_codes,
+    max_len) of the cluster of the bytes after byte b.
+
+    Like build_decode_table, entries of outs hold every byte that can be
+    fully decoded from a bits-wide prefix, but the codes of each byte after
+    the first are those of the byte before it.
+
+    @param (list[int],list[dict(int,(int,int))]) codes: context_map and
+    the codes of each cluster
+    @param int table_bits: most bits looked up at once
+    @rtype: (int, int, list[tuple])
+
+    >>> codes = ([0, 1] + [0] * 254,
+    ...          [{0: (0, 1), 1: (1, 1)}, {0: (1, 1), 1: (0, 1)}])
+    >>> bits, max_len, tables = build_context_tables(codes)
+    >>> bits, tables[0][0], tables[1][0]
+    (1, [b'\\x00', b'\\x01'], [b'\\x01', b'\\x00'])
+    """
+    context_map, cluster_codes = codes
+    max_lens = [max(length for _, length in cluster.values())
+                for cluster in cluster_codes]
+    bits = min(table_bits, max(max_lens))
+    size = 1 << bits
+    mask = size - 1
+    singles = [_first_symbols(cluster, bits) for cluster in cluster_codes]
+    cluster_tables = []
+    for (first, used, long_codes), max_len in zip(singles, max_lens):
+        outs = [b""] * size
+        chained = [0] * size
+        for i in range(size):
+            total = used[i]
+            if total == 0:
+                continue
+            symbols = [first[i]]
+            while total < bits:
+                next_first, next_used, _ = singles[context_map[symbols[-1]]]
+                nxt = (i << total) & mask
+                if next_used[nxt] == 0 or total + next_used[nxt] > bits:
+                    break
+                symbols.append(next_first[nxt])
+                total += next_used[nxt]
+            outs[i] = bytes(symbols)
+            chained[i] = total
+        cluster_tables.append((outs, chained, long_codes, max_len))
+    return bits, max(max_lens), [cluster_tables[cluster]
+                                 for cluster in context_map]
+
+
+def iter_uncompressed_context(table, chunks, size):
+    """ Use a table from build_context_tables to decompress size bytes from
+    the bytes objects in chunks, yielding the result piece by piece.
+
+    @param tuple table: decoding tables built by build_context_tables
+    @param iterable[bytes] chunks: compressed text split in order
+    @param int size: how many bytes to decompress in total
+    @rtype: generator[bytearray]
+
+    >>> codes = ([0, 1] + [0] * 254,
+    ...          [{0: (0, 1), 1: (1, 1)}, {0: (1, 1), 1: (0, 1)}])
+    >>> table = build_context_tables(codes)
+    >>> list(b"".join(iter_uncompressed_context(table, [b"\\x80"], 4)))
+    [1, 1, 1, 1]
+    """
+    acc = nbits = prev = 0
+    tail = b""
+    for chunk in chunks:
+        text = tail + chunk if tail else chunk
+        result, acc, nbits, pos, prev = _decode_context_chunk(
+            table, text, size, acc, nbits, prev, False)
+        tail = bytes(text[pos:])
+        size -= len(result)
+        yield result
+    yield _decode_context_chunk(table, tail, size, acc, nbits, prev,
+                                True)[0]
+
+
+def _decode_context_chunk(table, text, size, acc, nbits, prev, final):
+    """ Decode at most size bytes from text like _decode_chunk, with the
+    tables of build_context_tables, after the byte prev. Return the result,
+    the new leftover (acc, nbits), the position in text where decoding
+    stopped and the last byte decoded.
+
+    @param tuple table: decoding tables built by build_context_tables
+    @param bytes text: text to decompress
+    @param int size: most bytes to decompress
+    @param int acc: leftover bits of the previous chunk
+    @param int nbits: number of leftover bits in acc
+    @param int prev: the byte decoded before text
+    @param bool final: whether text is the end of the compressed text
+    @rtype: (bytearray, int, int, int, int)
+    """
+    bits, max_len, tables = table
+    need = max(bits, max_len)
+    result = bytearray()
+    pos = 0
+    n = len(text)
+    stop = float("inf") if final else n - need // 8 - 3
+    # past this, a final chunk is being decoded from padding alone
+    padded = n + need // 8 + 1
+    mask = (1 << bits) - 1
+    while len(result) < size and pos < stop:
+        if nbits < bits:
+            if pos + 1 < n:
+                # two bytes at a time always cover a table lookup
+                acc = ((acc & ((1 << nbits) - 1)) << 16 |
+                       text[pos] << 8 | text[pos + 1])
+                pos += 2
+                nbits += 16
+            while nbits < bits:
+                acc = ((acc & ((1 << nbits) - 1)) << 8) | (
+                    text[pos] if pos < n else 0)
+                pos += 1
+                nbits += 8
+            if pos > padded:
+                raise ValueError("compressed data is truncated")
+        outs, used, long_codes, code_max = tables[prev]
+        index = (acc >> (nbits - bits)) & mask
+        length = used[index]
+        if length:
+            out = outs[index]
+            result += out
+            prev = out[-1]
+            nbits -= length
+            continue
+        # the code is longer than the table, finish it one bit at a time
+        nbits -= bits
+        code = index | (1 << bits)
+        while code not in long_codes:
+            if code >> (code_max + 1):
+                raise ValueError("invalid code in compressed data")
+            if nbits == 0:
+                acc = text[pos] if pos < n else 0
+                pos += 1
+                nbits = 8
+            nbits -= 1
+            code = (code << 1) | ((acc >> nbits) & 1)
+        prev = long_codes[code]
+        result.append(prev)
+    if final and (pos - n) * 8 > need + 7:
+        raise ValueError("compressed data is truncated")
+    del result[size:]
+    return result, acc, nbits, pos, prev
+
+
+def compress_context(in_file, out_file, chunk_size=CHUNK_SIZE,
+                     max_code_length=None, checksum=False):
+    """ Compress contents of in_file into out_file with order-1 codes, and
+    return the average number of bits per byte of in_file they use.
+
+    Each byte is coded with codes chosen by the byte before it, from the
+    clusters of context_code_lengths, which suits text, where what follows
+    a letter depends a lot on the letter. Like compress, in_file is read
+    twice, chunk_size bytes at a time; max_code_length limits the codes of
+    each cluster and checksum adds the CRC-32 of in_file.
+
+    @param str in_file: input file whose contents we want to compress
+    @param str out_file: output file, where we store our compressed result
+    @param int chunk_size: most bytes of in_file held in memory at once
+    @param int|None max_code_length: the longest code allowed, if any
+    @param bool checksum: whether to write the CRC-32 of in_file
+    @rtype: float
+    """
+    with open(in_file, "rb") as f:
+        freq = make_freq_dict(iter_context_pairs(iter_chunks(f, chunk_size)))
+        context_map, clusters = context_code_lengths(freq, max_code_length)
+        codes = context_codes(context_map, [canonical_codes(lengths)
+                                            for lengths in clusters])
+        size = sum(freq.values())
+        f.seek(0)
+        crc = [0]
+        chunks = iter_chunks(f, chunk_size)
+        if checksum:
+            chunks = _iter_checksummed(chunks, crc)
+        with open(out_file, "wb") as g:
+            g.write(_flag_header(context_header(context_map, clusters),
+                                 CHECKSUMMED if checksum else 0) +
+                    size_to_bytes(size))
+            for piece in iter_compressed(iter_context_pairs(chunks), codes):
+                g.write(piece)
+            if checksum:
+                g.write(checksums_to_bytes(crc[0]))
+    return sum(count * codes[pair][1]
+               for pair, count in freq.items()) / max(size, 1)
+
+
+# ====================
+# Functions for wide symbols
+
+
+def varint_to_bytes(n):
+    """ Return non-negative int n as a varint: 7 bits per byte, least
+    significant first, with the top bit set on all bytes but the last.
+
+    @param int n: a non-negative int
+    @rtype: bytes
+
+    >>> list(varint_to_bytes(5)), list(varint_to_bytes(300))
+    ([5], [172, 2])
+    """
+    result = bytearray()
+    while n >= 0x80:
+        result.append((n & 0x7F) | 0x80)
+        n >>= 7
+    result.append(n)
+    return bytes(result)
+
+
+def bytes_to_varint(buf, pos=0):
+    """ Return the varint in buf starting at pos, and the position after it.
+
+    @param bytes buf: a bytes object
+    @param int pos: where the varint starts
+    @rtype: (int, int)
+
+    >>> bytes_to_varint(bytes([9, 172, 2]), 1)
+    (300, 3)
+    """
+    value = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("header is truncated")
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_varint(f):
+    """ Read a varint written by varint_to_bytes from the binary file f.
+
+    @param file f: a file opened for reading in binary mode
+    @rtype: int
+
+    >>> import io
+    >>> read_varint(io.BytesIO(bytes([172, 2])))
+    300
+    """
+    value = shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise ValueError("header is truncated")
+        value |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+
+
+def symbol_lengths_to_bytes(lengths):
+    """ Return a bytes representation of code lengths for symbols of any
+    size: the number of symbols, then for each symbol in increasing order
+    its distance from the previous symbol and its length, all as varints.
+
+    @param dict(int,int) lengths: mappings from symbols to code lengths
+    @rtype: bytes
+
+    >>> list(symbol_lengths_to_bytes({3: 1, 300: 2, 2: 2}))
+    [3, 2, 2, 1, 1, 169, 2, 2]
+    """
+    result = bytearray(varint_to_bytes(len(lengths)))
+    previous = 0
+    for symbol in sorted(lengths):
+        result += varint_to_bytes(symbol - previous)
+        result += varint_to_bytes(lengths[symbol])
+        previous = symbol
+    return bytes(result)
+
+
+def read_symbol_lengths(f):
+    """ Read code lengths written by symbol_lengths_to_bytes from the
+    binary file f.
+
+    @param file f: a file opened for reading in binary mode
+    @rtype: dict(int,int)
+
+    >>> import io
+    >>> buf = symbol_lengths_to_bytes({3: 1, 300: 2, 2: 2})
+    >>> read_symbol_lengths(io.BytesIO(buf))
+    {2: 2, 3: 1, 300: 2}
+    """
+    lengths = {}
+    symbol = 0
+    for _ in range(read_varint(f)):
+        symbol += read_varint(f)
+        lengths[symbol] = read_varint(f)
+    return lengths
+
+
+def text_to_symbols(text, symbol_mode):
+    """ Return text split into symbols according to symbol_mode, with the
+    list of distinct words for SYMBOLS_WORD, or None otherwise.
+
+    Symbols are bytes for SYMBOLS_BYTE, 16-bit little-endian words padded
+    with a zero byte for SYMBOLS_16BIT, and positions in the word list for
+    SYMBOLS_WORD.
+
+    @param bytes text: a bytes object
+    @param int symbol_mode: SYMBOLS_BYTE, SYMBOLS_16BIT or SYMBOLS_WORD
+    @rtype: (bytes|array, list[bytes]|None)
+
+    >>> text_to_symbols(b"to be, or not to be", SYMBOLS_WORD)
+    (array('I', [0, 1, 2, 3, 4, 1, 5, 1, 0, 1, 2]), \
+[b'to', b' ', b'be', b', ', b'or', b'not'])
+    >>> text_to_symbols(bytes([1, 2, 3]), SYMBOLS_16BIT)
+    (array('H', [513, 3]), None)
+    """
+    if symbol_mode == SYMBOLS_BYTE:
+        return bytes(text), None
+    if symbol_mode == SYMBOLS_16BIT:
+        symbols = array("H", bytes(text) + bytes(len(text) % 2))
+        if sys.byteorder == "big":
+            symbols.byteswap()
+        return symbols, None
+    if symbol_mode == SYMBOLS_WORD:
+        numbers = {}
+        symbols = array("I", [numbers.setdefault(word, len(numbers))
+                              for word in WORD_PATTERN.findall(text)])
+        return symbols, list(numbers)
+    raise ValueError("unknown symbol mode {}".format(symbol_mode))
+
+
+def iter_text_symbols(chunks, symbol_mode, numbers):
+    """ Yield the symbols that text_to_symbols splits the text in chunks
+    into with symbol_mode, chunk by chunk, with numbers mapping each word
+    seen to its symbol for SYMBOLS_WORD.
+
+    Only the odd byte of a chunk for SYMBOLS_16BIT, or the last word of a
+    chunk for SYMBOLS_WORD, is carried over to the next chunk, as the rest
+    of it may be there. New words are added to numbers as they are seen,
+    so list(numbers) is the word list of text_to_symbols.
+
+    @param iterable[bytes] chunks: the text, in bytes objects
+    @param int symbol_mode: SYMBOLS_BYTE, SYMBOLS_16BIT or SYMBOLS_WORD
+    @param dict(bytes,int) numbers: symbols of the words seen so far
+    @rtype: generator[bytes|array]
+
+    >>> numbers = {}
+    >>> chunks = [b"to b", b"e, or", b" to"]
+    >>> [list(s) for s in iter_text_symbols(chunks, SYMBOLS_WORD, numbers)]
+    [[0, 1], [2, 3], [4, 1], [0]]
+    >>> list(numbers)
+    [b'to', b' ', b'be', b', ', b'or']
+    >>> [list(s) for s in iter_text_symbols([bytes([1, 2, 3]), bytes([4])],
+    ...                                     SYMBOLS_16BIT, {})]
+    [[513], [1027]]
+    """
+    if symbol_mode not in (SYMBOLS_BYTE, SYMBOLS_16BIT, SYMBOLS_WORD):
+        raise ValueError("unknown symbol mode {}".format(symbol_mode))
+    carry = b""
+    for chunk in chunks:
+        if symbol_mode == SYMBOLS_BYTE:
+            yield chunk
+            continue
+        text = carry + chunk if carry else chunk
+        if symbol_mode == SYMBOLS_16BIT:
+            end = len(text) - len(text) % 2
+            carry = text[end:]
+            yield text_to_symbols(text[:end], symbol_mode)[0]
+        else:
+            words = WORD_PATTERN.findall(text)
+            carry = words.pop() if words else b""
+            yield array("I", [numbers.setdefault(word, len(numbers))
+                              for word in words])
+    if carry and symbol_mode == SYMBOLS_16BIT:
+        yield text_to_symbols(carry, symbol_mode)[0]
+    elif carry:
+        yield array("I", [numbers.setdefault(carry, len(numbers))])
+
+
+def symbols_to_text(symbols, symbol_mode, words, size):
+    """ Return the size bytes of text that text_to_symbols split into
+    symbols and words.
+
+    @param bytes|array symbols: symbols from text_to_symbols
+    @param int symbol_mode: SYMBOLS_BYTE, SYMBOLS_16BIT or SYMBOLS_WORD
+    @param list[bytes]|None words: word list for SYMBOLS_WORD
+    @param int size: number of bytes in text
+    @rtype: bytes
+
+    >>> symbols_to_text(array("H", [513, 3]), SYMBOLS_16BIT, None, 3)
+    b'\\x01\\x02\\x03'
+    """
+    if symbol_mode == SYMBOLS_BYTE:
+        return bytes(symbols)
+    if symbol_mode == SYMBOLS_16BIT:
+        # iter stops bytes from being read as raw machine words
+        words16 = array("H", iter(symbols))
+        if sys.byteorder == "big":
+            words16.byteswap()
+        return words16.tobytes()[:size]
+    if symbol_mode == SYMBOLS_WORD:
+        return b"".join([words[symbol] for symbol in symbols])
+    raise ValueError("unknown symbol mode {}".format(symbol_mode))
+
+
+def compress_symbols(in_file, out_file, symbol_mode=SYMBOLS_WORD,
+                     max_code_length=None, chunk_size=CHUNK_SIZE,
+                     verbose=False):
+    """ Compress contents of in_file into out_file, coding symbols made by
+    text_to_symbols with symbol_mode rather than single bytes.
+
+    The header holds the canonical code lengths of any number of symbols
+    of any size, the symbol mode, the sizes and the word list as varints.
+    Like compress, in_file is read twice, chunk_size bytes at a time, and
+    split by iter_text_symbols, so only the word list and a word running
+    across chunks are held beyond a chunk. If verbose, the bits per symbol
+    of the codes are printed.
+
+    @param str in_file: input file whose contents we want to compress
+    @param str out_file: output file, where we store our compressed result
+    @param int symbol_mode: SYMBOLS_BYTE, SYMBOLS_16BIT or SYMBOLS_WORD
+    @param int|None max_code_length: the longest code allowed, if any
+    @param int chunk_size: most bytes of in_file read at once
+    @param bool verbose: whether to print the bits per symbol
+    @rtype: NoneType
+    """
+    numbers = {}
+    with open(in_file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        freq = make_freq_dict(iter_text_symbols(iter_chunks(f, chunk_size),
+                                                symbol_mode, numbers))
+        lengths = get_code_lengths(_build_tree(freq, max_code_length,
+                                               verbose)) if freq else {}
+        header = bytearray([HEADER_MAGIC, FORMAT_SYMBOLS])
+        header += symbol_lengths_to_bytes(lengths)
+        header.append(symbol_mode)
+        header += varint_to_bytes(size) + varint_to_bytes(sum(freq.values()))
+        if symbol_mode == SYMBOLS_WORD:
+            header += varint_to_bytes(len(numbers))
+            for word in numbers:
+                header += varint_to_bytes(len(word)) + word
+        f.seek(0)
+        with open(out_file, "wb") as g:
+            g.write(header)
+            for piece in iter_compressed(iter_text_symbols(
+                    iter_chunks(f, chunk_size), symbol_mode, numbers),
+                    canonical_codes(lengths)):
+                g.write(piece)
+
+
+def _iter_symbols_text(f, table, chunk_size=CHUNK_SIZE):
+    """ Yield the uncompressed contents of the FORMAT_SYMBOLS file f, whose
+    header has been read up to its codes, piece by piece, reading
+    chunk_size bytes of f at a time.
+
+    @param file f: a compressed file opened for reading in binary mode
+    @param tuple table: the decoding table of the symbols
+    @param int chunk_size: most bytes of f read at once
+    @rtype: generator[bytes]
+    """
+    symbol_mode = f.read(1)[0]
+    size, num_symbols = read_varint(f), read_varint(f)
+    words = None
+    if symbol_mode == SYMBOLS_WORD:
+        words = [f.read(read_varint(f)) for _ in range(read_varint(f))]
+    for symbols in iter_uncompressed(table, iter_chunks(f, chunk_size),
+                                     num_symbols):
+        piece = symbols_to_text(symbols, symbol_mode, words, size)
+        size -= len(piece)
+        yield piece
+
+
+# ====================
+# Functions for adaptive streams
+
+
+class AdaptiveModel:
+    """ Byte counts that the encoder and decoder of a FORMAT_ADAPTIVE
+    stream update in lockstep, with the codes they give.
+
+    Every byte starts with a count of one, so that each has a code before
+    it is first seen.
+
+    === Attributes ===
+    @param list[int] counts: count of each byte value
+    @param dict(int,(int,int)) codes: canonical codes for counts
+    """
+
+    def __init__(self):
+        """ Create a model that has seen nothing.
+
+        @param AdaptiveModel self: this AdaptiveModel
+        @rtype: NoneType
+        """
+        self.counts = [1] * 256
+        self.codes = self._make_codes()
+
+    def _make_codes(self):
+        """ Return canonical codes for the current counts.
+
+        @param AdaptiveModel self: this AdaptiveModel
+        @rtype: dict(int,(int,int))
+        """
+        tree = huffman_array_tree(dict(enumerate(self.counts)))
+        return canonical_codes(get_code_lengths(tree))
+
+    def update(self, block):
+        """ Add the bytes of block to the counts and rebuild the codes,
+        halving the counts first if they grow past ADAPTIVE_COUNT_LIMIT.
+
+        @param AdaptiveModel self: this AdaptiveModel
+        @param bytes block: bytes just coded with this model
+        @rtype: NoneType
+
+        >>> model = AdaptiveModel()
+        >>> model.codes[65][1]
+        8
+        >>> model.update(b"A" * 1000)
+        >>> model.codes[65][1]
+        1
+        """
+        _count_bytes(block, self.counts)
+        if sum(self.counts) > ADAPTIVE_COUNT_LIMIT:
+            self.counts = [(count + 1) // 2 for count in self.counts]
+        self.codes = self._make_codes()
+
+
+def _read_full(read, size):
+    """ Return size bytes from read, calling it again after short reads, or
+    fewer at the end of the stream.
+
+    @param callable read: the read or read1 method of a binary stream
+    @param int size: number of bytes wanted
+    @rtype: bytes
+
+    >>> f = io.BytesIO(b"abcde")
+    >>> _read_full(lambda n: f.read(min(n, 2)), 4), f.read()
+    (b'abcd', b'e')
+    """
+    block = read(size)
+    if len(block) == size or not block:
+        return block
+    block = bytearray(block)
+    while len(block) < size:
+        piece = read(size - len(block))
+        if not piece:
+            break
+        block += piece
+    return bytes(block)
+
+
+def compress_stream(in_stream, out_stream, block_size=ADAPTIVE_BLOCK_SIZE):
+    """ Compress in_stream into out_stream in one pass, for pipes and
+    sockets as well as files.
+
+    Each block of at most block_size bytes is coded with codes built from
+    the bytes before it, so no codes are stored: the stream is a header,
+    then for each block its size, the size of its body and the body as
+    varints and bytes, then a block size of zero. Each block is written as
+    soon as block_size bytes, or the end of in_stream, are read, so short
+    reads from a pipe do not make short blocks, each with its own codes.
+
+    @param file in_stream: a binary stream to read
+    @param file out_stream: a binary stream to write
+    @param int block_size: most bytes coded in each block
+    @rtype: NoneType
+    """
+    read = getattr(in_stream, "read1", in_stream.read)
+    model = AdaptiveModel()
+    out_stream.write(bytes([HEADER_MAGIC, FORMAT_ADAPTIVE]))
+    block = _read_full(read, block_size)
+    while block:
+        body = generate_compressed(block, model.codes)
+        out_stream.write(varint_to_bytes(len(block)) +
+                         varint_to_bytes(len(body)) + body)
+        out_stream.flush()
+        model.update(block)
+        block = _read_full(read, block_size)
+    out_stream.write(varint_to_bytes(0))
+    out_stream.flush()
+
+
+def compress_adaptive(in_file, out_file, block_size=ADAPTIVE_BLOCK_SIZE):
+    """ Compress contents of in_file into out_file with compress_stream.
+
+    @param str in_file: input file whose contents we want to compress
+    @param str out_file: output file, where we store our compressed result
+    @param int block_size: most bytes coded in each block
+    @rtype: NoneType
+    """
+    with open(in_file, "rb") as f, open(out_file, "wb") as g:
+        compress_stream(f, g, block_size)
+
+
+def iter_adaptive_blocks(f):
+    """ Yield the uncompressed blocks of the FORMAT_ADAPTIVE stream f,
+    whose header has been read.
+
+    @param file f: a compressed binary stream
+    @rtype: generator
+    """
+    model = AdaptiveModel()
+    size = read_varint(f)
+    while size:
+        body = f.read(read_varint(f))
+        # models repeat when the counts stop changing the code lengths
+        table = decode_cache.get(codes_key(model.codes),
+                                 lambda: model.codes)[1]
+        block = decode_with_table(table, body, size)
+        yield block
+        model.update(block)
+        size = read_varint(f)
+
+
+def uncompress_stream(in_stream, out_stream):
+    """ Uncompress the stream in_stream written by compress_stream into
+    out_stream, writing each block as soon as it is decoded.
+
+    @param file in_stream: a binary stream to read
+    @param file out_stream: a binary stream to write
+    @rtype: NoneType
+    """
+    header = in_stream.read(2)
+    if header != bytes([HEADER_MAGIC, FORMAT_ADAPTIVE]):
+        raise ValueError("not an adaptive stream")
+    for block in iter_adaptive_blocks(in_stream):
+        out_stream.write(block)
+        out_stream.flush()
+
+
+def _read_range_adaptive(f, start, length):
+    """ Return length bytes from byte start of the FORMAT_ADAPTIVE file f,
+    decoding no further than needed.
+
+    @param file f: a compressed file whose header has been read
+    @param int start: first uncompressed byte wanted
+    @param int length: number of uncompressed bytes wanted
+    @rtype: bytes
+    """
+    pieces, position, end = [], 0, start + length
+    with closing(iter_adaptive_blocks(f)) as blocks:
+        for block in blocks:
+            if position >= end:
+                break
+            if position + len(block) > start:
+                pieces.append(block[max(start - position, 0):
+                                    end - position])
+            position += len(block)
+    return b"".join(pieces)
+
+
+# ====================
+# Functions for shared dictionaries
+
+# Registered dictionaries: ID -> (codes, encode table, decode table)
+_dictionaries = {}
+
+
+def train_dictionary(samples, max_code_length=None):
+    """ Return code lengths for all 256 bytes trained on the bytes-like
+    objects in samples, for compressing messages like them.
+
+    Every byte is counted once more than it occurs, so that bytes missing
+    from samples still have codes.
+
+    @param iterable samples: bytes-like objects typical of the messages
+    @param int|None max_code_length: the longest code allowed, if any
+    @rtype: dict(int,int)
+
+    >>> lengths = train_dictionary([b"a" * 1000, b"ab"])
+    >>> len(lengths), lengths[ord("a")]
+    (256, 1)
+    """
+    counts = [1] * 256
+    for sample in samples:
+        _count_bytes(sample, counts)
+    freq = dict(enumerate(counts))
+    if max_code_length is not None:
+        return limited_code_lengths(freq, max_code_length)
+    return get_code_lengths(huffman_array_tree(freq))
+
+
+def save_dictionary(lengths, dict_file):
+    """ Store the code lengths of a dictionary in dict_file.
+
+    @param dict(int,int) lengths: code lengths from train_dictionary
+    @param str dict_file: file to write
+    @rtype: NoneType
+    """
+    with open(dict_file, "wb") as f:
+        f.write(lengths_to_bytes(lengths))
+
+
+def load_dictionary(dict_file, dict_id):
+    """ Register the dictionary stored in dict_file by save_dictionary
+    under dict_id.
+
+    @param str dict_file: file to read
+    @param int dict_id: non-negative ID to register it under
+    @rtype: NoneType
+    """
+    with open(dict_file, "rb") as f:
+        buf = f.read()
+    register_dictionary(dict_id, bytes_to_lengths(buf[1:]))
+
+
+def dictionary_fingerprint(lengths):
+    """ Return the DICTIONARY_FINGERPRINT_SIZE bytes that messages
+    compressed with the dictionary with code lengths lengths carry, so
+    that decoding them with another dictionary is caught.
+
+    @param dict(int,int) lengths: code lengths of a dictionary
+    @rtype: bytes
+
+    >>> len(dictionary_fingerprint({97: 1, 98: 1}))
+    2
+    >>> dictionary_fingerprint({97: 1, 98: 1}) == \
+    dictionary_fingerprint({97: 1, 99: 1})
+    False
+    """
+    crc = zlib.crc32(lengths_to_bytes(lengths))
+    return crc.to_bytes(4, "little")[:DICTIONARY_FINGERPRINT_SIZE]
+
+
+def register_dictionary(dict_id, lengths):
+    """ Build the encode and decode tables of the dictionary with the code
+    lengths lengths once, and register them under dict_id with its
+    fingerprint.
+
+    @param int dict_id: non-negative ID to register it under
+    @param dict(int,int) lengths: code lengths from train_dictionary
+    @rtype: NoneType
+    """
+    codes = canonical_codes(lengths)
+    _dictionaries[dict_id] = (codes, build_encode_table(codes),
+                              build_decode_table(codes),
+                              dictionary_fingerprint(lengths))
+
+
+def get_dictionary(dict_id):
+    """ Return the codes, encode table, decode table and fingerprint of the
+    dictionary registered under dict_id.
+
+    @param int dict_id: ID of a registered dictionary
+    @rtype: (dict(int,(int,int)), tuple, tuple, bytes)
+    """
+    if dict_id not in _dictionaries:
+        raise ValueError("unknown dictionary {}".format(dict_id))
+    return _dictionaries[dict_id]
+
+
+def compress_message(message, dict_id):
+    """ Return message compressed with the dictionary registered under
+    dict_id.
+
+    Only the dictionary ID, its fingerprint and the message size are
+    stored before the body, so the dictionary must be registered when
+    uncompressing too. ValueError is raised if a byte of message has no
+    code in the dictionary.
+
+    @param bytes message: a bytes object
+    @param int dict_id: ID of a registered dictionary
+    @rtype: bytes
+
+    >>> register_dictionary(7, train_dictionary([b"hello world"]))
+    >>> message = compress_message(b"hello", 7)
+    >>> len(message), uncompress_message(message)
+    (11, b'hello')
+    >>> register_dictionary(8, {ord("a"): 1, ord("b"): 1})
+    >>> compress_message(b"abc", 8)
+    Traceback (most recent call last):
+    ...
+    ValueError: byte 99 has no code in dictionary 8
+    """
+    codes, encode_table, _, fingerprint = get_dictionary(dict_id)
+    if len(codes) < 256:
+        for symbol in set(message):
+            if symbol not in codes:
+                raise ValueError("byte {} has no code in dictionary {}"
+                                 .format(symbol, dict_id))
+    header = bytes([HEADER_MAGIC, FORMAT_DICTIONARY]) + \
+        varint_to_bytes(dict_id) + fingerprint + \
+        varint_to_bytes(len(message))
+    return header + generate_compressed(message, encode_table)
+
+
+def uncompress_message(buf):
+    """ Return the message that compress_message compressed into buf,
+    raising ValueError if the dictionary registered under its ID is not
+    the one it was compressed with.
+
+    @param bytes buf: a message compressed by compress_message
+    @rtype: bytes
+    """
+    if buf[:2] != bytes([HEADER_MAGIC, FORMAT_DICTIONARY]):
+        raise ValueError("not a dictionary message")
+    dict_id, pos = bytes_to_varint(buf, 2)
+    _, _, decode_table, fingerprint = get_dictionary(dict_id)
+    if buf[pos:pos + DICTIONARY_FINGERPRINT_SIZE] != fingerprint:
+        raise ValueError("message was not compressed with dictionary {}"
+                         .format(dict_id))
+    size, pos = bytes_to_varint(buf, pos + DICTIONARY_FINGERPRINT_SIZE)
+    return decode_with_table(decode_table, buf[pos:], size)
+
+
+# ====================
+# Functions for batches of files
+
+
+class BatchResult:
+    """ The outcome of compressing, uncompressing or verifying one file of a
+    batch.
+
+    === Attributes ===
+    @param str in_file: the file read
+    @param str|None out_file: the file written, or None when verifying
+    @param int in_size: bytes in in_file
+    @param int out_size: bytes in out_file, or that in_file decodes to
+    when verifying
+    @param float seconds: time taken
+    @param float|None bits_per_symbol: average code length, when compressing
+    @param str|None error: why the file failed, or None if it did not
+    """
+
+    def __init__(self, in_file, out_file):
+        """ Create a result for in_file and out_file with nothing done yet.
+
+        @param BatchResult self: this BatchResult
+        @param str in_file: the file read
+        @param str|None out_file: the file written, or None when verifying
+        @rtype: NoneType
+        """
+        self.in_file, self.out_file = in_file, out_file
+        self.in_size = self.out_size = 0
+        self.seconds = 0.0
+        self.bits_per_symbol = self.error = None
+
+    def __repr__(self):
+        """ Return a representation of this BatchResult.
+
+        @param BatchResult self: this BatchResult
+        @rtype: str
+
+        >>> BatchResult("a", "a.huf")
+        BatchResult('a', 'a.huf')
+        """
+        return "BatchResult({!r}, {!r})".format(self.in_file, self.out_file)
+
+    def uncompressed_size(self):
+        """ Return the size of the uncompressed side of this result.
+
+        @param BatchResult self: this BatchResult
+        @rtype: int
+        """
+        return self.in_size if self.bits_per_symbol is not None \
+            else self.out_size
+
+    def ratio(self):
+        """ Return the compressed size over the uncompressed size, or None
+        for an empty file.
+
+        @param BatchResult self: this BatchResult
+        @rtype: float|None
+
+        >>> result = BatchResult("a", "a.huf")
+        >>> result.in_size, result.out_size, result.bits_per_symbol = 4, 1, 2.0
+        >>> result.ratio()
+        0.25
+        """
+        compressed = self.in_size + self.out_size - self.uncompressed_size()
+        size = self.uncompressed_size()
+        return compressed / size if size else None
+
+    def throughput(self):
+        """ Return the uncompressed megabytes handled per second.
+
+        @param BatchResult self: this BatchResult
+        @rtype: float
+        """
+        return self.uncompressed_size() / 1e6 / max(self.seconds, 1e-9)
+
+
+def expand_paths(patterns):
+    """ Return the files matched by the glob patterns in patterns, in
+    order and without repeats. Patterns matching nothing are kept as they
+    are, so that missing files are reported rather than skipped.
+
+    @param list[str] patterns: file names or glob patterns
+    @rtype: list[str]
+    """
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(paths))
+
+
+def _run_batch_task(task):
+    """ Compress, uncompress or verify one file for task
+    (mode, in_file, out_file, kwargs), where mode is "c", "u" or "v", and
+    return its BatchResult, with any exception caught as its error.
+
+    @param (str,str,str|None,dict) task: what to do to which file
+    @rtype: BatchResult
+    """
+    mode, in_file, out_file, kwargs = task
+    result = BatchResult(in_file, out_file)
+    start = time.perf_counter()
+    try:
+        if mode == "v":
+            result.out_size = verify(in_file, **kwargs)
+        elif mode == "c":
+            kwargs = dict(kwargs)
+            method = kwargs.pop("method", compress)
+            if method is compress:
+                kwargs["verbose"] = False
+            result.bits_per_symbol = method(in_file, out_file, **kwargs)
+        else:
+            uncompress(in_file, out_file, **kwargs)
+        result.in_size = os.path.getsize(in_file)
+        if out_file is not None:
+            result.out_size = os.path.getsize(out_file)
+    except Exception as error:  # any failure is reported, not raised
+        result.error = "{}: {}".format(type(error).__name__, error)
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def _run_batch(mode, paths, out_dir, suffix, workers, kwargs):
+    """ Yield the BatchResult of each of paths in order, running up to
+    workers of them at once in separate processes.
+
+    @param str mode: "c" to compress, "u" to uncompress or "v" to verify
+    @param list[str] paths: files or glob patterns
+    @param str|None out_dir: directory for the results, or None for beside
+    each file; unused when verifying
+    @param str suffix: added to each file name to name its result
+    @param int|None workers: number of processes, or one per CPU if None
+    @param dict kwargs: keyword arguments for compress or uncompress
+    @rtype: generator[BatchResult]
+    """
+    tasks = [(mode, path, None if mode == "v" else
+              os.path.join(out_dir, os.path.basename(path)) + suffix
+              if out_dir else path + suffix, kwargs)
+             for path in expand_paths(paths)]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        yield from map(_run_batch_task, tasks)
+        return
+    with _process_pool(workers) as executor:
+        yield from _imap(executor, _run_batch_task, tasks, workers)
+
+
+def compress_files(paths, out_dir=None, suffix=".huf", workers=None,
+                   method=compress, **kwargs):
+    """ Compress each of the files or glob patterns in paths with method,
+    up to workers at once, and return a BatchResult for each file.
+    A failure is recorded in its result rather than stopping the batch.
+
+    @param list[str] paths: files or glob patterns
+    @param str|None out_dir: directory for the results, or None for beside
+    each file
+    @param str suffix: added to each file name to name its result
+    @param int|None workers: number of processes, or one per CPU if None
+    @param function method: compress, compress_context, compress_blocks or
+    compress_symbols
+    @param kwargs: keyword arguments for method
+    @rtype: list[BatchResult]
+    """
+    return list(_run_batch("c", paths, out_dir, suffix, workers,
+                           dict(kwargs, method=method)))
+
+
+def uncompress_files(paths, out_dir=None, suffix=".orig", workers=None,
+                     **kwargs):
+    """ Uncompress each of the files or glob patterns in paths like
+    compress_files.
+
+    @param list[str] paths: files or glob patterns
+    @param str|None out_dir: directory for the results, or None for beside
+    each file
+    @param str suffix: added to each file name to name its result
+    @param int|None workers: number of processes, or one per CPU if None
+    @param kwargs: keyword arguments for uncompress
+    @rtype: list[BatchResult]
+    """
+    return list(_run_batch("u", paths, out_dir, suffix, workers, kwargs))
+
+
+def verify_files(paths, workers=None, **kwargs):
+    """ Verify each of the files or glob patterns in paths with verify, up
+    to workers at once, and return a BatchResult for each file, with the
+    reason it is damaged as its error.
+
+    @param list[str] paths: files or glob patterns
+    @param int|None workers: number of processes, or one per CPU if None
+    @param kwargs: keyword arguments for verify
+    @rtype: list[BatchResult]
+    """
+    return list(_run_batch("v", paths, None, "", workers, kwargs))
+
+
+def format_result(result):
+    """ Return a line reporting result.
+
+    @param BatchResult result: a file of a batch
+    @rtype: str
+
+    >>> result = BatchResult("a", "a.huf")
+    >>> result.in_size, result.out_size, result.bits_per_symbol = 4, 1, 2.0
+    >>> result.seconds = 0.5
+    >>> format_result(result)
+    'a -> a.huf: 4 -> 1 bytes, ratio 0.250, 2.000 bits/symbol, 0.00 MB/s'
+    >>> result.error = "OSError: gone"
+    >>> format_result(result)
+    'a: FAILED OSError: gone'
+    >>> result = BatchResult("a.huf", None)
+    >>> result.in_size, result.out_size, result.seconds = 1, 4, 1.0
+    >>> format_result(result)
+    'a.huf: OK: 1 -> 4 bytes, ratio 0.250, 0.00 MB/s'
+    """
+    if result.error is not None:
+        return "{}: FAILED {}".format(result.in_file, result.error)
+    ratio = result.ratio()
+    line = "{}: {} -> {} bytes, ratio {}".format(
+        result.in_file + ": OK" if result.out_file is None
+        else result.in_file + " -> " + result.out_file,
+        result.in_size, result.out_size,
+        "-" if ratio is None else "{:.3f}".format(ratio))
+    if result.bits_per_symbol is not None:
+        line += ", {:.3f} bits/symbol".format(result.bits_per_symbol)
+    return line + ", {:.2f} MB/s".format(result.throughput())
+
+
+def format_summary(results, seconds):
+    """ Return a line totalling results, which took seconds in all.
+
+    @param list[BatchResult] results: the files of a batch
+    @param float seconds: wall time of the batch
+    @rtype: str
+    """
+    done = [result for result in results if result.error is None]
+    in_size = sum(result.in_size for result in done)
+    out_size = sum(result.out_size for result in done)
+    uncompressed = sum(result.uncompressed_size() for result in done)
+    ratio = (in_size + out_size - uncompressed) / uncompressed \
+        if uncompressed else None
+    return "{} files, {} failed: {} -> {} bytes, ratio {}, {:.2f} MB/s".format(
+        len(results), len(results) - len(done), in_size, out_size,
+        "-" if ratio is None else "{:.3f}".format(ratio),
+        uncompressed / 1e6 / max(seconds, 1e-9))
+
+
+def main(argv=None):
+    """ Compress, uncompress or verify the files named on the command line
+    argv, print a report, and return the exit status: 0 if every file succeeded
+    and 1 otherwise.
+
+    @param list[str]|None argv: arguments, or sys.argv[1:] if None
+    @rtype: int
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compress, uncompress or verify files with Huffman "
+        "codes.")
+    parser.add_argument("mode", choices=["c", "u", "v"],
+                        help="c to compress, u to uncompress or v to verify")
+    parser.add_argument("paths", nargs="+", help="files or glob patterns")
+    parser.add_argument("-o", "--out-dir", help="directory for the results")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument("--canonical", action="store_true",
+                        help="store canonical code lengths, not the tree")
+    parser.add_argument("--max-code-length", type=int,
+                        help="longest code allowed")
+    parser.add_argument("--index-interval", type=int,
+                        help="bytes between seek index entries")
+    parser.add_argument("--checksum", action="store_true",
+                        help="write the CRC-32 of each file")
+    parser.add_argument("--rle", action=argparse.BooleanOptionalAction,
+                        help="run-length code each file first (default: "
+                        "when a sample says it pays)")
+    parser.add_argument("--require-checksum", action="store_true",
+                        help="fail verifying files without a CRC-32")
+    parser.add_argument("--store", action="store_true",
+                        help="store files that coding would not shrink")
+    methods = parser.add_mutually_exclusive_group()
+    methods.add_argument("--context", action="store_true",
+                         help="code each byte by the byte before it")
+    methods.add_argument("--blocks", action="store_true",
+                         help="code the blocks of each file in parallel, "
+                         "one file at a time")
+    methods.add_argument("--symbols", choices=["byte", "16bit", "word"],
+                         help="code symbols of this kind instead of bytes")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE,
+                        help="bytes in each block (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if (args.context or args.blocks or args.symbols) and \
+            (args.canonical or args.index_interval or args.rle):
+        parser.error("--canonical, --index-interval and --rle cannot be "
+                     "used with --context, --blocks or --symbols")
+    if args.symbols and (args.checksum or args.store):
+        parser.error("--checksum and --store cannot be used with --symbols")
+    if args.context and args.store:
+        parser.error("--store cannot be used with --context")
+    kwargs = {}
+    workers = args.workers
+    if args.mode == "c" and args.context:
+        kwargs = {"method": compress_context,
+                  "max_code_length": args.max_code_length,
+                  "checksum": args.checksum}
+    elif args.mode == "c" and args.blocks:
+        kwargs = {"method": compress_blocks, "block_size": args.block_size,
+                  "workers": args.workers,
+                  "max_code_length": args.max_code_length,
+                  "checksum": args.checksum, "store": args.store}
+        # the blocks of each file take all the workers
+        workers = 1
+    elif args.mode == "c" and args.symbols:
+        kwargs = {"method": compress_symbols,
+                  "symbol_mode": {"byte": SYMBOLS_BYTE,
+                                  "16bit": SYMBOLS_16BIT,
+                                  "word": SYMBOLS_WORD}[args.symbols],
+                  "max_code_length": args.max_code_length}
+    elif args.mode == "c":
+        kwargs = {"canonical": args.canonical,
+                  "max_code_length": args.max_code_length,
+                  "index_interval": args.index_interval,
+                  "checksum": args.checksum, "rle": args.rle,
+                  "store": args.store}
+    elif args.mode == "v":
+        kwargs = {"require_checksum": args.require_checksum}
+    start = time.perf_counter()
+    results = []
+    for result in _run_batch(args.mode, args.paths, args.out_dir,
+                             ".huf" if args.mode == "c" else ".orig",
+                             workers, kwargs):
+        print(format_result(result))
+        results.append(result)
+    print(format_summary(results, time.perf_counter() - start))
+    return 0 if all(result.error is None for result in results) else 1
+
+
+# ====================
+# Other functions
+
+def improve_tree(tree, freq_dict):
+    """ Improve the tree as much as possible, without changing its shape,
+    by swapping nodes. The improvements are with respect to freq_dict.
+
+    @param HuffmanNode tree: Huffman tree rooted at 'tree'
+    @param dict(int,int) freq_dict: frequency dictionary
+    @rtype: NoneType
+
+    >>> left = HuffmanNode(None, HuffmanNode(99), HuffmanNode(100))
+    >>> right = HuffmanNode(None, HuffmanNode(101), \
+    HuffmanNode(None, HuffmanNode(97), HuffmanNode(98)))
+    >>> tree = HuffmanNode(None, left, right)
+    >>> freq = {97: 26, 98: 23, 99: 20, 100: 16, 101: 15}
+    >>> improve_tree(tree, freq)
+    >>> avg_length(tree, freq)
+    2.31
+    """
+    # get list(frequency, symbol) from high frequency to low frequency
+    lst = []
+    for key, value in freq_dict.items():
+        lst.append((value, key))
+    lst.sort(reverse=True)
+    # levelorder visited and change symbol of leaf
+    nodes = [tree]
+    while len(nodes) != 0:
+        next_node = nodes.pop(0)
         if next_node.is_leaf():
             next_node.symbol = lst.pop(0)[1]
         if next_node.left:
@@ -522,13 +3915,13 @@ def improve_tree(tree, freq_dict):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main())
     #import python_ta
     #python_ta.check_all(config="huffman_pyta.txt")
     import doctest
     doctest.testmod()
 
-    import time
-
     mode = input("Press c to compress or u to uncompress: ")
     if mode == "c":
         fname = input("File to compress: ")
@@ -1,5 +1,7 @@
 """Classes for representing nodes"""
 
+from array import array
+
 
 class HuffmanNode:
     """ A node in a Huffman tree.
@@ -14,6 +16,8 @@ class HuffmanNode:
     @param int number: node number
     """
 
+    __slots__ = ("symbol", "left", "right", "number")
+
     def __init__(self, symbol=None, left=None, right=None):
         """ Create a new HuffmanNode with the given parameters.
 
@@ -42,8 +46,20 @@ class HuffmanNode:
         >>> a == b
         False
         """
-        return (type(self) == type(other) and self.symbol == other.symbol and
-                self.left == other.left and self.right == other.right)
+        # compare pairs of nodes with an explicit stack, not recursion
+        stack = [(self, other)]
+        while stack:
+            node, other_node = stack.pop()
+            if node is None or other_node is None:
+                if node is not other_node:
+                    return False
+                continue
+            if not (type(node) == type(other_node) and
+                    node.symbol == other_node.symbol):
+                return False
+            stack.append((node.left, other_node.left))
+            stack.append((node.right, other_node.right))
+        return True
 
     def __lt__(self, other):
         """ Return True iff self is less than other.
@@ -89,6 +105,8 @@ class ReadNode:
     @param int r_data: a symbol or the node number of a HuffmanNode's right
     """
 
+    __slots__ = ("l_type", "l_data", "r_type", "r_data")
+
     def __init__(self, l_type, l_data, r_type, r_data):
         """ Create a new ReadNode with the given parameters.
 
@@ -111,6 +129,176 @@ class ReadNode:
         return 'ReadNode({}, {}, {}, {})'.format(
             self.l_type, self.l_data, self.r_type, self.r_data)
 
+
+class ArrayTree:
+    """ A Huffman tree stored as parallel arrays indexed by node number.
+    Children are numbered before their parents, so the root is the last node.
+
+    Attributes:
+    ===========
+    @param array left: node number of each node's left child, or -1
+    @param array right: node number of each node's right child, or -1
+    @param array symbol: symbol of each node, or -1 if it has none
+    """
+
+    __slots__ = ("left", "right", "symbol")
+
+    def __init__(self):
+        """ Create a new empty ArrayTree.
+
+        @param ArrayTree self: this ArrayTree
+        @rtype: NoneType
+        """
+        self.left, self.right = array("i"), array("i")
+        self.symbol = array("i")
+
+    def __len__(self):
+        """ Return the number of nodes in self.
+
+        @param ArrayTree self: this ArrayTree
+        @rtype: int
+        """
+        return len(self.symbol)
+
+    def __eq__(self, other):
+        """ Return True iff self is equivalent to other.
+
+        @param ArrayTree self: this ArrayTree
+        @param ArrayTree|Any other: an ArrayTree
+        @rtype: bool
+
+        >>> a = ArrayTree.from_huffman_node(HuffmanNode(4))
+        >>> a == ArrayTree.from_huffman_node(HuffmanNode(4))
+        True
+        >>> a == ArrayTree.from_huffman_node(HuffmanNode(5))
+        False
+        """
+        return (type(self) == type(other) and self.left == other.left and
+                self.right == other.right and self.symbol == other.symbol)
+
+    def __repr__(self):
+        """ Return constructor-style string representation.
+
+        @param ArrayTree self: this ArrayTree
+        @rtype: str
+        """
+        return 'ArrayTree.from_huffman_node({})'.format(
+            self.to_huffman_node())
+
+    def add_node(self, symbol=-1, left=-1, right=-1):
+        """ Add a node with the given symbol and children to self, and
+        return its node number.
+
+        @param ArrayTree self: this ArrayTree
+        @param int symbol: symbol of the node, or -1
+        @param int left: node number of the left child, or -1
+        @param int right: node number of the right child, or -1
+        @rtype: int
+
+        >>> t = ArrayTree()
+        >>> t.add_node(3)
+        0
+        >>> t.add_node(-1, 0, t.add_node(2))
+        2
+        """
+        self.left.append(left)
+        self.right.append(right)
+        self.symbol.append(symbol)
+        return len(self.symbol) - 1
+
+    def is_leaf(self, index):
+        """ Return True iff node number index of self is a leaf.
+
+        @param ArrayTree self: this ArrayTree
+        @param int index: a node number
+        @rtype: bool
+        """
+        return self.left[index] < 0 and self.right[index] < 0
+
+    @classmethod
+    def from_huffman_node(cls, tree):
+        """ Return the ArrayTree of the tree rooted at HuffmanNode tree,
+        whose symbols are non-negative ints or None.
+
+        @param type cls: ArrayTree
+        @param HuffmanNode tree: a Huffman tree rooted at node 'tree'
+        @rtype: ArrayTree
+
+        >>> t = ArrayTree.from_huffman_node(HuffmanNode(None, HuffmanNode(3), \
+HuffmanNode(2)))
+        >>> list(t.left), list(t.right), list(t.symbol)
+        ([-1, -1, 0], [-1, -1, 1], [3, 2, -1])
+        """
+        result = cls()
+        numbers = {}
+        # postorder with an explicit stack, so children come first
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node is None:
+                continue
+            if expanded or node.is_leaf():
+                numbers[id(node)] = result.add_node(
+                    -1 if node.symbol is None else node.symbol,
+                    numbers[id(node.left)] if node.left else -1,
+                    numbers[id(node.right)] if node.right else -1)
+            else:
+                stack.extend([(node, True), (node.right, False),
+                              (node.left, False)])
+        return result
+
+    def to_huffman_node(self):
+        """ Return the root HuffmanNode of the same tree as self.
+
+        @param ArrayTree self: this ArrayTree
+        @rtype: HuffmanNode
+
+        >>> t = ArrayTree()
+        >>> t.add_node(-1, t.add_node(3), t.add_node(2))
+        2
+        >>> t.to_huffman_node() == HuffmanNode(None, HuffmanNode(3), \
+HuffmanNode(2))
+        True
+        """
+        nodes = []
+        for index in range(len(self)):
+            left, right = self.left[index], self.right[index]
+            nodes.append(HuffmanNode(
+                None if self.symbol[index] < 0 else self.symbol[index],
+                nodes[left] if left >= 0 else None,
+                nodes[right] if right >= 0 else None))
+        return nodes[-1] if nodes else None
+
+    def code_pairs(self):
+        """ Return a dict mapping the symbols of self to (value, length)
+        pairs, where value is the code read as a binary number.
+
+        @param ArrayTree self: this ArrayTree
+        @rtype: dict(int,(int,int))
+
+        >>> t = ArrayTree()
+        >>> t.add_node(-1, t.add_node(3), t.add_node(2))
+        2
+        >>> t.code_pairs() == {3: (0, 1), 2: (1, 1)}
+        True
+        """
+        codes = {}
+        if not len(self):
+            return codes
+        left, right, symbol = self.left, self.right, self.symbol
+        stack = [(len(self) - 1, 0, 0)]
+        while stack:
+            index, value, length = stack.pop()
+            if left[index] < 0 and right[index] < 0:
+                codes[None if symbol[index] < 0 else symbol[index]] = (
+                    value, length)
+                continue
+            if right[index] >= 0:
+                stack.append((right[index], (value << 1) | 1, length + 1))
+            if left[index] >= 0:
+                stack.append((left[index], value << 1, length + 1))
+        return codes
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
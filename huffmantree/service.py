@@ -0,0 +1,303 @@
+"""
+An asyncio service compressing and uncompressing payloads with huffman.py
+in a pool of processes.
+
+Requests and responses are frames of a one-byte kind, a four-byte
+little-endian length and a payload. A request's kind is b"c" to compress
+or b"u" to uncompress; a response's kind is b"+" with the result or b"-"
+with an error message. Each connection is answered in order.
+
+Run as
+    python service.py --port 8765
+    python service.py --unix /tmp/huffman.sock
+    python service.py --stdio
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from .huffman import compress_bytes, uncompress_bytes, size_to_bytes
+    from .huffman import bytes_to_size, declared_size
+except ImportError:
+    # run as a script, or imported from this directory
+    from huffman import compress_bytes, uncompress_bytes, size_to_bytes
+    from huffman import bytes_to_size, declared_size
+
+# Request kinds and the functions that serve them
+OPERATIONS = {b"c": compress_bytes, b"u": uncompress_bytes}
+# Response kinds
+OK, ERROR = b"+", b"-"
+# Default most jobs running or queued in the pool at once
+MAX_IN_FLIGHT = 16
+# Largest payload accepted, so a bad length cannot exhaust memory
+MAX_PAYLOAD = 1 << 30
+# Default largest output an uncompress request may declare
+MAX_OUTPUT = 1 << 30
+
+
+async def read_head(reader):
+    """ Return (kind, length) from the head of the next frame from reader,
+    leaving its payload unread, or None at the end of the stream.
+
+    @param asyncio.StreamReader reader: where frames come from
+    @rtype: (bytes, int)|None
+    """
+    try:
+        head = await reader.readexactly(5)
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise
+        return None
+    length = bytes_to_size(head[1:])
+    if length > MAX_PAYLOAD:
+        raise ValueError("payload of {} bytes is too large".format(length))
+    return head[:1], length
+
+
+async def read_frame(reader):
+    """ Return (kind, payload) of the next frame from reader, or None at
+    the end of the stream.
+
+    @param asyncio.StreamReader reader: where frames come from
+    @rtype: (bytes, bytes)|None
+    """
+    head = await read_head(reader)
+    if head is None:
+        return None
+    return head[0], await reader.readexactly(head[1])
+
+
+async def write_frame(writer, kind, payload):
+    """ Write a frame to writer, waiting while its buffer is full.
+
+    @param asyncio.StreamWriter writer: where frames go
+    @param bytes kind: one byte saying what payload is
+    @param bytes payload: the frame contents
+    @rtype: NoneType
+    """
+    writer.write(kind + size_to_bytes(len(payload)))
+    writer.write(payload)
+    await writer.drain()
+
+
+class HuffmanService:
+    """ Compression jobs run in a process pool, with at most max_in_flight
+    of them running or queued at once. Callers beyond that wait, and stop
+    reading their connections, which pushes back on their clients.
+    Connections wait for a slot before reading a payload, so at most
+    max_in_flight payloads are held at once.
+
+    === Attributes ===
+    @param int max_in_flight: most jobs submitted to the pool at once
+    @param int max_output: largest output an uncompress request may
+    declare
+    """
+
+    def __init__(self, workers=None, max_in_flight=MAX_IN_FLIGHT,
+                 max_output=MAX_OUTPUT):
+        """ Create a service with a pool of workers processes, or one per
+        CPU if workers is None.
+
+        @param HuffmanService self: this HuffmanService
+        @param int|None workers: number of processes
+        @param int max_in_flight: most jobs submitted to the pool at once
+        @param int max_output: largest output an uncompress request may
+        declare
+        @rtype: NoneType
+        """
+        self.max_in_flight = max_in_flight
+        self.max_output = max_output
+        self._executor = ProcessPoolExecutor(workers or os.cpu_count())
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    async def run(self, operation, payload):
+        """ Return the result of OPERATIONS[operation] on payload, computed
+        in the pool once a slot is free.
+
+        @param HuffmanService self: this HuffmanService
+        @param bytes operation: b"c" or b"u"
+        @param bytes payload: data to compress or uncompress
+        @rtype: bytes
+        """
+        async with self._slots:
+            return await self._submit(operation, payload)
+
+    async def _submit(self, operation, payload):
+        """ Return the result of OPERATIONS[operation] on payload, computed
+        in the pool, once the caller holds a slot. Uncompress requests
+        declaring more than max_output bytes are rejected first.
+
+        @param HuffmanService self: this HuffmanService
+        @param bytes operation: b"c" or b"u"
+        @param bytes payload: data to compress or uncompress
+        @rtype: bytes
+        """
+        if operation not in OPERATIONS:
+            raise ValueError("unknown operation {!r}".format(operation))
+        if operation == b"u":
+            size = declared_size(payload)
+            if size is not None and size > self.max_output:
+                raise ValueError("output of {} bytes is too large".format(
+                    size))
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, OPERATIONS[operation], payload)
+
+    async def compress(self, payload):
+        """ Return payload compressed by compress_bytes in the pool.
+
+        @param HuffmanService self: this HuffmanService
+        @param bytes payload: data to compress
+        @rtype: bytes
+        """
+        return await self.run(b"c", payload)
+
+    async def uncompress(self, payload):
+        """ Return payload uncompressed by uncompress_bytes in the pool.
+
+        @param HuffmanService self: this HuffmanService
+        @param bytes payload: data to uncompress
+        @rtype: bytes
+        """
+        return await self.run(b"u", payload)
+
+    async def handle(self, reader, writer):
+        """ Answer each request frame from reader on writer until reader
+        ends, then close writer. A failed job is answered with its error
+        and the connection carries on. Each payload is read only once a
+        slot is free. A frame too large to read is answered with an error
+        before the connection is closed, since its payload cannot be
+        skipped.
+
+        @param HuffmanService self: this HuffmanService
+        @param asyncio.StreamReader reader: where requests come from
+        @param asyncio.StreamWriter writer: where responses go
+        @rtype: NoneType
+        """
+        try:
+            while True:
+                try:
+                    head = await read_head(reader)
+                except ValueError as error:
+                    await write_frame(writer, ERROR, "{}: {}".format(
+                        type(error).__name__, error).encode())
+                    break
+                if head is None:
+                    break
+                async with self._slots:
+                    payload = await reader.readexactly(head[1])
+                    try:
+                        result = await self._submit(head[0], payload)
+                    except Exception as error:  # reported to the client
+                        result = None
+                        message = "{}: {}".format(type(error).__name__,
+                                                  error).encode()
+                # answer after giving up the slot, as a slow client reads
+                if result is None:
+                    await write_frame(writer, ERROR, message)
+                else:
+                    await write_frame(writer, OK, result)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """ Shut down the pool once its jobs are done.
+
+        @param HuffmanService self: this HuffmanService
+        @rtype: NoneType
+        """
+        self._executor.shutdown()
+
+
+async def request(reader, writer, operation, payload):
+    """ Send one request on a connection to the service and return the
+    result, raising ValueError with the message of a failed job.
+
+    @param asyncio.StreamReader reader: where responses come from
+    @param asyncio.StreamWriter writer: where requests go
+    @param bytes operation: b"c" or b"u"
+    @param bytes payload: data to compress or uncompress
+    @rtype: bytes
+    """
+    await write_frame(writer, operation, payload)
+    frame = await read_frame(reader)
+    if frame is None:
+        raise ConnectionError("service closed the connection")
+    kind, result = frame
+    if kind == ERROR:
+        raise ValueError(result.decode())
+    return result
+
+
+async def open_stdio():
+    """ Return a reader and writer for this process's stdin and stdout,
+    which must be pipes or sockets rather than files.
+
+    @rtype: (asyncio.StreamReader, asyncio.StreamWriter)
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, sys.stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def serve(args):
+    """ Serve requests as args from the command line ask, until stdin ends
+    in --stdio mode or forever otherwise.
+
+    @param argparse.Namespace args: parsed command line
+    @rtype: NoneType
+    """
+    service = HuffmanService(args.workers, args.max_in_flight,
+                             args.max_output)
+    try:
+        if args.stdio:
+            await service.handle(*await open_stdio())
+            return
+        if args.unix:
+            server = await asyncio.start_unix_server(service.handle,
+                                                     args.unix)
+        else:
+            server = await asyncio.start_server(service.handle, args.host,
+                                                args.port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    """ Run the service as the command line argv asks.
+
+    @param list[str]|None argv: arguments, or sys.argv[1:] if None
+    @rtype: NoneType
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--port", type=int, help="TCP port to listen on")
+    where.add_argument("--unix", help="Unix socket path to listen on")
+    where.add_argument("--stdio", action="store_true",
+                       help="serve one client on stdin and stdout")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help="most jobs in the pool at once (default: {})"
+                        .format(MAX_IN_FLIGHT))
+    parser.add_argument("--max-output", type=int, default=MAX_OUTPUT,
+                        help="largest output an uncompress request may "
+                        "declare (default: {})".format(MAX_OUTPUT))
+    asyncio.run(serve(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""Classes for recording where compression spends its time"""
+
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageStats:
+    """ Totals for one stage of compressing or uncompressing.
+
+    Times are exclusive: time spent in a stage nested inside this one is
+    counted for the nested stage only.
+
+    Attributes:
+    ===========
+    @param int calls: number of times the stage ran
+    @param float wall: wall time in seconds
+    @param float cpu: CPU time of this process in seconds
+    @param int bytes_in: bytes the stage consumed
+    @param int bytes_out: bytes the stage produced
+    @param int blocks: change in the number of memory blocks allocated by
+    the interpreter, as counted by sys.getallocatedblocks
+    """
+
+    __slots__ = ("calls", "wall", "cpu", "bytes_in", "bytes_out", "blocks")
+
+    def __init__(self):
+        """ Create totals for a stage that has not run.
+
+        @param StageStats self: this StageStats
+        @rtype: NoneType
+        """
+        self.calls = self.bytes_in = self.bytes_out = self.blocks = 0
+        self.wall = self.cpu = 0.0
+
+    def __repr__(self):
+        """ Return a representation of this StageStats.
+
+        @param StageStats self: this StageStats
+        @rtype: str
+
+        >>> StageStats()
+        StageStats(calls=0, wall=0.0, cpu=0.0, bytes_in=0, bytes_out=0, \
+blocks=0)
+        """
+        return "StageStats({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for name in self.__slots__))
+
+    def as_dict(self):
+        """ Return the totals as a dict, for JSON.
+
+        @param StageStats self: this StageStats
+        @rtype: dict(str,int|float)
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Stats:
+    """ Per-stage totals collected while compressing or uncompressing.
+
+    Pass a Stats to compress or uncompress and read stages afterwards, or
+    give a callback to hear about every stage as it ends.
+
+    Attributes:
+    ===========
+    @param dict(str,StageStats) stages: totals of each stage, in the order
+    the stages first ran
+    @param callable|None callback: called with the name and totals of a
+    stage whenever it ends
+    """
+
+    def __init__(self, callback=None):
+        """ Create an empty Stats.
+
+        @param Stats self: this Stats
+        @param callable|None callback: called as callback(name, stage_stats)
+        whenever a stage ends
+        @rtype: NoneType
+        """
+        self.stages = {}
+        self.callback = callback
+        self._running = []
+
+    def __getitem__(self, name):
+        """ Return the totals of the stage name, creating them if needed.
+
+        @param Stats self: this Stats
+        @param str name: a stage
+        @rtype: StageStats
+        """
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """ Add the time and memory blocks used in the with block to the
+        totals of the stage name, which it yields.
+
+        @param Stats self: this Stats
+        @param str name: a stage
+        @rtype: generator[StageStats]
+
+        >>> stats = Stats()
+        >>> with stats.stage("outer") as outer:
+        ...     outer.bytes_in += 3
+        ...     with stats.stage("inner"):
+        ...         time.sleep(0.01)
+        >>> list(stats.stages), stats["outer"].bytes_in
+        (['outer', 'inner'], 3)
+        >>> stats["inner"].wall >= 0.01 > stats["outer"].wall
+        True
+        """
+        record = self[name]
+        # start times, then the totals of the stages nested inside
+        frame = [time.perf_counter(), time.process_time(),
+                 sys.getallocatedblocks(), 0.0, 0.0, 0]
+        self._running.append(frame)
+        try:
+            yield record
+        finally:
+            self._running.pop()
+            wall = time.perf_counter() - frame[0]
+            cpu = time.process_time() - frame[1]
+            blocks = sys.getallocatedblocks() - frame[2]
+            record.calls += 1
+            record.wall += wall - frame[3]
+            record.cpu += cpu - frame[4]
+            record.blocks += blocks - frame[5]
+            if self._running:
+                parent = self._running[-1]
+                parent[3] += wall
+                parent[4] += cpu
+                parent[5] += blocks
+            if self.callback is not None:
+                self.callback(name, record)
+
+    def iterate(self, name, iterable):
+        """ Yield the items of iterable, and once they run out, add the
+        time taken to get them all and their total length as output to the
+        stage name, as one call.
+
+        Only clocks are read for each item, so this is cheap enough for
+        small chunks; memory blocks are not counted.
+
+        @param Stats self: this Stats
+        @param str name: a stage
+        @param iterable iterable: items with lengths, such as chunks
+        @rtype: generator
+
+        >>> stats = Stats()
+        >>> list(stats.iterate("read", [b"ab", b"c"]))
+        [b'ab', b'c']
+        >>> stats["read"].calls, stats["read"].bytes_out
+        (1, 3)
+        """
+        wall = cpu = 0.0
+        size = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start, start_cpu = time.perf_counter(), time.process_time()
+                item = next(iterator, None)
+                wall += time.perf_counter() - start
+                cpu += time.process_time() - start_cpu
+                if item is None:
+                    return
+                size += len(item)
+                yield item
+        finally:
+            self.add(name, wall, cpu, bytes_out=size)
+
+    def write(self, name, f, pieces):
+        """ Write each of pieces to f, add the time taken and the bytes
+        written as input to the stage name, as one call, and return the
+        number of bytes written.
+
+        @param Stats self: this Stats
+        @param str name: a stage
+        @param file f: a file opened for writing in binary mode
+        @param iterable pieces: bytes-like objects
+        @rtype: int
+
+        >>> import io
+        >>> stats = Stats()
+        >>> stats.write("write", io.BytesIO(), [b"ab", b"c"])
+        3
+        >>> stats["write"].calls, stats["write"].bytes_in
+        (1, 3)
+        """
+        wall = cpu = 0.0
+        size = 0
+        try:
+            for piece in pieces:
+                start, start_cpu = time.perf_counter(), time.process_time()
+                f.write(piece)
+                wall += time.perf_counter() - start
+                cpu += time.process_time() - start_cpu
+                size += len(piece)
+        finally:
+            self.add(name, wall, cpu, bytes_in=size)
+        return size
+
+    def add(self, name, wall, cpu, bytes_in=0, bytes_out=0):
+        """ Add one call taking wall and cpu seconds to the totals of the
+        stage name, as a stage nested in the one running, if any.
+
+        @param Stats self: this Stats
+        @param str name: a stage
+        @param float wall: wall time in seconds
+        @param float cpu: CPU time of this process in seconds
+        @param int bytes_in: bytes the call consumed
+        @param int bytes_out: bytes the call produced
+        @rtype: NoneType
+        """
+        record = self[name]
+        record.calls += 1
+        record.wall += wall
+        record.cpu += cpu
+        record.bytes_in += bytes_in
+        record.bytes_out += bytes_out
+        if self._running:
+            self._running[-1][3] += wall
+            self._running[-1][4] += cpu
+        if self.callback is not None:
+            self.callback(name, record)
+
+    def total(self):
+        """ Return the totals of all stages added together.
+
+        @param Stats self: this Stats
+        @rtype: StageStats
+        """
+        result = StageStats()
+        for record in self.stages.values():
+            for name in StageStats.__slots__:
+                setattr(result, name, getattr(result, name) +
+                        getattr(record, name))
+        return result
+
+    def as_dict(self):
+        """ Return the totals of each stage as a dict, for JSON.
+
+        @param Stats self: this Stats
+        @rtype: dict(str,dict)
+        """
+        return {name: record.as_dict() for name, record in self.stages.items()}
+
+    def __str__(self):
+        """ Return a table of the totals of each stage, with the share of
+        the wall time each took.
+
+        @param Stats self: this Stats
+        @rtype: str
+        """
+        total = self.total().wall or 1.0
+        lines = ["{:<10}{:>7}{:>10}{:>10}{:>7}{:>12}{:>12}{:>10}".format(
+            "stage", "calls", "wall", "cpu", "share", "bytes in",
+            "bytes out", "blocks")]
+        for name, record in self.stages.items():
+            lines.append(
+                "{:<10}{:>7}{:>10.4f}{:>10.4f}{:>7.1%}{:>12}{:>12}{:>10}"
+                .format(name, record.calls, record.wall, record.cpu,
+                        record.wall / total, record.bytes_in,
+                        record.bytes_out, record.blocks))
+        return "\n".join(lines)
+
+
+class NullStats:
+    """ A stand-in for Stats that records nothing, used when no statistics
+    are asked for, so that collecting them costs nothing.
+    """
+
+    def __init__(self):
+        """ Create a NullStats.
+
+        @param NullStats self: this NullStats
+        @rtype: NoneType
+        """
+        # the totals every stage yields, which are never read
+        self._stage = nullcontext(StageStats())
+
+    def stage(self, name):
+        """ Return a context manager that records nothing for the stage
+        name.
+
+        @param NullStats self: this NullStats
+        @param str name: a stage
+        @rtype: nullcontext
+
+        >>> with NullStats().stage("read") as record:
+        ...     record.bytes_in += 1
+        """
+        return self._stage
+
+    def iterate(self, name, iterable):
+        """ Return iterable as it is.
+
+        @param NullStats self: this NullStats
+        @param str name: a stage
+        @param iterable iterable: items with lengths, such as chunks
+        @rtype: iterable
+        """
+        return iterable
+
+    def write(self, name, f, pieces):
+        """ Write each of pieces to f and return the number of bytes
+        written.
+
+        @param NullStats self: this NullStats
+        @param str name: a stage
+        @param file f: a file opened for writing in binary mode
+        @param iterable pieces: bytes-like objects
+        @rtype: int
+        """
+        size = 0
+        for piece in pieces:
+            f.write(piece)
+            size += len(piece)
+        return size
@@ -4,15 +4,73 @@
 Property testing for functions in huffman.py.
 """
 
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
 import unittest
+import random
 from random import shuffle
-from huffman import byte_to_bits, bits_to_byte, get_bit, make_freq_dict
-from huffman import huffman_tree, get_codes, number_nodes
-from huffman import generate_compressed, generate_uncompressed
-from huffman import avg_length, tree_to_bytes, num_nodes_to_bytes
-from nodes import HuffmanNode
+try:
+    from .huffman import (byte_to_bits, bits_to_byte, get_bit, make_freq_dict,
+                          huffman_tree, get_codes, number_nodes,
+                          huffman_array_tree, generate_compressed,
+                          generate_uncompressed, avg_length, tree_to_bytes,
+                          num_nodes_to_bytes, generate_tree_general,
+                          get_code_pairs, build_decode_table,
+                          decode_with_table, iter_compressed,
+                          iter_uncompressed, get_code_lengths, canonical_codes,
+                          lengths_to_bytes, bytes_to_lengths,
+                          limited_code_lengths, lengths_to_tree, compress,
+                          uncompress, compress_blocks, read_range,
+                          compress_symbols, varint_to_bytes, read_varint,
+                          SYMBOLS_BYTE, SYMBOLS_16BIT, SYMBOLS_WORD,
+                          compress_stream, uncompress_stream,
+                          compress_adaptive, train_dictionary,
+                          register_dictionary, compress_message,
+                          uncompress_message, decode_cache, compress_files,
+                          uncompress_files, main, verify, verify_files,
+                          iter_rle, iter_unrle, FORMAT_RLE, compress_context,
+                          iter_context_pairs, context_code_lengths,
+                          context_codes, build_context_tables,
+                          iter_uncompressed_context, compress_bytes,
+                          uncompress_bytes, size_to_bytes, CHECKSUMMED)
+    from .nodes import HuffmanNode, ReadNode, ArrayTree
+    from .stats import Stats
+    from .service import (HuffmanService, request, read_frame, ERROR,
+                          MAX_PAYLOAD)
+except ImportError:
+    # run as a script, or imported from this directory
+    from huffman import (byte_to_bits, bits_to_byte, get_bit, make_freq_dict,
+                         huffman_tree, get_codes, number_nodes,
+                         huffman_array_tree, generate_compressed,
+                         generate_uncompressed, avg_length, tree_to_bytes,
+                         num_nodes_to_bytes, generate_tree_general,
+                         get_code_pairs, build_decode_table, decode_with_table,
+                         iter_compressed, iter_uncompressed, get_code_lengths,
+                         canonical_codes, lengths_to_bytes, bytes_to_lengths,
+                         limited_code_lengths, lengths_to_tree, compress,
+                         uncompress, compress_blocks, read_range,
+                         compress_symbols, varint_to_bytes, read_varint,
+                         SYMBOLS_BYTE, SYMBOLS_16BIT, SYMBOLS_WORD,
+                         compress_stream, uncompress_stream, compress_adaptive,
+                         train_dictionary, register_dictionary,
+                         compress_message, uncompress_message, decode_cache,
+                         compress_files, uncompress_files, main, verify,
+                         verify_files, iter_rle, iter_unrle, FORMAT_RLE,
+                         compress_context, iter_context_pairs,
+                         context_code_lengths, context_codes,
+                         build_context_tables, iter_uncompressed_context,
+                         compress_bytes, uncompress_bytes, size_to_bytes,
+                         CHECKSUMMED)
+    from nodes import HuffmanNode, ReadNode, ArrayTree
+    from stats import Stats
+    from service import (HuffmanService, request, read_frame, ERROR,
+                         MAX_PAYLOAD)
 from hypothesis import given, assume, settings
 from hypothesis.strategies import binary, integers, dictionaries, text
+from hypothesis.strategies import lists, tuples
 
 settings.register_profile("norand", settings(derandomize=True,
                                              max_examples=200))
@@ -29,7 +87,7 @@ class TestByteUtilities(unittest.TestCase):
         self.assertTrue(set(byte_to_bits(b)).issubset({"0", "1"}))
         self.assertEqual(len(byte_to_bits(b)), 8)
 
-    @given(text(["0", "1"], 0, 4, 8))
+    @given(text(["0", "1"], min_size=0, max_size=8))
     def test_bits_to_byte(self, s):
         """bits_to_byte produces byte"""
 
@@ -49,16 +107,28 @@ class TestByteUtilities(unittest.TestCase):
 class TestCompressionCode(unittest.TestCase):
     """Property tests for Huffman functions"""
 
-    @given(binary(0, 100, 1000))
+    @given(binary(min_size=0, max_size=1000))
     def test_make_freq_dict(self, byte_list):
         """make_freq_dict returns dictionary whose values
-        sum to the number of bytes consumed"""
+        sum to the number of bytes consumed, in first-seen order"""
 
         b, d = byte_list, make_freq_dict(byte_list)
         self.assertTrue(isinstance(d, dict))
         self.assertEqual(sum(d.values()), len(b))
+        self.assertEqual(list(d), list(dict.fromkeys(b)))
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(binary(min_size=0, max_size=1000), integers(1, 50))
+    def test_make_freq_dict_chunks(self, b, chunk_size):
+        """make_freq_dict of a list of chunks is the same as
+        make_freq_dict of the whole bytes object"""
+
+        chunks = [memoryview(b)[i:i + chunk_size]
+                  for i in range(0, len(b), chunk_size)]
+        self.assertEqual(list(make_freq_dict(chunks).items()),
+                         list(make_freq_dict(b).items()))
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000),
+                        min_size=2, max_size=256))
     def test_huffman_tree(self, d):
         """huffman_tree returns a non-leaf HuffmanNode"""
 
@@ -66,7 +136,18 @@ class TestCompressionCode(unittest.TestCase):
         self.assertTrue(isinstance(t, HuffmanNode))
         self.assertTrue(not t.is_leaf())
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(dictionaries(integers(0, 1 << 16), integers(1, 1000),
+                        min_size=2, max_size=2000))
+    def test_huffman_tree_large_alphabet(self, d):
+        """huffman_tree gives every symbol of a large alphabet its own leaf,
+        and builds the same tree each time"""
+
+        t = huffman_tree(d)
+        self.assertEqual(set(get_codes(t)), set(d))
+        self.assertEqual(t, huffman_tree(d))
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000),
+                        min_size=2, max_size=256))
     def test_get_codes(self, d):
         """the sum of len(code) * freq_dict[code] is optimal, so it
         must be invariant under permutation of the dictionary"""
@@ -82,7 +163,67 @@ class TestCompressionCode(unittest.TestCase):
         self.assertEqual(sum([d[k] * len(c1[k]) for k in d]),
                          sum([d2[k] * len(c2[k]) for k in d2]))
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(lists(tuples(integers(0, 3), integers(1, 600))), integers(1, 50),
+           integers(1, 50))
+    def test_rle(self, runs, chunk_size, piece_size):
+        """iter_unrle undoes iter_rle, however the input and the coded bytes
+        are split into chunks"""
+
+        b = b"".join(bytes([byte]) * length for byte, length in runs)
+        chunks = [b[i:i + chunk_size] for i in range(0, len(b), chunk_size)]
+        coded = b"".join(iter_rle(chunks))
+        self.assertEqual(coded, b"".join(iter_rle([b])))
+        pieces = [coded[i:i + piece_size]
+                  for i in range(0, len(coded), piece_size)]
+        self.assertEqual(b"".join(iter_unrle(pieces)), b)
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 50),
+           integers(8, 12))
+    def test_context_round_trip(self, b, chunk_size, max_length):
+        """order-1 codes of the clusters from context_code_lengths decode
+        back to b from chunks of any size"""
+
+        freq = make_freq_dict(iter_context_pairs([b]))
+        context_map, clusters = context_code_lengths(freq, max_length)
+        cluster_codes = [canonical_codes(lengths) for lengths in clusters]
+        self.assertTrue(all(length <= max_length for lengths in clusters
+                            for length in lengths.values()))
+        chunks = [b[i:i + chunk_size] for i in range(0, len(b), chunk_size)]
+        compressed = b"".join(iter_compressed(
+            iter_context_pairs(chunks),
+            context_codes(context_map, cluster_codes)))
+        table = build_context_tables((context_map, cluster_codes))
+        pieces = [compressed[i:i + chunk_size]
+                  for i in range(0, len(compressed), chunk_size)]
+        self.assertEqual(b"".join(iter_uncompressed_context(
+            table, pieces, len(b))), b)
+
+    @given(integers(min_value=0, max_value=2 ** 70))
+    def test_varint(self, n):
+        """read_varint reads back what varint_to_bytes writes"""
+
+        self.assertEqual(read_varint(io.BytesIO(varint_to_bytes(n))), n)
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000),
+                        min_size=2, max_size=256), integers(8, 20))
+    def test_limited_code_lengths(self, d, max_length):
+        """limited_code_lengths gives a complete prefix code with no code
+        over max_length bits, which is no better than Huffman's and is as
+        good once max_length is not binding"""
+
+        lengths = limited_code_lengths(d, max_length)
+        self.assertTrue(max(lengths.values()) <= max_length)
+        self.assertEqual(sum(2 ** (max_length - l) for l in lengths.values()),
+                         2 ** max_length)
+        t = huffman_tree(d)
+        limited, optimal = avg_length(lengths_to_tree(lengths), d), \
+            avg_length(t, d)
+        self.assertTrue(limited >= optimal - 1e-9)
+        if max(len(code) for code in get_codes(t).values()) <= max_length:
+            self.assertAlmostEqual(limited, optimal)
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000),
+                        min_size=2, max_size=256))
     def test_number_nodes(self, d):
         """if the root is an interior node, it must be numbered
         two less than the number of symbols"""
@@ -96,7 +237,36 @@ class TestCompressionCode(unittest.TestCase):
         number_nodes(t)
         self.assertEqual(count, t.number + 2)
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(dictionaries(integers(0, 1 << 16), integers(1, 1000),
+                        min_size=1, max_size=2000))
+    def test_array_tree(self, d):
+        """converting a tree to an ArrayTree and back gives the same tree,
+        as does building it as an ArrayTree, and all give the same codes"""
+
+        t = huffman_tree(d)
+        a = ArrayTree.from_huffman_node(t)
+        self.assertEqual(len(a), 2 * len(d) - 1)
+        self.assertEqual(a.to_huffman_node(), t)
+        self.assertEqual(get_code_pairs(a), get_code_pairs(t))
+        self.assertEqual(huffman_array_tree(d).to_huffman_node(), t)
+
+    @given(integers(2, 5000))
+    def test_deep_tree(self, depth):
+        """trees far deeper than the recursion limit can be rebuilt from
+        nodes, numbered and given codes"""
+
+        node_lst = [ReadNode(0, 0, 0, 1)] + [ReadNode(0, i + 1, 1, i - 1)
+                                             for i in range(1, depth - 1)]
+        t = generate_tree_general(node_lst, len(node_lst) - 1)
+        number_nodes(t)
+        self.assertEqual(t.number, len(node_lst) - 1)
+        codes = get_codes(t)
+        self.assertEqual(len(codes), depth)
+        self.assertEqual(max(len(code) for code in codes.values()),
+                         depth - 1)
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000),
+                        min_size=2, max_size=256))
     def test_avg_length(self, d):
         """avg_length should return a float in the
         interval [0, 8]"""
@@ -107,7 +277,7 @@ class TestCompressionCode(unittest.TestCase):
         self.assertTrue(isinstance(f, float))
         self.assertTrue(0 <= f <= 8.0, d)
 
-    @given(binary(2, 100, 1000))
+    @given(binary(min_size=2, max_size=1000))
     def test_generate_compressed(self, b):
         """generate_compressed should return a bytes
         object that is no longer than the input bytes, and
@@ -131,7 +301,16 @@ class TestCompressionCode(unittest.TestCase):
         compressed2 = generate_compressed(b, c)
         self.assertEqual(len(compressed2), len(compressed))
 
-    @given(binary(2, 100, 1000))
+    @given(binary(min_size=2, max_size=1000))
+    def test_generate_compressed_code_pairs(self, b):
+        """generate_compressed gives the same bytes for bit string codes
+        and for the equivalent (value, length) codes"""
+
+        t = huffman_tree(make_freq_dict(b))
+        self.assertEqual(generate_compressed(b, get_codes(t)),
+                         generate_compressed(b, get_code_pairs(t)))
+
+    @given(binary(min_size=2, max_size=1000))
     def test_tree_to_bytes(self, b):
         """tree_to_bytes generates a bytes representation of
         a post-order traversal of a trees internal nodes"""
@@ -151,7 +330,7 @@ class TestCompressionCode(unittest.TestCase):
         leaf_count = dictionary_length
         self.assertEqual(4 * (leaf_count - 1), len(output_bytes))
 
-    @given(binary(2, 100, 1000))
+    @given(binary(min_size=2, max_size=1000))
     def test_num_nodes_to_bytes(self, b):
         """num_nodes_to_bytes returns a bytes object that
         has length 1 (since the number of internal nodes cannot
@@ -170,7 +349,7 @@ class TestCompressionCode(unittest.TestCase):
 class TestRoundTrip(unittest.TestCase):
     """Property test for round trip"""
 
-    @given(binary(1, 100, 1000))
+    @given(binary(min_size=1, max_size=1000))
     def test_round_trip(self, b):
         """test inverting generate_compressed and generate_uncompressed"""
 
@@ -183,5 +362,498 @@ class TestRoundTrip(unittest.TestCase):
         uncompressed = generate_uncompressed(tree, compressed, len(orig_text))
         assert orig_text == uncompressed, '\n'.join([str(list(orig_text)), byte_to_bits(compressed[0]), str(list(uncompressed)), str(codes)])
 
+    @given(binary(min_size=1, max_size=1000), integers(1, 12))
+    def test_round_trip_table_bits(self, b, table_bits):
+        """decoding gives back the text whatever the table width, so
+        codes longer than the table are also decoded correctly"""
+
+        freq = make_freq_dict(b)
+        assume(len(freq) > 1)
+        tree = huffman_tree(freq)
+        compressed = generate_compressed(b, get_codes(tree))
+        table = build_decode_table(get_code_pairs(tree), table_bits)
+        self.assertEqual(decode_with_table(table, compressed, len(b)), b)
+
+    @given(binary(min_size=1, max_size=1000), integers(1, 50))
+    def test_round_trip_chunks(self, b, chunk_size):
+        """compressing and decompressing chunk by chunk gives the same
+        bytes as doing it all at once"""
+
+        freq = make_freq_dict(b)
+        assume(len(freq) > 1)
+        tree = huffman_tree(freq)
+        codes = get_codes(tree)
+        chunks = [b[i:i + chunk_size] for i in range(0, len(b), chunk_size)]
+        compressed = b"".join(iter_compressed(chunks, codes))
+        self.assertEqual(compressed, generate_compressed(b, codes))
+        chunks = [compressed[i:i + chunk_size]
+                  for i in range(0, len(compressed), chunk_size)]
+        table = build_decode_table(get_code_pairs(tree))
+        self.assertEqual(b"".join(iter_uncompressed(table, chunks, len(b))), b)
+
+    @given(binary(min_size=1, max_size=1000))
+    def test_round_trip_canonical(self, b):
+        """canonical codes rebuilt from the stored lengths alone decode
+        what was compressed with them"""
+
+        tree = huffman_tree(make_freq_dict(b))
+        lengths = get_code_lengths(tree)
+        compressed = generate_compressed(b, canonical_codes(lengths))
+        header = lengths_to_bytes(lengths)
+        self.assertEqual(header[0] + 1, len(lengths))
+        codes = canonical_codes(bytes_to_lengths(header[1:]))
+        self.assertEqual(decode_with_table(build_decode_table(codes),
+                                           compressed, len(b)), b)
+
+    @given(binary(), integers(min_value=1, max_value=64))
+    def test_round_trip_stream(self, b, block_size):
+        """uncompress_stream inverts compress_stream for any block size"""
+
+        compressed, uncompressed = io.BytesIO(), io.BytesIO()
+        compress_stream(io.BytesIO(b), compressed, block_size)
+        compressed.seek(0)
+        uncompress_stream(compressed, uncompressed)
+        self.assertEqual(uncompressed.getvalue(), b)
+
+    @given(binary(max_size=200), binary(max_size=200),
+           integers(min_value=0, max_value=2 ** 20))
+    def test_round_trip_message(self, sample, b, dict_id):
+        """uncompress_message inverts compress_message with any dictionary,
+        even for bytes missing from its training samples"""
+
+        register_dictionary(dict_id, train_dictionary([sample]))
+        self.assertEqual(uncompress_message(compress_message(b, dict_id)), b)
+
+    def test_message_checks(self):
+        """compress_message rejects bytes the dictionary cannot code, and
+        uncompress_message rejects messages from another dictionary"""
+
+        register_dictionary(1, {ord("a"): 1, ord("b"): 1})
+        with self.assertRaises(ValueError):
+            compress_message(b"abc", 1)
+        message = compress_message(b"abba", 1)
+        register_dictionary(1, train_dictionary([b"abba"]))
+        with self.assertRaises(ValueError):
+            uncompress_message(message)
+
+
+class TestFiles(unittest.TestCase):
+    """Round trip tests for compressing whole files"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def round_trip(self, data, compress_file, uncompress_kwargs=None,
+                   **kwargs):
+        """Return data after compress_file and uncompress"""
+
+        names = [os.path.join(self.dir.name, name)
+                 for name in ("in", "in.huf", "in.orig")]
+        with open(names[0], "wb") as f:
+            f.write(data)
+        compress_file(names[0], names[1], **kwargs)
+        uncompress(names[1], names[2], **(uncompress_kwargs or {}))
+        with open(names[2], "rb") as f:
+            return f.read()
+
+    def test_compress_blocks(self):
+        """compress_blocks round trips, whether blocks divide the input
+        evenly or not, and for empty input"""
+
+        data = bytes(range(256)) * 40 + b"abracadabra" * 100
+        for block_size in (997, len(data), 10 ** 6):
+            self.assertEqual(self.round_trip(data, compress_blocks,
+                                             block_size=block_size,
+                                             workers=2), data)
+        self.assertEqual(self.round_trip(b"aaaa", compress_blocks,
+                                         block_size=3, workers=1), b"aaaa")
+        for checksum in (False, True):
+            self.assertEqual(self.round_trip(b"", compress_blocks, workers=1,
+                                             checksum=checksum), b"")
+        name = os.path.join(self.dir.name, "in.huf")
+        self.assertEqual(verify(name, require_checksum=True), 0)
+        self.assertEqual(read_range(name, 0, 10), b"")
+
+    def test_mmap(self):
+        """compressing and uncompressing through memory maps gives the same
+        results as reading the files"""
+
+        data = bytes(range(256)) * 20 + b"abracadabra" * 200
+        for kwargs in [{}, {"index_interval": 100, "canonical": True}]:
+            self.assertEqual(self.round_trip(data, compress,
+                                             {"use_mmap": True},
+                                             use_mmap=True, chunk_size=7,
+                                             **kwargs), data)
+            with open(os.path.join(self.dir.name, "in.huf"), "rb") as f:
+                mapped = f.read()
+            self.round_trip(data, compress, **kwargs)
+            with open(os.path.join(self.dir.name, "in.huf"), "rb") as f:
+                self.assertEqual(f.read(), mapped)
+
+    def test_stream_short_reads(self):
+        """compress_stream fills each block despite short reads from a pipe,
+        so it writes the same stream as for a file"""
+
+        data = bytes(range(256)) * 20 + b"abracadabra" * 200
+
+        class Pipe(io.BytesIO):
+            """A stream giving at most 100 bytes on each read1"""
+
+            def read1(self, size=-1):
+                return super().read1(min(size, 100))
+
+        streams = []
+        for in_stream in (io.BytesIO(data), Pipe(data)):
+            streams.append(io.BytesIO())
+            compress_stream(in_stream, streams[-1], 1000)
+        self.assertEqual(streams[0].getvalue(), streams[1].getvalue())
+        streams[1].seek(0)
+        uncompressed = io.BytesIO()
+        uncompress_stream(streams[1], uncompressed)
+        self.assertEqual(uncompressed.getvalue(), data)
+
+    def test_read_range(self):
+        """read_range gives the same bytes as slicing the input, with or
+        without a seek index whatever the chunk size, and in the block and
+        adaptive formats, and rejects a negative start"""
+
+        data = bytes(range(256)) * 20 + b"abracadabra" * 200
+        name = os.path.join(self.dir.name, "in.huf")
+        for compress_file, kwargs in [(compress, {}),
+                                      (compress, {"index_interval": 100}),
+                                      (compress, {"index_interval": 1,
+                                                  "canonical": True}),
+                                      (compress, {"index_interval": 100,
+                                                  "chunk_size": 64}),
+                                      (compress_blocks, {"block_size": 333,
+                                                         "workers": 1}),
+                                      (compress_adaptive, {"block_size": 333})
+                                      ]:
+            self.assertEqual(self.round_trip(data, compress_file, **kwargs),
+                             data)
+            for start, length in [(0, 0), (0, 1), (99, 2), (100, 100),
+                                  (5000, 10 ** 6), (len(data), 1)]:
+                self.assertEqual(read_range(name, start, length),
+                                 data[start:start + length])
+            with self.assertRaises(ValueError):
+                read_range(name, -1, 2)
+
+    def test_decode_cache(self):
+        """uncompressing files with the same header hits decode_cache, and
+        the cache never holds more than maxsize tables"""
+
+        maxsize = decode_cache.maxsize
+        decode_cache.clear()
+        decode_cache.maxsize = 2
+        try:
+            for data in [b"abracadabra", b"abracadabra", b"aardvark",
+                         b"zebra", b"abracadabra"]:
+                for kwargs in [{}, {"canonical": True}]:
+                    self.assertEqual(self.round_trip(data, compress,
+                                                     **kwargs), data)
+                    self.assertTrue(len(decode_cache) <= 2)
+            self.assertEqual(decode_cache.hits, 2)
+            self.assertEqual(decode_cache.misses, 8)
+        finally:
+            decode_cache.maxsize = maxsize
+            decode_cache.clear()
+
+    def test_compress_files(self):
+        """compress_files and uncompress_files round trip every file matched,
+        recording failures, with each way of compressing main offers, and
+        main exits non-zero if any file fails"""
+
+        datas = [b"abracadabra" * 10, bytes(range(256))]
+        names = []
+        for i, data in enumerate(datas):
+            names.append(os.path.join(self.dir.name, "f{}".format(i)))
+            with open(names[-1], "wb") as f:
+                f.write(data)
+        missing = os.path.join(self.dir.name, "missing")
+        results = compress_files([os.path.join(self.dir.name, "f*"), missing],
+                                 workers=1, canonical=True)
+        self.assertEqual([result.in_file for result in results],
+                         names + [missing])
+        self.assertEqual([result.error is None for result in results],
+                         [True, True, False])
+        results = uncompress_files([name + ".huf" for name in names],
+                                   workers=2)
+        for result, data in zip(results, datas):
+            self.assertIsNone(result.error)
+            with open(result.out_file, "rb") as f:
+                self.assertEqual(f.read(), data)
+        results = compress_files(names, workers=2, method=compress_context,
+                                 checksum=True)
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertEqual(verify(names[0] + ".huf", require_checksum=True),
+                         len(datas[0]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(main(["c", names[0], "-j", "1"]), 0)
+            self.assertEqual(main(["u", missing, "-j", "1"]), 1)
+            for options in (["--context"], ["--blocks", "--block-size", "7"],
+                            ["--symbols", "word"]):
+                self.assertEqual(main(["c", names[0], "-j", "2"] + options),
+                                 0)
+                self.assertEqual(main(["u", names[0] + ".huf", "-j", "1"]),
+                                 0)
+                with open(names[0] + ".huf.orig", "rb") as f:
+                    self.assertEqual(f.read(), datas[0])
+        with contextlib.redirect_stderr(io.StringIO()), \
+                self.assertRaises(SystemExit):
+            main(["c", names[0], "--context", "--canonical"])
+
+    def test_stats(self):
+        """compress and uncompress record every stage in stats, with the
+        bytes each handled"""
+
+        data = b"abracadabra" * 100
+        compress_stats, uncompress_stats = Stats(), Stats()
+        self.assertEqual(self.round_trip(data, compress,
+                                         {"stats": uncompress_stats},
+                                         chunk_size=64, verbose=False,
+                                         stats=compress_stats), data)
+        self.assertEqual(set(compress_stats.stages),
+                         {"read", "count", "tree", "header", "encode",
+                          "write"})
+        self.assertEqual(compress_stats["read"].bytes_out, 2 * len(data))
+        size = os.path.getsize(os.path.join(self.dir.name, "in.huf"))
+        self.assertEqual(compress_stats["write"].bytes_in, size)
+        self.assertEqual(set(uncompress_stats.stages),
+                         {"header", "read", "decode", "write"})
+        self.assertEqual(uncompress_stats["decode"].bytes_out, len(data))
+        self.assertEqual(uncompress_stats["write"].bytes_in, len(data))
+
+    def test_store(self):
+        """data that coding would not shrink is stored as it is, by file or
+        by block, and still round trips and reads back by range"""
+
+        noise = random.Random(0).randbytes(5000)
+        data = noise + b"abracadabra" * 500
+        name = os.path.join(self.dir.name, "in.huf")
+        self.assertEqual(self.round_trip(noise, compress, use_mmap=True,
+                                         verbose=False, store=True), noise)
+        self.assertEqual(os.path.getsize(name), len(noise) + 6)
+        self.assertEqual(read_range(name, 4990, 20), noise[4990:])
+        self.assertEqual(self.round_trip(data, compress_blocks,
+                                         block_size=1000, workers=1,
+                                         store=True), data)
+        self.assertTrue(os.path.getsize(name) < len(noise) + 3000)
+        self.assertEqual(read_range(name, 4500, 1000), data[4500:5500])
+
+    def test_tiny(self):
+        """empty files and files of one distinct byte round trip and verify
+        with any options"""
+
+        name = os.path.join(self.dir.name, "in.huf")
+        for data in (b"", b"x", b"aaaaaaa"):
+            for kwargs in ({}, {"rle": False}, {"canonical": True},
+                           {"use_mmap": True, "checksum": True},
+                           {"index_interval": 3, "rle": False}):
+                self.assertEqual(self.round_trip(data, compress,
+                                                 verbose=False, **kwargs),
+                                 data)
+                self.assertEqual(verify(name), len(data))
+                self.assertEqual(read_range(name, 1, 3), data[1:4])
+
+    def test_checksum(self):
+        """files compressed with checksums round trip and verify, with their
+        seek index and stored blocks, and a flipped bit is caught by verify
+        and uncompress, which leaves no output behind"""
+
+        noise = random.Random(0).randbytes(5000)
+        data = noise + b"abracadabra" * 500
+        name = os.path.join(self.dir.name, "in.huf")
+        for compress_file, kwargs in (
+                (compress, {"index_interval": 100, "verbose": False,
+                            "store": True}),
+                (compress, {"use_mmap": True, "verbose": False,
+                            "store": True}),
+                (compress_blocks, {"block_size": 1000, "workers": 1,
+                                   "store": True})):
+            for text in (noise, data):
+                self.assertEqual(self.round_trip(text, compress_file,
+                                                 checksum=True, **kwargs),
+                                 text)
+                self.assertEqual(verify(name, workers=1,
+                                        require_checksum=True), len(text))
+                self.assertEqual(read_range(name, 4990, 20),
+                                 text[4990:5010])
+            with open(name, "r+b") as f:
+                f.seek(3000)
+                byte = f.read(1)[0]
+                f.seek(3000)
+                f.write(bytes([byte ^ 1]))
+            with self.assertRaises(ValueError):
+                verify(name, workers=1)
+            with self.assertRaises(ValueError):
+                uncompress(name, name + ".orig", workers=1)
+            self.assertEqual(sorted(os.listdir(self.dir.name)),
+                             ["in", "in.huf", "in.orig"])
+        self.round_trip(data, compress, verbose=False)
+        self.assertEqual(verify(name), len(data))
+        with self.assertRaises(ValueError):
+            verify(name, require_checksum=True)
+        results = verify_files([name, name + ".missing"], workers=1)
+        self.assertEqual([result.error is None for result in results],
+                         [True, False])
+        # a file ending with checksums, compressed again without any
+        self.round_trip(noise, compress, verbose=False, store=True,
+                        checksum=True)
+        with open(name, "rb") as f:
+            archived = f.read()
+        for compress_file, kwargs in (
+                (compress, {"verbose": False}),
+                (compress_blocks, {"block_size": 1000, "workers": 1})):
+            self.assertEqual(self.round_trip(archived, compress_file,
+                                             store=True, **kwargs), archived)
+            self.assertEqual(verify(name, workers=1), len(archived))
+
+    def test_rle(self):
+        """data with long runs is run-length coded unless it has a seek
+        index, round trips, and reads back by range"""
+
+        data = b"".join(bytes([i % 7]) * (i * 13 % 300 + 1)
+                        for i in range(500)) + b"abracadabra" * 100
+        name = os.path.join(self.dir.name, "in.huf")
+        for kwargs in ({}, {"use_mmap": True, "chunk_size": 1000},
+                       {"rle": True, "checksum": True}):
+            self.assertEqual(self.round_trip(data, compress, verbose=False,
+                                             **kwargs), data)
+            with open(name, "rb") as f:
+                self.assertEqual(f.read(2)[1] & ~CHECKSUMMED, FORMAT_RLE)
+            self.assertEqual(read_range(name, 70000, 100),
+                             data[70000:70100])
+            self.assertEqual(verify(name), len(data))
+        size = os.path.getsize(name)
+        self.assertEqual(self.round_trip(data, compress, verbose=False,
+                                         rle=False), data)
+        self.assertTrue(size < os.path.getsize(name) / 2)
+        self.round_trip(data, compress, verbose=False, index_interval=1000)
+        with open(name, "rb") as f:
+            self.assertNotEqual(f.read(2)[1], FORMAT_RLE)
+        with self.assertRaises(ValueError):
+            self.round_trip(data, compress, rle=True, index_interval=1000)
+
+    def test_compress_context(self):
+        """compress_context round trips, reads back by range and verifies,
+        and beats order-0 codes on text"""
+
+        data = b"the cat sat on the mat, then the rat ate the hat. " * 200
+        name = os.path.join(self.dir.name, "in.huf")
+        for text in (data, b"", b"x"):
+            self.assertEqual(self.round_trip(text, compress_context,
+                                             checksum=True), text)
+            self.assertEqual(read_range(name, 100, 50), text[100:150])
+            self.assertEqual(verify(name, require_checksum=True), len(text))
+        bits = compress_context(name[:-4], name)
+        self.assertTrue(bits < avg_length(huffman_tree(make_freq_dict(data)),
+                                          make_freq_dict(data)))
+
+    def test_compress_symbols(self):
+        """compress_symbols round trips in every symbol mode, including odd
+        lengths and empty input, and gives the same file whatever the
+        chunks it reads, even with words and 16-bit symbols across them"""
+
+        data = b"the cat sat on the mat, " * 50 + bytes(range(256)) + b"!"
+        name = os.path.join(self.dir.name, "in.huf")
+        for symbol_mode in (SYMBOLS_BYTE, SYMBOLS_16BIT, SYMBOLS_WORD):
+            for text in (data, b"", b"x"):
+                self.assertEqual(self.round_trip(text, compress_symbols,
+                                                 symbol_mode=symbol_mode),
+                                 text)
+            files = []
+            for chunk_size in (7, len(data)):
+                self.assertEqual(self.round_trip(data, compress_symbols,
+                                                 symbol_mode=symbol_mode,
+                                                 chunk_size=chunk_size),
+                                 data)
+                self.assertEqual(read_range(name, 1000, 10),
+                                 data[1000:1010])
+                with open(name, "rb") as f:
+                    files.append(f.read())
+            self.assertEqual(files[0], files[1])
+
+
+class TestService(unittest.TestCase):
+    """Tests for the asyncio service"""
+
+    def test_service(self):
+        """concurrent clients get their payloads back through the service,
+        and a failed job leaves the connection usable"""
+
+        payloads = [b"abracadabra" * 100, bytes(range(256)) * 3, b"", b"x"]
+
+        async def client(port, payload):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            compressed = await request(reader, writer, b"c", payload)
+            with self.assertRaises(ValueError):
+                await request(reader, writer, b"u", b"\x00\x09")
+            result = await request(reader, writer, b"u", compressed)
+            writer.close()
+            await writer.wait_closed()
+            return result
+
+        async def run():
+            service = HuffmanService(workers=2, max_in_flight=2)
+            server = await asyncio.start_server(service.handle, "127.0.0.1",
+                                                0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await asyncio.gather(*[client(port, payload)
+                                              for payload in payloads])
+            finally:
+                server.close()
+                await server.wait_closed()
+                service.close()
+
+        self.assertEqual(asyncio.run(run()), payloads)
+
+    def test_service_limits(self):
+        """a payload declaring more output than it can hold fails without
+        decoding it, one declaring more than max_output is rejected, and a
+        frame larger than MAX_PAYLOAD is answered with an error"""
+
+        buf = compress_bytes(b"abracadabra" * 2)
+        # the size follows the magic, format and code lengths of 5 symbols
+        forged = buf[:13] + size_to_bytes(20000000) + buf[17:]
+        with self.assertRaises(ValueError):
+            uncompress_bytes(forged)
+
+        async def run():
+            service = HuffmanService(workers=1, max_output=1000)
+            try:
+                with self.assertRaises(ValueError):
+                    await service.uncompress(forged)
+                return await service.uncompress(buf)
+            finally:
+                service.close()
+
+        self.assertEqual(asyncio.run(run()), b"abracadabra" * 2)
+
+        async def oversized():
+            service = HuffmanService(workers=1)
+            server = await asyncio.start_server(service.handle, "127.0.0.1",
+                                                0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1",
+                                                               port)
+                writer.write(b"u" + size_to_bytes(MAX_PAYLOAD + 1))
+                frames = [await read_frame(reader), await read_frame(reader)]
+                writer.close()
+                await writer.wait_closed()
+                return frames
+            finally:
+                server.close()
+                await server.wait_closed()
+                service.close()
+
+        error, end = asyncio.run(oversized())
+        self.assertEqual(error[0], ERROR)
+        self.assertIn(b"too large", error[1])
+        self.assertIsNone(end)
+
+
 if __name__ == "__main__":
     unittest.main()